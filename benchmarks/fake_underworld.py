@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+=================
+ Fake Underworld
+=================
+
+A stand-in for the Underworld binary, so the LMR Python pipeline can be
+exercised and benchmarked on machines that do not have Underworld installed.
+
+It understands the command line that lmrRunModel.py builds, prints output that
+looks like a real Underworld run (timestep headers, non-linear iterations and
+-A11_ksp_monitor residuals), and writes the same checkpoint files Underworld
+does: FrequentOutput.dat, Mesh.linearMesh.00000.h5, <Field>.NNNNN.h5,
+materialSwarm.NNNNN.h5 and the XDMF meta files. If h5py is available the .h5
+files are real HDF5 files with sensibly shaped datasets, otherwise they are
+filled with placeholder bytes of a similar size.
+
+It can also stand in for mpirun. When the first argument is a CPU flag (e.g.
+-np 4), the flag and the following program name are skipped, so setting both
+<parallel_command> and <Underworld_binary> to this file works:
+
+    fake_underworld.py -np 4 fake_underworld.py lmrMain.xml --dim=2 ...
+
+The cost of a timestep scales with the number of elements. It can be tuned
+with the LMR_FAKE_UW_SECONDS_PER_ELEMENT environment variable.
+"""
+
+import os
+import sys
+import time
+import random
+
+try:
+    import numpy as np
+    import h5py
+    have_h5py = True
+except ImportError:
+    have_h5py = False
+
+
+SECONDS_PER_YEAR = 3.15569e7
+
+CHECKPOINTED_FIELDS = [("VelocityField", "dim"),
+                       ("PressureField", 1),
+                       ("TemperatureField", 1),
+                       ("TemperatureField-phiDotField", 1),
+                       ("StrainRateField", "tensor"),
+                       ("StressField", "tensor"),
+                       ("MaterialIndexField", 1)]
+
+THERMAL_FIELDS = ["VelocityField",
+                  "PressureField",
+                  "TemperatureField",
+                  "TemperatureField-phiDotField"]
+
+
+def parse_arguments(argv):
+    """
+    Turn the Underworld command line into a dict. Anything that isn't a
+    --key=value flag (XML files, PETSc options) is kept in a list.
+    """
+    args = list(argv)
+
+    # Pretend to be mpirun: <cpu flag> <cpus> <program> ...
+    cpus = 1
+    if len(args) > 2 and args[0].startswith("-") and "=" not in args[0]:
+        try:
+            cpus = int(args[1])
+            args = args[3:]
+        except ValueError:
+            pass
+
+    options = {"cpus": cpus}
+    others = []
+    for arg in args:
+        if arg.startswith("--") and "=" in arg:
+            key, value = arg[2:].split("=", 1)
+            options[key] = value
+        elif arg:
+            others.append(arg)
+    options["others"] = others
+    return options
+
+
+def write_h5(filename, datasets, placeholder_bytes):
+    if have_h5py:
+        with h5py.File(filename, "w") as h5file:
+            for name, data in datasets.items():
+                h5file.create_dataset(name, data=data)
+    else:
+        with open(filename, "wb") as h5file:
+            h5file.write(b"\0" * placeholder_bytes)
+
+
+def write_checkpoint(output_path, timestep, res, dims, thermal_only, rng):
+    nodes = (res[0] + 1) * (res[1] + 1) * ((res[2] + 1) if dims == 3 else 1)
+    elements = res[0] * res[1] * (res[2] if dims == 3 else 1)
+    tensor = 6 if dims == 3 else 3
+
+    for field, components in CHECKPOINTED_FIELDS:
+        if thermal_only and field not in THERMAL_FIELDS:
+            continue
+        if components == "dim":
+            components = dims
+        elif components == "tensor":
+            components = tensor
+        rows = elements if field == "PressureField" else nodes
+        data = None
+        if have_h5py:
+            data = np.full((rows, components), rng.random())
+        write_h5(os.path.join(output_path, "{0}.{1:05d}.h5".format(field, timestep)),
+                 {"data": data}, rows * components * 8)
+
+    if not thermal_only:
+        particles = elements * 40
+        positions = np.zeros((particles, dims)) if have_h5py else None
+        write_h5(os.path.join(output_path, "materialSwarm.{0:05d}.h5".format(timestep)),
+                 {"Position": positions}, particles * dims * 8)
+
+    with open(os.path.join(output_path, "XDMF.{0:05d}.xmf".format(timestep)), "w") as xmf:
+        xmf.write('<?xml version="1.0" ?>\n'
+                  '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">\n'
+                  '<Domain>\n'
+                  '<Grid Name="FEM_Mesh_linearMesh">\n'
+                  '\t<Time Value="{0}" />\n'
+                  '</Grid>\n'
+                  '</Domain>\n'
+                  '</Xdmf>\n'.format(timestep))
+
+    with open(os.path.join(output_path, "XDMF.FilesField.xdmf"), "a") as files_field:
+        files_field.write('\t<xi:include href="XDMF.{0:05d}.xmf" '
+                          'xpointer="xpointer(//Xdmf/Domain/Grid[1])"/>\n'.format(timestep))
+
+
+def write_mesh(output_path, res, dims):
+    axes = [np.linspace(0.0, 1.0, n + 1) for n in res[:dims]] if have_h5py else None
+    nodes = (res[0] + 1) * (res[1] + 1) * ((res[2] + 1) if dims == 3 else 1)
+    vertices = None
+    if have_h5py:
+        grids = np.meshgrid(*axes, indexing="ij")
+        vertices = np.column_stack([g.transpose().ravel() for g in grids])
+    write_h5(os.path.join(output_path, "Mesh.linearMesh.00000.h5"),
+             {"vertices": vertices}, nodes * dims * 8)
+
+
+def main():
+    options = parse_arguments(sys.argv[1:])
+
+    dims = int(options.get("dim", 2))
+    res = [int(options.get("elementResI", 8)),
+           int(options.get("elementResJ", 8)),
+           int(options.get("elementResK", 0))]
+    output_path = options.get("outputPath", "./output")
+    max_steps = int(options.get("maxTimeSteps", 10))
+    end_time = float(options.get("end", 1e6)) * SECONDS_PER_YEAR
+    checkpoint_every = int(options.get("checkpointEvery", 1))
+    checkpoint_time_inc = float(options.get("checkpointAtTimeInc", 1e12)) * SECONDS_PER_YEAR
+    max_nonlinear = int(options.get("nonLinearMaxIterations", 5))
+    nonlinear_tolerance = float(options.get("nonLinearTolerance", 1e-3))
+    restart_step = int(options.get("restartTimestep", 0))
+    thermal_only = any("lmrThermalEquilibration.xml" in arg for arg in options["others"])
+    use_multigrid = any(arg.startswith("--mgLevels") for arg in sys.argv)
+
+    seconds_per_element = float(os.environ.get("LMR_FAKE_UW_SECONDS_PER_ELEMENT", 2e-7))
+    elements = res[0] * res[1] * (res[2] if dims == 3 else 1)
+    rng = random.Random(sum(res) + dims)
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+
+    print("StGermain Framework revision fake. Copyright (C) 2003-2005 VPAC.")
+    print("Underworld (Geodynamics toolbox) revision fake. Copyright (C) 2005 Monash University.")
+    print("Running with {0} processes.".format(options["cpus"]))
+    sys.stdout.flush()
+
+    if restart_step == 0:
+        write_mesh(output_path, res, dims)
+        with open(os.path.join(output_path, "FrequentOutput.dat"), "w") as freq:
+            freq.write("#       Timestep            Time        CPU_Time            Vrms\n")
+        with open(os.path.join(output_path, "XDMF.FilesField.xdmf"), "w") as files_field:
+            files_field.write('<?xml version="1.0" ?>\n'
+                              '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">\n'
+                              '<Grid GridType="Collection" CollectionType="Temporal" Name="FEM_Mesh_Fields">\n')
+        write_checkpoint(output_path, 0, res, dims, thermal_only, rng)
+
+    # Aim to get to the end time in roughly max_steps, like a well behaved model.
+    dt = end_time / max(max_steps, 1)
+    model_time = restart_step * dt
+    last_checkpoint_time = model_time
+    start_wall = time.time()
+
+    step = restart_step
+    while step < max_steps and model_time < end_time:
+        step += 1
+        print("TimeStep = {0}, Start time = {1:.6g} + {2:.6g} prev timeStep dt".format(step, model_time, dt))
+
+        iterations = 1 if thermal_only else rng.randint(2, max(2, min(max_nonlinear, 6)))
+        residual = 1.0
+        for iteration in range(iterations):
+            print("Non linear solver - iteration {0}".format(iteration))
+            ksp_iterations = rng.randint(3, 12) if use_multigrid else 1
+            for ksp in range(ksp_iterations):
+                print("  {0} KSP Residual norm {1:.12e}".format(ksp, residual * 10 ** (-ksp)))
+            time.sleep(seconds_per_element * elements)
+            residual *= 10 ** -rng.uniform(0.5, 1.5)
+            converged = residual < nonlinear_tolerance or iteration == iterations - 1
+            print("Non linear solver - Residual {0:.8e}; Tolerance {1:.4e} - {2} - {3:.4f} (secs)".format(
+                residual, nonlinear_tolerance, "Converged" if converged else "Not converged",
+                seconds_per_element * elements))
+        print("Non linear solver - Converged after {0} iterations".format(iterations))
+        sys.stdout.flush()
+
+        model_time += dt
+        with open(os.path.join(output_path, "FrequentOutput.dat"), "a") as freq:
+            freq.write("{0:16d}{1:16.6e}{2:16.6e}{3:16.6e}\n".format(step, model_time,
+                                                                 time.time() - start_wall,
+                                                                 rng.uniform(1e-10, 1e-9)))
+
+        if step % checkpoint_every == 0 or model_time - last_checkpoint_time >= checkpoint_time_inc:
+            write_checkpoint(output_path, step, res, dims, thermal_only, rng)
+            last_checkpoint_time = model_time
+
+    with open(os.path.join(output_path, "XDMF.FilesField.xdmf"), "a") as files_field:
+        files_field.write("</Grid>\n</Xdmf>\n")
+
+    print("Finished at TimeStep = {0}, time = {1:.6g}".format(step, model_time))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
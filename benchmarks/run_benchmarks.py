@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+================
+ LMR benchmarks
+================
+
+Times each stage of the LMR launcher (load_xml, process_xml, prepare_job,
+run_model and post_model_run) on a set of small canonical 2D and 3D models,
+and appends the results to a history file so versions can be compared.
+
+By default the models are run with fake_underworld.py, which prints realistic
+Underworld output and writes realistic checkpoint files, so the Python side
+of the LMR can be benchmarked on machines without Underworld. Use --binary to
+time a real Underworld build instead.
+
+Run by:
+    python benchmarks/run_benchmarks.py                 # All cases
+    python benchmarks/run_benchmarks.py 2d_small 3d_small
+    python benchmarks/run_benchmarks.py --list
+
+Each case runs the thermal equilibration phase, then the thermo-mechanical
+phase, in a scratch copy of the LMR XMLs. For every stage it records the wall
+time, and after run_model it records the peak RSS of the launcher and of the
+Underworld processes, plus the number of timesteps, non-linear iterations and
+KSP iterations found in the Underworld output.
+"""
+
+from __future__ import division
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from xml.etree import ElementTree
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LMR_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, LMR_DIR)
+
+import lmrRunModel  # noqa: E402
+
+
+LMR_NAMESPACE = "https://bitbucket.org/lmondy/lithosphericmodellingrecipe"
+
+# name: (model resolution, thermal resolution, mechanical timesteps, extra <Solver_Details>)
+CASES = [("2d_small",         (64, 32, 0),   (4, 48, 0), 10, {}),
+         ("2d_medium",        (128, 64, 0),  (4, 48, 0), 10, {}),
+         ("2d_large",         (256, 128, 0), (4, 48, 0), 10, {}),
+         ("2d_multigrid",     (128, 64, 0),  (4, 48, 0), 10, {"force_multigrid_solve": "true"}),
+         ("3d_small",         (16, 16, 16),  (4, 48, 4), 5,  {}),
+         ("3d_medium",        (32, 16, 32),  (4, 48, 4), 5,  {})]
+
+THERMAL_TIMESTEPS = 5
+
+STAGES = ["load_xml", "process_xml", "prepare_job", "run_model", "post_model_run"]
+
+timestep_re = re.compile(r"^TimeStep = (\d+)")
+nonlinear_re = re.compile(r"^Non linear solver - iteration \d+")
+ksp_re = re.compile(r"^\s*\d+ KSP Residual norm")
+
+
+def write_start_xml(template, filename, case, thermal, binary, cpus):
+    """
+    Write a copy of lmrStart.xml set up for one phase of a benchmark case.
+    """
+    name, res, therm_res, timesteps, solver_details = case
+
+    ElementTree.register_namespace("lmr", LMR_NAMESPACE)
+    ElementTree.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    tree = ElementTree.parse(template)
+    root = tree.getroot()
+
+    def set_text(path, value):
+        root.find(path).text = " {0} ".format(value)
+
+    set_text("Output_Controls/description", "benchmark_{0}".format(name))
+    for axis, value in zip("xyz", res):
+        set_text("Output_Controls/model_resolution/{0}".format(axis), value)
+    set_text("Output_Controls/experiment_duration_options/maximum_timesteps", timesteps)
+    set_text("Output_Controls/checkpoint_frequency_options/every_x_timesteps", max(1, timesteps // 2))
+    set_text("Output_Controls/write_log_file", "false")
+
+    set_text("Thermal_Equilibration/run_thermal_equilibration_phase", "true" if thermal else "false")
+    for axis, value in zip("xyz", therm_res):
+        set_text("Thermal_Equilibration/output_controls/thermal_model_resolution/{0}".format(axis), value)
+    set_text("Thermal_Equilibration/output_controls/experiment_duration_options/maximum_timesteps",
+             THERMAL_TIMESTEPS)
+    set_text("Thermal_Equilibration/output_controls/checkpoint_frequency_options/every_x_timesteps",
+             THERMAL_TIMESTEPS)
+
+    set_text("Restarting_Controls/restart", "false")
+    for key, value in solver_details.items():
+        set_text("Solver_Details/{0}".format(key), value)
+
+    uw_exec = root.find("Underworld_Execution")
+    set_text("Underworld_Execution/Underworld_binary", binary)
+    set_text("Underworld_Execution/CPUs", cpus)
+    if binary.endswith("fake_underworld.py") and uw_exec.find("parallel_command") is None:
+        # The fake binary doubles as mpirun. <parallel_command> must come
+        # after <supercomputer_mpi_format> to keep the XSD happy.
+        position = list(uw_exec).index(uw_exec.find("supercomputer_mpi_format")) + 1
+        parallel_command = ElementTree.Element("parallel_command")
+        parallel_command.text = " {0} ".format(binary)
+        uw_exec.insert(position, parallel_command)
+
+    tree.write(filename, encoding="UTF-8", xml_declaration=True)
+
+
+def count_output(log_filename):
+    counts = {"timesteps": 0, "nonlinear_iterations": 0, "ksp_iterations": 0}
+    with open(log_filename) as log_file:
+        for line in log_file:
+            if ksp_re.match(line):
+                counts["ksp_iterations"] += 1
+            elif nonlinear_re.match(line):
+                counts["nonlinear_iterations"] += 1
+            elif timestep_re.match(line):
+                counts["timesteps"] += 1
+    return counts
+
+
+def run_phase(start_xml, xsd, log_filename):
+    """
+    Run the LMR stages one after another, exactly as lmrRunModel.main() does,
+    timing each of them.
+    """
+    timings = {}
+
+    start = time.time()
+    raw_dict = lmrRunModel.load_xml(start_xml, xsd)
+    timings["load_xml"] = time.time() - start
+
+    start = time.time()
+    model_dict, command_dict = lmrRunModel.process_xml(raw_dict)
+    timings["process_xml"] = time.time() - start
+
+    start = time.time()
+    model_dict, command_dict = lmrRunModel.prepare_job(model_dict, command_dict)
+    timings["prepare_job"] = time.time() - start
+
+    # run_model hands sys.stdout to Underworld, so it must be a real file.
+    real_stdout = sys.stdout
+    sys.stdout.flush()
+    with open(log_filename, "a") as log_file:
+        sys.stdout = log_file
+        try:
+            start = time.time()
+            lmrRunModel.run_model(model_dict, command_dict)
+            timings["run_model"] = time.time() - start
+        finally:
+            sys.stdout = real_stdout
+
+    start = time.time()
+    lmrRunModel.post_model_run(model_dict)
+    timings["post_model_run"] = time.time() - start
+
+    return timings
+
+
+def run_case(case, binary, cpus, keep):
+    name = case[0]
+    workdir = tempfile.mkdtemp(prefix="lmr_benchmark_{0}_".format(name))
+    for filename in os.listdir(LMR_DIR):
+        if filename.endswith((".xml", ".xsd")):
+            shutil.copy(os.path.join(LMR_DIR, filename), workdir)
+
+    template = os.path.join(LMR_DIR, "lmrStart.xml")
+    xsd = os.path.join(workdir, "LMR.xsd")
+    thermal_xml = os.path.join(workdir, "lmrStart.xml")
+    mechanical_xml = os.path.join(workdir, "lmrStart.mechanical.xml")
+    log_filename = os.path.join(workdir, "benchmark_log.txt")
+    write_start_xml(template, thermal_xml, case, True, binary, cpus)
+    write_start_xml(template, mechanical_xml, case, False, binary, cpus)
+
+    result = {"case": name,
+              "resolution": "x".join(map(str, case[1])),
+              "thermal_resolution": "x".join(map(str, case[2])),
+              "cpus": cpus}
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for phase, start_xml in (("thermal", thermal_xml), ("mechanical", mechanical_xml)):
+            timings = run_phase(start_xml, xsd, log_filename)
+            for stage in STAGES:
+                result["{0}_{1}".format(phase, stage)] = timings[stage]
+    finally:
+        os.chdir(cwd)
+
+    result["wall_time"] = sum(value for key, value in result.items()
+                              if key.split("_", 1)[-1] in STAGES)
+    # ru_maxrss is in kilobytes on Linux, bytes on OSX.
+    rss_scale = 1 if sys.platform == "darwin" else 1024
+    result["peak_rss_launcher"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_scale
+    result["peak_rss_underworld"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_scale
+    result.update(count_output(log_filename))
+
+    if keep:
+        result["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=LMR_DIR,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_history(history_file):
+    history = []
+    if os.path.isfile(history_file):
+        with open(history_file) as hist:
+            for line in hist:
+                line = line.strip()
+                if line:
+                    history.append(json.loads(line))
+    return history
+
+
+def report(results, history):
+    """
+    Print a summary, with the change relative to the last recorded run of
+    each case.
+    """
+    previous = {}
+    for entry in history:
+        previous[entry["case"]] = entry
+
+    print("\n{0:<16}{1:>12}{2:>12}{3:>12}{4:>14}{5:>10}{6:>10}".format(
+        "case", "wall (s)", "run (s)", "python (s)", "peak UW (MB)", "NL its", "vs last"))
+    for result in results:
+        run_time = result["thermal_run_model"] + result["mechanical_run_model"]
+        change = ""
+        if result["case"] in previous:
+            change = "{0:+.1%}".format(result["wall_time"] / previous[result["case"]]["wall_time"] - 1)
+        print("{0:<16}{1:>12.3f}{2:>12.3f}{3:>12.3f}{4:>14.1f}{5:>10d}{6:>10}".format(
+            result["case"], result["wall_time"], run_time, result["wall_time"] - run_time,
+            result["peak_rss_underworld"] / 1024 ** 2, result["nonlinear_iterations"], change))
+
+
+def main():
+    case_names = [case[0] for case in CASES]
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the LMR launcher.")
+    parser.add_argument("cases", nargs="*", default=case_names,
+                        help="Which cases to run. The default is all of them.")
+    parser.add_argument("--list", action="store_true",
+                        help="List the available cases and exit.")
+    parser.add_argument("--binary", default=os.path.join(BENCHMARK_DIR, "fake_underworld.py"),
+                        help="The Underworld binary to use. The default is the fake one.")
+    parser.add_argument("--cpus", type=int, default=1,
+                        help="How many CPUs to run Underworld on.")
+    parser.add_argument("--history", default=os.path.join(BENCHMARK_DIR, "history.jsonl"),
+                        help="The file results are appended to, one JSON record per line.")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the scratch directories the models ran in.")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, res, therm_res, timesteps, _ in CASES:
+            print("{0:<16} {1:>12} ({2} steps), thermal {3}".format(
+                name, "x".join(map(str, res)), timesteps, "x".join(map(str, therm_res))))
+        return 0
+
+    unknown = set(args.cases) - set(case_names)
+    if unknown:
+        sys.exit("ERROR - Unknown cases: {0}. Use --list to see them.".format(", ".join(sorted(unknown))))
+
+    binary = os.path.abspath(args.binary)
+    if not os.path.exists(binary):
+        sys.exit("ERROR - Can't find the Underworld binary: {0}".format(binary))
+
+    history = load_history(args.history)
+    common = {"date": datetime.datetime.now().isoformat(),
+              "revision": git_revision(),
+              "host": socket.gethostname(),
+              "python": platform.python_version(),
+              "binary": binary}
+
+    results = []
+    for case in CASES:
+        if case[0] not in args.cases:
+            continue
+        print("Running {0}...".format(case[0]))
+        sys.stdout.flush()
+        # A fresh process per case, so the peak RSS figures belong to that case alone.
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(run_case, (case, binary, args.cpus, args.keep))
+        finally:
+            pool.close()
+            pool.join()
+        result.update(common)
+        results.append(result)
+        with open(args.history, "a") as hist:
+            hist.write(json.dumps(result, sort_keys=True) + "\n")
+
+    report(results, history)
+    print("\nResults appended to {0}".format(args.history))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,697 @@
+"""
+==========================
+ 1D steady-state geotherm
+==========================
+
+Solves the thermal equilibration phase without Underworld, for models that
+are laterally homogeneous (every material layer and fixed-temperature shape
+spans the whole width of the model, like the default laterally_homog setup).
+The temperature then only depends on depth, and the steady state Underworld
+would reach after hundreds of millions of years is the solution of
+
+    d/dy (diffusivity * dT/dy) + sourceTerms_thermalEqn = 0
+
+which takes a fraction of a second to solve on a 1D mesh.
+
+Everything is read from the same XMLs Underworld would use (lmrMain.xml and
+the lmr*.xml files it includes, plus lmrThermalEquilibration.xml): the domain
+and layer geometry and material properties from lmrMaterials.xml and
+lmrRheologyLibrary.xml, the heat sources from lmrNumerics.xml, and the fixed
+temperatures (or basal heat flux) from lmrThermalBoundaries.xml. Temperature
+dependent densities are handled by iterating until the geotherm stops
+changing. Latent heat from melting is zero in a steady state.
+
+Properties are averaged within each element, so a layer boundary that falls
+between nodes is still accounted for: diffusivity as a harmonic mean (layers
+conduct in series), heat sources as an arithmetic mean.
+
+If the model is anything the solver doesn't understand (a shape that doesn't
+span the model, a property function it can't evaluate, ...) a ModelError
+(GeothermError for what only the solver needs) says why, and lmrRunModel.py
+runs Underworld instead.
+
+The result is written as a timestep 0 checkpoint of the thermal model, in the
+layout the mechanical phase reads it from: Mesh.linearMesh.00000.h5 and
+TemperatureField.00000.h5, plus the rest of the thermal checkpoint and a
+geotherm_1d.txt of the profile.
+
+Used by lmrRunModel.py when <use_1d_steady_state_solver> is true, or run by
+itself (from a model folder) to see the geotherm without writing anything:
+    python lmrGeotherm.py [lmrMain.xml lmrThermalEquilibration.xml] [--resolution 48]
+"""
+
+from __future__ import division
+import argparse
+import collections
+import os
+import re
+import sys
+import time
+from xml.etree import ElementTree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class ModelError(Exception):
+    """
+    Something in a model's XMLs can't be read or evaluated here.
+    """
+    pass
+
+
+class GeothermError(ModelError):
+    """
+    The model can't be solved as a 1D geotherm, so Underworld has to do it.
+    """
+    pass
+
+
+# Conversion to SI of the units used in the LMR XMLs.
+UNITS = {"": 1.0, "m": 1.0, "km": 1e3, "K": 1.0, "K^-1": 1.0, "1/K": 1.0,
+         "m*m/s": 1.0, "m^2/s": 1.0, "m^2*s^-1": 1.0,
+         "J/(K*kg)": 1.0, "J/(kg*K)": 1.0, "J*kg^-1*K^-1": 1.0,
+         "W/(m*m*m)": 1.0, "W/m^3": 1.0, "W*m^-3": 1.0, "uW/m^3": 1e-6, "microW/m^3": 1e-6,
+         "W/(m*m)": 1.0, "W/m^2": 1.0, "mW/(m*m)": 1e-3, "mW/m^2": 1e-3, "mW*m^-2": 1e-3,
+         "kg*m^-3": 1.0, "kg/m^3": 1.0, "kg/(m*m*m)": 1.0,
+         "J*kg^-1": 1.0, "kJ*kg^-1": 1e3, "Pa": 1.0, "MPa": 1e6, "GPa": 1e9, "Pa^-1": 1.0,
+         "m*s^-2": 1.0, "m/s^2": 1.0, "s^-1": 1.0, "Pa*s": 1.0,
+         "J/mol": 1.0, "kJ/mol": 1e3, "kJ*mol^-1": 1e3, "m^3/mol": 1.0, "m^3*mol^-1": 1.0}
+
+# Stress to a power, like the (MPa)^-3.5*s^-1 of flow law pre-exponential factors.
+STRESS_POWER_UNITS = re.compile(r"^\(?(k|M|G)?Pa\)?\^(-?[0-9.]+)\*s\^-1$")
+
+GAS_CONSTANT = 8.3144621
+
+
+def unit_factor(units):
+    """
+    What to multiply a value in these units by to get SI units.
+    """
+    if units in UNITS:
+        return UNITS[units]
+    match = STRESS_POWER_UNITS.match(units.replace(" ", ""))
+    if match:
+        return {None: 1.0, "k": 1e3, "M": 1e6, "G": 1e9}[match.group(1)] ** float(match.group(2))
+    raise ModelError("Unknown units '{0}'".format(units))
+
+
+# Samples per element used to average the properties.
+SAMPLES_PER_ELEMENT = 16
+
+Param = collections.namedtuple("Param", ["text", "units"])
+
+
+# === Reading the StGermain XMLs =============================================
+
+def local_tag(element):
+    tag = element.tag if isinstance(element.tag, str) else ""
+    return tag.split("}")[-1]
+
+
+def read_value(element):
+    tag = local_tag(element)
+    if tag == "param":
+        return Param((element.text or "").strip(), (element.get("units") or "").strip())
+    if tag == "list":
+        return [read_value(child) for child in element if local_tag(child) in ("param", "struct", "list")]
+    struct = collections.OrderedDict()
+    for child in element:
+        merge_child(struct, child)
+    return struct
+
+
+def merge_child(struct, element):
+    """
+    Add element to struct the way StGermain does: replace what is there,
+    unless mergeType="merge", when structs are merged and lists appended to.
+    """
+    if local_tag(element) not in ("param", "struct", "list") or element.get("name") is None:
+        return
+    name = element.get("name")
+    existing = struct.get(name)
+    if element.get("mergeType") == "merge" and isinstance(existing, collections.OrderedDict) \
+            and local_tag(element) == "struct":
+        for child in element:
+            merge_child(existing, child)
+    elif element.get("mergeType") == "merge" and isinstance(existing, list) and local_tag(element) == "list":
+        existing.extend(read_value(element))
+    else:
+        struct[name] = read_value(element)
+
+
+def load_stgermain(xml_files, merged=None):
+    """
+    Merge XML files (and the LMR files they <include>) into one dictionary.
+    Includes that aren't next to the including file are Underworld's own, so
+    are skipped.
+    """
+    merged = collections.OrderedDict() if merged is None else merged
+    for xml_file in xml_files:
+        try:
+            root = ElementTree.parse(xml_file).getroot()
+        except (IOError, ElementTree.ParseError) as err:
+            raise ModelError("Unable to read {0}: {1}".format(xml_file, err))
+        for element in root:
+            if local_tag(element) == "include":
+                included = os.path.join(os.path.dirname(xml_file), (element.text or "").strip())
+                if os.path.isfile(included):
+                    load_stgermain([included], merged)
+            else:
+                merge_child(merged, element)
+    return merged
+
+
+# === The model, as seen down one column ======================================
+
+class Column(object):
+    """
+    A vertical line through the model, with the material at each point, and
+    the property functions of the XMLs evaluated along it.
+    """
+    def __init__(self, config):
+        self.params = config
+        self.components = config.get("components", collections.OrderedDict())
+        self.materials = [(name, struct) for name, struct in self.components.items()
+                          if isinstance(struct, dict) and self.text(struct, "Type") in ("RheologyMaterial", "Material")]
+
+    @staticmethod
+    def text(struct, name, default=None):
+        param = struct.get(name)
+        return param.text if isinstance(param, Param) else default
+
+    def number(self, param, seen=()):
+        """
+        A param's value in SI units. It can also be the name of a top-level
+        param, like the minX used in shapes.
+        """
+        try:
+            value = float(param.text)
+        except ValueError:
+            if param.text in self.params and isinstance(self.params[param.text], Param) and param.text not in seen:
+                return self.number(self.params[param.text], seen + (param.text,))
+            raise ModelError("Unable to find a number for '{0}'".format(param.text))
+        return value * unit_factor(param.units)
+
+    def domain(self, axis):
+        return (self.number(Param("min" + axis, "")), self.number(Param("max" + axis, "")))
+
+    def inside(self, shape_name, x, y, z):
+        """
+        Whether each point is inside a shape. x, y and z (None in 2D) are
+        broadcast together, so they can be a scalar x and z and an array of
+        y for a column, or open grids (e.g. from np.ix_) for the whole model.
+        """
+        return np.broadcast_to(self.region(shape_name, x, y, z), points_shape(x, y, z))
+
+    def region(self, shape_name, x, y, z):
+        """
+        The same as inside, but only broadcast as far as the shape needs: a
+        box that only limits y is an array of y, however big x and z are.
+        """
+        invert = shape_name.startswith("!")
+        shape_name = shape_name.lstrip("!")
+        shape = self.components.get(shape_name)
+        if not isinstance(shape, dict):
+            raise ModelError("Unable to find the shape '{0}'".format(shape_name))
+        shape_type = self.text(shape, "Type")
+        if shape_type == "Box":
+            inside = np.array(True)
+            for axis, values in (("X", x), ("Y", y), ("Z", z)):
+                if values is None:
+                    continue
+                limit = np.array(True)
+                if "start" + axis in shape:
+                    limit = limit & (values >= self.number(shape["start" + axis]))
+                if "end" + axis in shape:
+                    limit = limit & (values <= self.number(shape["end" + axis]))
+                # Limits that every point is within (like minZ to maxZ) don't add a dimension.
+                if not np.all(limit):
+                    inside = inside & limit
+        elif shape_type in ("Union", "Intersection"):
+            parts = [self.region(part.text.strip(), x, y, z)
+                     for part in shape.get("shapes", []) if isinstance(part, Param)]
+            if not parts:
+                raise ModelError("The shape '{0}' has no shapes in it".format(shape_name))
+            inside = parts[0]
+            for part in parts[1:]:
+                inside = (inside | part) if shape_type == "Union" else (inside & part)
+        elif shape_type == "Everywhere":
+            inside = np.array(True)
+        else:
+            raise ModelError("The shape '{0}' is a {1}, which can't be evaluated here".format(
+                shape_name, shape_type))
+        return ~inside if invert else inside
+
+    def material_index(self, x, y, z, allow_gaps=False):
+        """
+        The index (into self.materials) of the material at each point (x, y
+        and z broadcast together, as for inside). Later materials overprint
+        earlier ones, like in Underworld. Points with no material are -1 if
+        allow_gaps, or else an error.
+        """
+        index = np.full(points_shape(x, y, z), -1, dtype=np.int16)
+        for number, (name, material) in enumerate(self.materials):
+            shape = self.text(material, "Shape")
+            if shape:
+                np.copyto(index, number, where=self.region(shape.strip(), x, y, z))
+        if np.any(index < 0) and not allow_gaps:
+            raise ModelError("Part of the model (y = {0:.6g} m) has no material".format(
+                np.broadcast_to(y, index.shape)[index < 0][0]))
+        return index
+
+    def thermally_identical(self, first, second):
+        """
+        Whether two materials (indices into self.materials) have the same
+        thermal properties, at any temperature.
+        """
+        temperature = np.linspace(273.15, 2273.15, 9)
+        for name in ("DiffusivityProperty", "sourceTerms_thermalEqn"):
+            values = [self.evaluate(name, temperature, np.full(temperature.shape, number))
+                      for number in (first, second)]
+            if not np.allclose(values[0], values[1], rtol=1e-12, atol=0):
+                return False
+        return True
+
+    def evaluate(self, name, temperature, material, units="", pressure=None):
+        """
+        A property function (a number, a component like global_cp or
+        radiogenicHeating, or a material property like DensityProperty),
+        evaluated at points with the given temperatures and materials (and
+        pressures, for the functions that need them).
+        """
+        name = name.strip()
+        try:
+            float(name)
+        except ValueError:
+            pass
+        else:
+            return np.full(temperature.shape, self.number(Param(name, units)))
+
+        component = self.components.get(name)
+        if isinstance(component, dict):
+            return self.evaluate_component(name, component, temperature, material, pressure)
+
+        if any(name in struct for _, struct in self.materials):
+            result = np.empty(temperature.shape)
+            for number in np.unique(material):
+                material_name, struct = self.materials[number]
+                if not isinstance(struct.get(name), Param):
+                    raise ModelError("The material '{0}' has no {1}".format(material_name, name))
+                mask = material == number
+                result[mask] = self.evaluate(struct[name].text, temperature[mask], material[mask], struct[name].units,
+                                             None if pressure is None else pressure[mask])
+            return result
+
+        raise ModelError("Unable to find the property '{0}'".format(name))
+
+    def evaluate_component(self, name, component, temperature, material, pressure=None):
+        ppc_type = self.text(component, "Type")
+
+        def evaluate(param_name, default=None):
+            if param_name not in component and default is not None:
+                return np.full(temperature.shape, default)
+            param = component[param_name]
+            return self.evaluate(param.text, temperature, material, param.units, pressure)
+
+        if ppc_type == "Ppc_Constant":
+            return np.full(temperature.shape, self.number(component["Value"]))
+
+        if ppc_type == "Ppc_Variable":
+            field = self.text(component, "FieldVariable")
+            if field == "TemperatureField":
+                return temperature
+            if field == "PressureField" and pressure is not None:
+                return pressure
+            raise ModelError("'{0}' depends on {1}, which isn't known here".format(name, field))
+
+        if ppc_type == "Ppc_Operation":
+            operation = self.text(component, "Operation")
+            values = [self.evaluate(item.text, temperature, material, item.units, pressure)
+                      for item in component.get("Properties", []) if isinstance(item, Param)]
+            if not values or operation not in ("+", "-", "*", "/"):
+                raise ModelError("Unable to evaluate the operation '{0}'".format(name))
+            result = values[0]
+            for value in values[1:]:
+                if operation == "+":
+                    result = result + value
+                elif operation == "-":
+                    result = result - value
+                elif operation == "*":
+                    result = result * value
+                else:
+                    result = result / value
+            return result
+
+        if ppc_type in ("Ppc_LinearDensity", "Ppc_LinearDensityMelt"):
+            # rho = rhoRef * (1 + beta * deltaP - alpha * deltaT - meltFraction * meltDensityChange)
+            change = -evaluate("ThermalExpansivity") * (temperature - self.number(component["ReferenceTemperature"]))
+            if "Pressure" in component:
+                change += evaluate("Compressibility") * (evaluate("Pressure") - evaluate("ReferencePressure", 0.0))
+            if ppc_type == "Ppc_LinearDensityMelt":
+                change -= evaluate("MeltFraction") * evaluate("MeltDensityChange")
+            return evaluate("ReferenceDensity") * (1 + change)
+
+        if ppc_type == "Ppc_Melt_Polynomial":
+            # T = term0 + term1*p + term2*p^2 + term3*p^3
+            melt_pressure = evaluate("Pressure")
+            return sum(evaluate("term{0}".format(power), 0.0) * melt_pressure ** power for power in range(4))
+
+        if ppc_type in ("Ppc_PartialMelt", "Ppc_PartialMelt_Limited"):
+            # McKenzie and Bickle, 1988, optionally limited to a maximum melt fraction.
+            solidus = evaluate("SolidusTag")
+            liquidus = evaluate("LiquidusTag")
+            melt_temperature = evaluate("TemperatureTag")
+            supersolidus = (melt_temperature - solidus) / (liquidus - solidus) - 0.5
+            fraction = 0.5 + supersolidus + (supersolidus ** 2 - 0.25) * (0.4256 + 2.988 * supersolidus)
+            fraction = np.where(melt_temperature < solidus, 0.0, np.where(melt_temperature > liquidus, 1.0, fraction))
+            if "MeltLimitTag" in component:
+                fraction = np.minimum(fraction, evaluate("MeltLimitTag"))
+            return np.clip(fraction, 0.0, 1.0)
+
+        if ppc_type == "Ppc_MeltHeating":
+            return np.zeros(temperature.shape)  # The melt fraction doesn't change in a steady state.
+
+        if ppc_type == "Ppc_a_Vector":
+            # Only the vertical component matters in 1D.
+            return evaluate("Alpha") * self.number(component.get("vj", Param("0", "")))
+
+        raise ModelError("'{0}' is a {1}, which can't be evaluated here".format(name, ppc_type))
+
+
+def points_shape(x, y, z):
+    """
+    The shape of the points x, y and z (None in 2D) broadcast together.
+    """
+    return np.broadcast(*[values for values in (x, y, z) if values is not None]).shape
+
+
+def solve_tridiagonal(lower, diagonal, upper, rhs):
+    """
+    Solve a tridiagonal system (lower[0] and upper[-1] are unused).
+    """
+    count = len(diagonal)
+    upper_prime = np.zeros(count)
+    rhs_prime = np.zeros(count)
+    upper_prime[0] = upper[0] / diagonal[0]
+    rhs_prime[0] = rhs[0] / diagonal[0]
+    for row in range(1, count):
+        pivot = diagonal[row] - lower[row] * upper_prime[row - 1]
+        upper_prime[row] = upper[row] / pivot
+        rhs_prime[row] = (rhs[row] - lower[row] * rhs_prime[row - 1]) / pivot
+    solution = np.zeros(count)
+    solution[-1] = rhs_prime[-1]
+    for row in range(count - 2, -1, -1):
+        solution[row] = rhs_prime[row] - upper_prime[row] * solution[row + 1]
+    return solution
+
+
+def boundary_conditions(column, y_nodes, columns_x, columns_z):
+    """
+    Fixed temperatures (node index: K) and heat fluxes into the model ("bottom"
+    or "top": the name of the flux function) from temperatureBCs and any
+    surface flux terms.
+    """
+    fixed = {}
+    bcs = column.params.get("temperatureBCs")
+    for vc in (bcs.get("vcList", []) if isinstance(bcs, dict) else []):
+        if not isinstance(vc, dict):
+            continue
+        temperatures = [variable for variable in vc.get("variables", [])
+                        if isinstance(variable, dict) and Column.text(variable, "name") == "temperature"]
+        if not temperatures:
+            continue
+        if Column.text(temperatures[0], "type") != "double":
+            raise GeothermError("A temperature boundary condition isn't a fixed value")
+        value = column.number(temperatures[0]["value"])
+        vc_type = Column.text(vc, "type")
+        if vc_type == "WallVC":
+            wall = Column.text(vc, "wall")
+            if wall == "bottom":
+                fixed[0] = value
+            elif wall == "top":
+                fixed[len(y_nodes) - 1] = value
+            else:
+                raise GeothermError("There is a fixed temperature on the {0} wall, so the model isn't 1D".format(wall))
+        elif vc_type == "MeshShapeVC":
+            shape = Column.text(vc, "Shape")
+            masks = [column.inside(shape, x, y_nodes, z) for x in columns_x for z in columns_z]
+            if any(np.any(mask != masks[0]) for mask in masks):
+                raise GeothermError("The fixed temperature shape '{0}' doesn't span the whole model".format(shape))
+            for node in np.nonzero(masks[0])[0]:
+                fixed[int(node)] = value
+        else:
+            raise GeothermError("Unable to handle a {0} temperature boundary condition".format(vc_type))
+
+    fluxes = {}
+    for name, component in column.components.items():
+        if isinstance(component, dict) and Column.text(component, "Type") == "VectorSurfaceAssemblyTerm_NA__Fi__ni" \
+                and Column.text(component, "ForceVector") == "residual":
+            surface = Column.text(component, "Surface")
+            if surface not in ("bottom", "top"):
+                raise GeothermError("There is a heat flux through the {0} wall, so the model isn't 1D".format(surface))
+            fluxes[surface] = Column.text(component, "functionLabel")
+
+    if not fixed:
+        raise GeothermError("No fixed temperatures found in temperatureBCs")
+    return fixed, fluxes
+
+
+def solve(xml_files, resolution, dims, tolerance=1e-6, max_iterations=100):
+    """
+    Solve for the steady-state geotherm of the model described by xml_files,
+    on the mesh Underworld would use for the thermal model (resolution is a
+    dict of x, y, z element counts). Returns a dict of the solution and the
+    things needed to write it out.
+    """
+    if np is None:
+        raise GeothermError("The 1D solver requires numpy")
+    started = time.time()
+    column = Column(load_stgermain(xml_files))
+    if not column.materials:
+        raise GeothermError("No materials (RheologyMaterial) found in the XMLs")
+
+    min_x, max_x = column.domain("X")
+    min_y, max_y = column.domain("Y")
+    min_z, max_z = column.domain("Z") if dims == 3 else (None, None)
+    y_nodes = np.linspace(min_y, max_y, resolution["y"] + 1)
+    spacing = y_nodes[1] - y_nodes[0]
+    # Sample points within each element, to average the properties over.
+    offsets = (np.arange(SAMPLES_PER_ELEMENT) + 0.5) / SAMPLES_PER_ELEMENT
+    y_samples = (y_nodes[:-1, None] + spacing * offsets[None, :]).ravel()
+
+    # It's only 1D if every column through the model has the same layers. Materials that only differ
+    # in ways that don't matter here, like the passive marker stripes, count as the same.
+    columns_x = np.linspace(min_x, max_x, resolution["x"] + 1)
+    columns_z = np.linspace(min_z, max_z, resolution["z"] + 1) if dims == 3 else [None]
+    material = column.material_index(columns_x[0], y_samples, columns_z[0])
+    for x in columns_x:
+        for z in columns_z:
+            other = column.material_index(x, y_samples, z)
+            different = [index for index in np.nonzero(other != material)[0]
+                         if not column.thermally_identical(material[index], other[index])]
+            if different:
+                where = different[0]
+                raise GeothermError("The model isn't laterally homogeneous: at y = {0:.6g} m there is {1} at "
+                                    "x = {2:.6g} m, but {3} at x = {4:.6g} m".format(
+                                        y_samples[where], column.materials[material[where]][0], columns_x[0],
+                                        column.materials[other[where]][0], x))
+
+    fixed, fluxes = boundary_conditions(column, y_nodes, columns_x, columns_z)
+    fixed_nodes = np.array(sorted(fixed))
+    fixed_values = np.array([fixed[node] for node in fixed_nodes])
+    free = np.ones(len(y_nodes), dtype=bool)
+    free[fixed_nodes] = False
+
+    temperature = np.interp(y_nodes, y_nodes[fixed_nodes], fixed_values)
+    for iteration in range(1, max_iterations + 1):
+        sample_temperature = np.interp(y_samples, y_nodes, temperature)
+        diffusivity = column.evaluate("DiffusivityProperty", sample_temperature, material)
+        source = column.evaluate("sourceTerms_thermalEqn", sample_temperature, material)
+        if np.any(diffusivity <= 0):
+            raise GeothermError("Some materials have a diffusivity of zero or less")
+
+        element_diffusivity = 1.0 / np.mean((1.0 / diffusivity).reshape(-1, SAMPLES_PER_ELEMENT), axis=1)
+        element_source = np.mean(source.reshape(-1, SAMPLES_PER_ELEMENT), axis=1)
+        conductance = element_diffusivity / spacing
+
+        lower = np.zeros(len(y_nodes))
+        upper = np.zeros(len(y_nodes))
+        lower[1:] = conductance
+        upper[:-1] = conductance
+        diagonal = -(lower + upper)
+        rhs = np.zeros(len(y_nodes))
+        rhs[1:] -= element_source * spacing / 2
+        rhs[:-1] -= element_source * spacing / 2
+        for surface, function in fluxes.items():
+            node, sample = (0, 0) if surface == "bottom" else (-1, -1)
+            rhs[node] -= column.evaluate(function, sample_temperature[[sample]], material[[sample]])[0]
+
+        # Fixed temperatures are rows of the identity.
+        lower[~free], upper[~free], diagonal[~free] = 0.0, 0.0, 1.0
+        rhs[~free] = fixed_values
+        new_temperature = solve_tridiagonal(lower, diagonal, upper, rhs)
+
+        change = np.max(np.abs(new_temperature - temperature))
+        temperature = new_temperature
+        if change < tolerance:
+            break
+    else:
+        raise GeothermError("The geotherm didn't converge in {0} iterations (last change {1:.3g} K)".format(
+            max_iterations, change))
+
+    # Heat flow at the surface of the rock (the top of the highest free node), for a sanity check.
+    top_free = np.nonzero(free)[0][-1]
+    sample_temperature = np.interp(y_samples, y_nodes, temperature)
+    conductivity = (column.evaluate("DiffusivityProperty", sample_temperature, material) *
+                    column.evaluate("DensityProperty", sample_temperature, material) *
+                    column.evaluate("CpProperty", sample_temperature, material))
+    surface_heat_flow = (np.mean(conductivity.reshape(-1, SAMPLES_PER_ELEMENT), axis=1)[min(top_free, len(y_nodes) - 2)] *
+                         (temperature[top_free] - temperature[top_free + 1]) / spacing
+                         if top_free < len(y_nodes) - 1 else float("nan"))
+
+    scaling = [struct for struct in column.components.values()
+               if isinstance(struct, dict) and Column.text(struct, "Type") == "Scaling"]
+    space_scale = float(Column.text(scaling[0], "spaceCoefficient_meters", 1.0)) if scaling else 1.0
+    temperature_scale = float(Column.text(scaling[0], "temperatureCoefficient_kelvin", 1.0)) if scaling else 1.0
+
+    node_material = column.material_index(columns_x[0], y_nodes, columns_z[0])
+    return {"y": y_nodes, "temperature": temperature, "iterations": iteration,
+            "materials": [column.materials[number][0] for number in node_material],
+            "surface_heat_flow": surface_heat_flow,
+            "resolution": resolution, "dims": dims,
+            "x_range": (min_x, max_x), "z_range": (min_z, max_z),
+            "space_scale": space_scale, "temperature_scale": temperature_scale,
+            "seconds": time.time() - started}
+
+
+# === Writing the result ======================================================
+
+def write_h5(filename, datasets, resolution):
+    # Written under a temporary name, so it is never half written, and doesn't write through hard links.
+    with h5py.File(filename + ".partial", "w") as h5file:
+        h5file.attrs["dimensions"] = len(resolution)
+        h5file.attrs["mesh resolution"] = np.array(resolution, dtype=np.int32)
+        for name, data in datasets.items():
+            h5file.create_dataset(name, data=data)
+    os.rename(filename + ".partial", filename)
+
+
+def write_initial_condition(output_path, geotherm, model_time):
+    """
+    Write the geotherm as timestep 0 of a thermal equilibration run in
+    output_path, on the full thermal mesh. model_time (seconds) is given to
+    it in FrequentOutput.dat: a steady state is where the run would end up.
+    """
+    if h5py is None:
+        raise GeothermError("Writing the geotherm requires h5py")
+    dims = geotherm["dims"]
+    res = geotherm["resolution"]
+    resolution = [res["x"], res["y"]] + ([res["z"]] if dims == 3 else [])
+    space, kelvin = geotherm["space_scale"], geotherm["temperature_scale"]
+
+    xs = np.linspace(geotherm["x_range"][0], geotherm["x_range"][1], res["x"] + 1) / space
+    ys = geotherm["y"] / space
+    temperature = geotherm["temperature"] / kelvin
+    if dims == 2:
+        grid_y, grid_x = np.meshgrid(ys, xs, indexing="ij")
+        vertices = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+        node_temperature = np.repeat(temperature, len(xs))
+    else:
+        zs = np.linspace(geotherm["z_range"][0], geotherm["z_range"][1], res["z"] + 1) / space
+        grid_z, grid_y, grid_x = np.meshgrid(zs, ys, xs, indexing="ij")
+        vertices = np.column_stack([grid_x.ravel(), grid_y.ravel(), grid_z.ravel()])
+        node_temperature = np.tile(np.repeat(temperature, len(xs)), len(zs))
+    node_count = len(vertices)
+    element_count = int(np.prod(resolution))
+
+    # Q1 elements, nodes in the same x fastest order as the vertices.
+    node_index = np.arange(node_count).reshape(tuple(n + 1 for n in reversed(resolution)))
+    if dims == 2:
+        corners = [node_index[:-1, :-1], node_index[:-1, 1:], node_index[1:, :-1], node_index[1:, 1:]]
+    else:
+        corners = [node_index[k:k + res["z"], j:j + res["y"], i:i + res["x"]]
+                   for k in (0, 1) for j in (0, 1) for i in (0, 1)]
+    connectivity = np.column_stack([corner.ravel() for corner in corners]).astype(np.int32)
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    write_h5(os.path.join(output_path, "Mesh.linearMesh.00000.h5"),
+             {"vertices": vertices, "connectivity": connectivity,
+              "min": vertices.min(axis=0), "max": vertices.max(axis=0)}, resolution)
+    write_h5(os.path.join(output_path, "TemperatureField.00000.h5"),
+             {"data": node_temperature.reshape(-1, 1)}, resolution)
+    write_h5(os.path.join(output_path, "TemperatureField-phiDotField.00000.h5"),
+             {"data": np.zeros((node_count, 1))}, resolution)
+    write_h5(os.path.join(output_path, "VelocityField.00000.h5"),
+             {"data": np.zeros((node_count, dims))}, resolution)
+    write_h5(os.path.join(output_path, "PressureField.00000.h5"),
+             {"data": np.zeros((element_count, 1))}, resolution)
+
+    grid_dims = " ".join(str(n + 1) for n in reversed(resolution))
+    with open(os.path.join(output_path, "XDMF.00000.xmf"), "w") as xmf:
+        xmf.write('<?xml version="1.0" ?>\n'
+                  '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">\n'
+                  '<Domain>\n'
+                  '<Grid Name="FEM_Mesh_linearMesh" GridType="Uniform">\n'
+                  '\t<Time Value="0" />\n'
+                  '\t<Topology Type="{0}DSMesh" NumberOfElements="{1}"/>\n'
+                  '\t<Geometry Type="{2}">\n'
+                  '\t\t<DataItem Format="HDF" NumberType="Float" Precision="8" Dimensions="{3} {0}">'
+                  'Mesh.linearMesh.00000.h5:/vertices</DataItem>\n'
+                  '\t</Geometry>\n'
+                  '\t<Attribute Type="Scalar" Center="Node" Name="TemperatureField">\n'
+                  '\t\t<DataItem Format="HDF" NumberType="Float" Precision="8" Dimensions="{3} 1">'
+                  'TemperatureField.00000.h5:/data</DataItem>\n'
+                  '\t</Attribute>\n'
+                  '</Grid>\n'
+                  '</Domain>\n'
+                  '</Xdmf>\n'.format(dims, grid_dims, "XYZ" if dims == 3 else "XY", node_count))
+    with open(os.path.join(output_path, "XDMF.FilesField.xdmf"), "w") as files_field:
+        files_field.write('<?xml version="1.0" ?>\n'
+                          '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">\n'
+                          '<Grid GridType="Collection" CollectionType="Temporal" Name="FEM_Mesh_Fields">\n'
+                          '\t<xi:include href="XDMF.00000.xmf" xpointer="xpointer(//Xdmf/Domain/Grid[1])"/>\n'
+                          '</Grid>\n</Xdmf>\n')
+
+    with open(os.path.join(output_path, "FrequentOutput.dat"), "w") as freq:
+        freq.write("#       Timestep            Time        CPU_Time            Vrms\n")
+        freq.write("{0:16d}{1:16.6e}{2:16.6e}{3:16.6e}\n".format(0, model_time, geotherm["seconds"], 0.0))
+
+    with open(os.path.join(output_path, "geotherm_1d.txt"), "w") as profile:
+        profile.write("# Steady-state 1D geotherm. Surface heat flow {0:.2f} mW/m^2\n"
+                      "#        y (m)  temperature (K)  material\n".format(geotherm["surface_heat_flow"] * 1e3))
+        for y, temperature, material in zip(geotherm["y"], geotherm["temperature"], geotherm["materials"]):
+            profile.write("{0:14.1f} {1:16.3f}  {2}\n".format(y, temperature, material))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve the steady-state 1D geotherm of an LMR model.")
+    parser.add_argument("xml_files", nargs="*", default=["lmrMain.xml", "lmrThermalEquilibration.xml"],
+                        help="The XMLs Underworld would be given. Default lmrMain.xml lmrThermalEquilibration.xml.")
+    parser.add_argument("--resolution", type=int, default=48,
+                        help="Number of elements vertically. Default 48.")
+    args = parser.parse_args()
+
+    try:
+        geotherm = solve(args.xml_files, {"x": 1, "y": args.resolution, "z": 0}, 2)
+    except ModelError as err:
+        sys.exit("ERROR - {0}".format(err))
+
+    print("Converged in {0} iteration(s). Surface heat flow {1:.2f} mW/m^2".format(
+        geotherm["iterations"], geotherm["surface_heat_flow"] * 1e3))
+    print("       y (km)  temperature (C)  material")
+    for y, temperature, material in reversed(list(zip(geotherm["y"], geotherm["temperature"], geotherm["materials"]))):
+        print("{0:13.2f} {1:16.1f}  {2}".format(y / 1e3, temperature - 273.15, material))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+==================
+ Checkpoint hooks
+==================
+
+Post-processing that lmrRunModel.py runs on each checkpoint as soon as it is
+complete, while Underworld carries on with the model, so the results are
+ready shortly after the run ends rather than days later (see
+<checkpoint_hooks> in lmrStart.xml).
+
+A hook is a function hook(output_path, timestep), called once for each
+checkpoint, in a worker process. It is named either as one of the built-in
+hooks below, or as module:function, where the module can be imported from
+the model folder (or the scripts folder), e.g. my_analysis:surface_heat_flow.
+
+The built-in hooks:
+    xdmf        Rewrites XDMF.CleanTemporalFields.xmf to list every finished
+                checkpoint in order (as scripts/xdmf_generator.py does), so
+                ParaView can open the run while it is going, and after it
+                has been restarted.
+    statistics  Appends the minimum, maximum and mean of each component of
+                each field to checkpoint_statistics.jsonl.
+    pyramid     Coarsened copies of the fields for quick remote viewing, as
+                scripts/field_pyramids.py makes them.
+    diagnostics Appends the topography, Moho and LAB depth, rift width, strain
+                localisation and melt volume to diagnostics.jsonl, as
+                scripts/diagnostics.py measures them (with its defaults).
+
+The workers run at the lowest priority, and lmrRunModel.py only gives them
+a checkpoint while there are idle cores, so they never slow Underworld down.
+Whatever is left when Underworld finishes is done on every core.
+
+What each hook did (and how long it took, or why it failed) is recorded in
+checkpoint_hooks.jsonl in the result folder. Hooks that have succeeded on a
+checkpoint aren't run on it again when the model is restarted.
+"""
+
+import glob
+import importlib
+import json
+import os
+import re
+import sys
+import time
+import traceback
+
+try:
+    import numpy as np
+    import h5py
+except ImportError:
+    np = None
+    h5py = None
+
+LMR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# How field_pyramids.py is run by the pyramid hook.
+PYRAMID_FACTORS = [2, 4, 8]
+
+# Set in the worker processes by lower_priority().
+_started = None
+
+
+def lower_priority(started=None):
+    """
+    Run at the lowest priority. The initializer of the worker processes.
+    If started (a multiprocessing SimpleQueue) is given, run() puts
+    (name, timestep, pid) on it as each hook starts, so the parent can tell
+    when the worker running a hook has died.
+    """
+    global _started
+    _started = started
+    try:
+        os.nice(19)
+    except (AttributeError, OSError):
+        pass
+    # Anything a hook prints shouldn't go into lmrRunModel.py's log, which belongs to the parent process.
+    sys.stdout = sys.__stdout__
+    for path in (os.getcwd(), os.path.join(LMR_DIR, "scripts")):
+        if path not in sys.path:
+            sys.path.append(path)
+
+
+def find_hook(name):
+    """
+    The function a hook name refers to.
+    """
+    if ":" not in name:
+        if name not in BUILT_IN:
+            raise ValueError("There is no built-in checkpoint hook called '{0}' (there are: {1}). Hooks of your own "
+                             "are written as module:function.".format(name, ", ".join(sorted(BUILT_IN))))
+        return BUILT_IN[name]
+    module, function = name.split(":", 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def run(name, output_path, timestep):
+    """
+    Run one hook on one checkpoint. Returns the record for
+    checkpoint_hooks.jsonl; a hook that fails doesn't stop the others.
+    """
+    if _started is not None:
+        _started.put((name, timestep, os.getpid()))
+    started = time.time()
+    record = {"hook": name, "timestep": timestep}
+    try:
+        find_hook(name)(output_path, timestep)
+        record["status"] = "ok"
+    except BaseException:
+        # Including sys.exit (e.g. a script's check for h5py), which would otherwise take the worker with it.
+        record["status"] = "failed"
+        record["error"] = traceback.format_exc().strip().split("\n")[-1]
+    record["seconds"] = round(time.time() - started, 3)
+    return record
+
+
+def step_files(output_path, timestep):
+    return sorted(filename for filename in glob.glob(os.path.join(output_path, "*.{0:05d}.h5".format(timestep)))
+                  if not os.path.basename(filename).startswith("Mesh."))
+
+
+def xdmf(output_path, timestep):
+    """
+    List the checkpoints up to this one in XDMF.CleanTemporalFields.xmf.
+    """
+    files = [filename for pattern in ("XDMF.[0-9]*.xmf", "XDMF.Fields.*.xmf")
+             for filename in glob.glob(os.path.join(output_path, pattern))]
+    steps = sorted((int(os.path.basename(filename).split(".")[-2]), os.path.basename(filename)) for filename in files
+                   if os.path.basename(filename).split(".")[-2].isdigit())
+    filename = os.path.join(output_path, "XDMF.CleanTemporalFields.xmf")
+    try:
+        # Hooks on later checkpoints may have finished first.
+        with open(filename) as current:
+            listed = set(re.findall(r'href="([^"]+)"', current.read()))
+    except IOError:
+        listed = set()
+    # Hooks on different checkpoints may be writing it at the same time, so each writes its own and renames it.
+    partial = "{0}.{1}.partial".format(filename, os.getpid())
+    with open(partial, "w") as xmf:
+        xmf.write('<?xml version="1.0" ?>\n'
+                  '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">\n'
+                  '<Grid GridType="Collection" CollectionType="Temporal" Name="FEM_Mesh_Fields">\n')
+        for step, name in steps:
+            # Later checkpoints may not be finished yet.
+            if step <= timestep or name in listed:
+                xmf.write('\t<xi:include href="{0}" xpointer="xpointer(//Xdmf/Domain/Grid[1])"/>\n'.format(name))
+        xmf.write("</Grid>\n</Xdmf>\n")
+    os.rename(partial, filename)
+
+
+def statistics(output_path, timestep):
+    """
+    Record the minimum, maximum and mean of each component of each field.
+    """
+    if h5py is None:
+        raise ImportError("The statistics hook requires numpy and h5py")
+    record = {"timestep": timestep, "fields": {}}
+    for filename in step_files(output_path, timestep):
+        field = ".".join(os.path.basename(filename).split(".")[:-2])
+        if field == "materialSwarm":
+            continue  # Particles, not a mesh field.
+        with h5py.File(filename, "r") as h5file:
+            if "data" not in h5file:
+                continue
+            data = h5file["data"][...]
+        data = np.reshape(data, (data.shape[0], -1))
+        record["fields"][field] = {"min": data.min(axis=0).tolist(), "max": data.max(axis=0).tolist(),
+                                   "mean": data.mean(axis=0).tolist()}
+    # A single write of one line, so lines from hooks running at the same time don't get mixed up.
+    with open(os.path.join(output_path, "checkpoint_statistics.jsonl"), "a") as stats:
+        stats.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def pyramid(output_path, timestep):
+    """
+    Build the coarsened copies of this checkpoint, as field_pyramids.py does.
+    """
+    import field_pyramids
+    pyramid_dir = os.path.join(output_path, "pyramid")
+    if not os.path.isdir(pyramid_dir):
+        try:
+            os.makedirs(pyramid_dir)
+        except OSError:
+            pass  # Made by a hook on another checkpoint in the meantime.
+    field_pyramids.build_pyramid((output_path, timestep, PYRAMID_FACTORS))
+    for factor in PYRAMID_FACTORS:
+        field_pyramids.write_temporal_xdmf(output_path, factor)
+
+
+def diagnostics(output_path, timestep):
+    """
+    Measure this checkpoint, as diagnostics.py does.
+    """
+    import diagnostics as measure
+    measure.append(output_path, measure.diagnose(output_path, timestep))
+
+
+BUILT_IN = {"xdmf": xdmf, "statistics": statistics, "pyramid": pyramid, "diagnostics": diagnostics}
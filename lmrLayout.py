@@ -0,0 +1,271 @@
+"""
+=================
+ Material layout
+=================
+
+Rasterizes the material layout of a model (the shapes of lmrMaterials.xml,
+with their unions and intersections, and the materials that use them) onto
+the model's elements, so mistakes in the geometry show up before a model is
+queued rather than hours into a run.
+
+The material of each element is the material at its centre, with later
+materials overprinting earlier ones as in Underworld. Shapes are evaluated on
+open grids (one array of coordinates per axis), so even large 3D models take
+a fraction of a second.
+
+The checks fail on:
+    - shapes that can't be found, or that are missing the shapes they join,
+    - boxes that are empty (a start at or past its end),
+    - elements that no material covers,
+and warn about boxes entirely outside the model, and materials that don't
+cover the centre of any element (thinner than an element, or completely
+overprinted by a later material with a different shape).
+
+The layout is written as MaterialLayout.h5 (the material index of each
+element, and the material names), MaterialLayout.xdmf (open it in ParaView)
+and MaterialLayout.png (a picture of the layout, the middle z slice in 3D).
+
+Used by lmrRunModel.py as part of the <preflight_check>, or run by itself
+(from a model folder) to check and draw the layout of the model lmrStart.xml
+describes:
+    python lmrLayout.py [lmrStart.xml] [--output_path layout] [--thermal]
+"""
+
+from __future__ import division
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from lmrGeotherm import Column, ModelError, load_stgermain, points_shape
+
+
+# Colours for the picture, one per material (repeating if there are more).
+PALETTE = [(166, 206, 227), (31, 120, 180), (178, 223, 138), (51, 160, 44), (251, 154, 153), (227, 26, 28),
+           (253, 191, 111), (255, 127, 0), (202, 178, 214), (106, 61, 154), (255, 255, 153), (177, 89, 40)]
+GAP_COLOUR = (0, 0, 0)
+
+
+def element_centres(column, resolution, dims):
+    """
+    The x, y and z (None in 2D) coordinates of the element centres, as open
+    grids in the (z, y, x) order of the fields Underworld writes.
+    """
+    centres = []
+    for axis in ("X", "Y", "Z")[:dims]:
+        low, high = column.domain(axis)
+        count = resolution[axis.lower()]
+        centres.append(low + (np.arange(count) + 0.5) * (high - low) / count)
+    grids = np.ix_(*reversed(centres))
+    return (grids[-1], grids[-2], grids[0] if dims == 3 else None)
+
+
+def box_problems(column, domain):
+    """
+    (problems, warnings) about the boxes in the XMLs: empty ones, and ones
+    that are entirely outside the model.
+    """
+    problems = []
+    warnings = []
+    for name, shape in column.components.items():
+        if not isinstance(shape, dict) or Column.text(shape, "Type", "").strip() != "Box":
+            continue
+        for axis, (low, high) in domain.items():
+            try:
+                start = column.number(shape["start" + axis]) if "start" + axis in shape else low
+                end = column.number(shape["end" + axis]) if "end" + axis in shape else high
+            except ModelError as err:
+                problems.append("The box '{0}': {1}".format(name, err))
+                break
+            if start >= end:
+                problems.append("The box '{0}' is empty: start{1} ({2:.6g} m) is not less than end{1} "
+                                "({3:.6g} m)".format(name, axis, start, end))
+                break
+            if end < low or start > high:
+                warnings.append("The box '{0}' is outside the model in {1} ({2:.6g} to {3:.6g} m, the model "
+                                "is {4:.6g} to {5:.6g} m)".format(name, axis, start, end, low, high))
+                break
+    return problems, warnings
+
+
+def rasterize(xml_files, resolution, dims):
+    """
+    The material index of each element of a model, and the checks of its
+    layout. Returns a dict with the index grid (shape (z,) y, x, -1 where
+    there is no material), the material names, and lists of problems and
+    warnings.
+    """
+    if np is None:
+        raise ModelError("Rasterizing the material layout requires numpy")
+    started = time.time()
+    column = Column(load_stgermain(xml_files))
+    if not column.materials:
+        raise ModelError("No materials (RheologyMaterial) found in the XMLs")
+    domain = dict((axis, column.domain(axis)) for axis in ("X", "Y", "Z")[:dims])
+
+    problems, warnings = box_problems(column, domain)
+    x, y, z = element_centres(column, resolution, dims)
+    index = np.full(points_shape(x, y, z), -1, dtype=np.int16)
+    unknown = set()
+    for number, (name, material) in enumerate(column.materials):
+        shape = Column.text(material, "Shape")
+        if not shape:
+            continue
+        try:
+            np.copyto(index, number, where=column.region(shape.strip(), x, y, z))
+        except ModelError as err:
+            problems.append("The material '{0}': {1}".format(name, err))
+            unknown.add(number)
+
+    gaps = index < 0
+    if np.any(gaps):
+        where = [values[0] for values in np.nonzero(gaps)]
+        centre = [np.broadcast_to(values, index.shape)[tuple(where)] for values in (x, y, z) if values is not None]
+        problems.append("{0} of the {1} elements have no material, e.g. the one centred at ({2}) m".format(
+            int(np.sum(gaps)), index.size, ", ".join("{0:.6g}".format(value) for value in centre)))
+    counts = np.bincount(index.ravel() + 1, minlength=len(column.materials) + 1)[1:]
+    shapes = [(Column.text(material, "Shape") or "").strip() for _, material in column.materials]
+    for number, name in enumerate([name for name, _ in column.materials]):
+        # A material given the same shape as a later one (like sediment) is overprinted on purpose.
+        if not counts[number] and shapes[number] and number not in unknown \
+                and shapes[number] not in shapes[number + 1:]:
+            warnings.append("The material '{0}' isn't in any element: its shape is thinner than an element, "
+                            "or completely overprinted by later materials".format(name))
+
+    return {"index": index, "materials": [name for name, _ in column.materials], "counts": counts,
+            "resolution": resolution, "dims": dims, "domain": domain,
+            "problems": problems, "warnings": warnings, "seconds": time.time() - started}
+
+
+def write_png(filename, rgb):
+    """
+    Write an (height, width, 3) uint8 array as a PNG, without needing an
+    imaging library.
+    """
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    height, width = rgb.shape[:2]
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)], axis=1)
+    with open(filename, "wb") as png:
+        png.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+                  chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def picture(layout, max_pixels=1600):
+    """
+    An RGB image of the layout (the middle z slice in 3D), top of the model
+    at the top, scaled up to make small models visible.
+    """
+    index = layout["index"]
+    if layout["dims"] == 3:
+        index = index[index.shape[0] // 2]
+    colours = np.array([PALETTE[number % len(PALETTE)] for number in range(len(layout["materials"]))] +
+                       [GAP_COLOUR], dtype=np.uint8)
+    image = colours[index][::-1]
+    scale = max(1, max_pixels // max(image.shape[:2]))
+    return image.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+def write_layout(output_path, layout):
+    """
+    Write MaterialLayout.h5, .xdmf and .png to output_path. The HDF5 and
+    XDMF need h5py; the picture is always written.
+    """
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    write_png(os.path.join(output_path, "MaterialLayout.png"), picture(layout))
+    if h5py is None:
+        return
+    index = layout["index"]
+    filename = os.path.join(output_path, "MaterialLayout.h5")
+    with h5py.File(filename + ".partial", "w") as h5file:
+        h5file.create_dataset("data", data=index, compression="gzip", compression_opts=1)
+        h5file.attrs["materials"] = np.array([name.encode("ascii") for name in layout["materials"]])
+    os.rename(filename + ".partial", filename)
+
+    # A regular grid ParaView can read with no mesh file: the nodes are the element corners. The
+    # origin and spacing are in the same slowest first (z, y, x) order as the data.
+    dims = layout["dims"]
+    axes = ("Z", "Y", "X")[3 - dims:]
+    lows = [layout["domain"][axis][0] for axis in axes]
+    spacings = [(layout["domain"][axis][1] - layout["domain"][axis][0]) / layout["resolution"][axis.lower()]
+                for axis in axes]
+    with open(os.path.join(output_path, "MaterialLayout.xdmf"), "w") as xdmf:
+        xdmf.write('<?xml version="1.0" ?>\n'
+                   '<Xdmf Version="2.0">\n'
+                   '<Domain>\n'
+                   '<Grid Name="MaterialLayout" GridType="Uniform">\n'
+                   '\t<Information Name="materials" Value="{0}"/>\n'
+                   '\t<Topology TopologyType="{1}DCoRectMesh" Dimensions="{2}"/>\n'
+                   '\t<Geometry GeometryType="ORIGIN_{3}">\n'
+                   '\t\t<DataItem Format="XML" NumberType="Float" Dimensions="{1}">{4}</DataItem>\n'
+                   '\t\t<DataItem Format="XML" NumberType="Float" Dimensions="{1}">{5}</DataItem>\n'
+                   '\t</Geometry>\n'
+                   '\t<Attribute Type="Scalar" Center="Cell" Name="MaterialIndex">\n'
+                   '\t\t<DataItem Format="HDF" NumberType="Int" Precision="2" Dimensions="{6}">'
+                   'MaterialLayout.h5:/data</DataItem>\n'
+                   '\t</Attribute>\n'
+                   '</Grid>\n'
+                   '</Domain>\n'
+                   '</Xdmf>\n'.format(" ".join("{0}={1}".format(number, name)
+                                               for number, name in enumerate(layout["materials"])),
+                                      dims, " ".join(str(count + 1) for count in index.shape),
+                                      "DXDYDZ"[:2 * dims], " ".join(repr(value) for value in lows),
+                                      " ".join(repr(value) for value in spacings),
+                                      " ".join(str(count) for count in index.shape)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and draw the material layout of an LMR model.")
+    parser.add_argument("start_xml", nargs="?", default="lmrStart.xml",
+                        help="The lmrStart.xml of the model. Default lmrStart.xml.")
+    parser.add_argument("--output_path", default="layout",
+                        help="Where to write the layout files. Default layout.")
+    parser.add_argument("--thermal", action="store_true",
+                        help="Use the thermal equilibration resolution rather than the model resolution.")
+    args = parser.parse_args()
+
+    import lmrRunModel
+    # Only the resolution is needed, so not lmrRunModel.process_xml(), which also checks for Underworld.
+    raw_dict = lmrRunModel.load_xml(args.start_xml)
+    model_resolution = raw_dict["Output_Controls"]["model_resolution"]
+    if args.thermal:
+        model_resolution = raw_dict["Thermal_Equilibration"]["output_controls"]["thermal_model_resolution"]
+    resolution = dict((dim, int(value)) for dim, value in model_resolution.items())
+    dims = 3 if int(raw_dict["Output_Controls"]["model_resolution"].get("z", 0)) > 0 else 2
+    xmls_dir = os.path.dirname(os.path.abspath(args.start_xml))
+    xml_files = [os.path.join(xmls_dir, "lmrMain.xml")]
+    if args.thermal:
+        xml_files.append(os.path.join(xmls_dir, "lmrThermalEquilibration.xml"))
+    try:
+        layout = rasterize(xml_files, resolution, dims)
+    except ModelError as err:
+        sys.exit("ERROR - {0}".format(err))
+
+    print("Rasterized {0} elements in {1:.3f} seconds".format(layout["index"].size, layout["seconds"]))
+    for name, count in zip(layout["materials"], layout["counts"]):
+        print("    {0:<30} {1:>10d} elements".format(name, count))
+    for warning in layout["warnings"]:
+        print("WARNING - {0}".format(warning))
+    for problem in layout["problems"]:
+        print("ERROR - {0}".format(problem))
+    write_layout(args.output_path, layout)
+    print("Written to {0}".format(args.output_path))
+    return 1 if layout["problems"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,444 @@
+"""
+===========================
+ Rheologies and strength
+===========================
+
+Evaluates the rheologies of lmrRheologyLibrary.xml, as they are assigned to
+the materials in lmrMaterials.xml, without running Underworld: viscosity,
+yield stress, density and strength as NumPy arrays over any grid of
+temperature, pressure and strain rate (the arrays are broadcast together),
+and yield-strength envelopes along a geotherm.
+
+A material's Rheology list is applied in order, as Underworld does:
+    - viscous laws (MaterialViscosity, FrankKamenetskii, HKViscousCreep,
+      ViscousCreep) set the viscosity,
+    - MeltViscosity reduces it with the material's melt fraction,
+    - yield laws (DruckerPrager, VonMises) and stress limiters
+      (SimpleStressLimiter, vanHunenStressLimiter) cap it at the viscosity
+      that gives their yield stress at that strain rate,
+    - ViscosityLimiter clips it to its range.
+The strength is then the stress 2 * viscosity * strain rate.
+
+Densities are the materials' DensityProperty (densTemp_*, densMelt_*, ...),
+and melt fractions their MeltFractionProperty, evaluated the same way as
+lmrGeotherm.py does for the thermal properties.
+
+The envelope follows a geotherm (the 1D steady-state solution from
+lmrGeotherm.py by default, or a geotherm_1d.txt) down a column of the model,
+with the lithostatic pressure from the densities along it, and integrates
+the strength over depth, in total and per material.
+
+Screening compares the integrated strength of a column with different laws
+substituted for one of a material's rheologies, e.g. every viscous law in
+the library for the lower crust. Library entries that can't be read (like a
+mistyped number) are reported rather than guessed.
+
+Run by (from a model folder):
+    python lmrRheology.py envelope [--strain_rate 1e-15] [--geotherm geotherm_1d.txt]
+    python lmrRheology.py screen lowercrust "viscSRT*" [--strain_rate 1e-15]
+
+or used from Python:
+    import lmrRheology
+    rheology = lmrRheology.Rheology(["lmrMain.xml"])
+    rheology.viscosity("mantle", temperature, pressure, strain_rate)
+"""
+
+from __future__ import division
+import argparse
+import fnmatch
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from lmrGeotherm import GAS_CONSTANT, Column, ModelError, Param, load_stgermain
+import lmrGeotherm
+
+
+VISCOUS_LAWS = ("MaterialViscosity", "FrankKamenetskii", "HKViscousCreep", "ViscousCreep")
+MELT_LAWS = ("MeltViscosity",)
+YIELD_LAWS = ("DruckerPrager", "VonMises", "SimpleStressLimiter", "vanHunenStressLimiter")
+LIMITER_LAWS = ("ViscosityLimiter",)
+RHEOLOGY_TYPES = VISCOUS_LAWS + MELT_LAWS + YIELD_LAWS + LIMITER_LAWS
+
+
+class Rheology(object):
+    """
+    The materials and rheologies of a model, from the XMLs Underworld would
+    be given (lmrMain.xml includes the rest).
+    """
+    def __init__(self, xml_files):
+        if np is None:
+            raise ModelError("Evaluating rheologies requires numpy")
+        self.column = Column(load_stgermain(xml_files))
+        if not self.column.materials:
+            raise ModelError("No materials (RheologyMaterial) found in the XMLs")
+        self.material_names = [name for name, _ in self.column.materials]
+
+    def material_number(self, material):
+        try:
+            return self.material_names.index(material)
+        except ValueError:
+            raise ModelError("There is no material '{0}'".format(material))
+
+    def laws(self, material, substitutes=None):
+        """
+        The names of a material's rheologies, in order, with any in
+        substitutes (a dict of old name to new name) swapped.
+        """
+        struct = self.column.materials[self.material_number(material)][1]
+        names = [item.text.strip() for item in struct.get("Rheology", []) if isinstance(item, Param)]
+        return [(substitutes or {}).get(name, name) for name in names]
+
+    def law(self, name):
+        struct = self.column.components.get(name)
+        if not isinstance(struct, dict):
+            raise ModelError("Unable to find the rheology '{0}'".format(name))
+        law_type = Column.text(struct, "Type", "").strip()
+        if law_type not in RHEOLOGY_TYPES and law_type != "StrainWeakening":
+            raise ModelError("'{0}' is a {1}, which isn't a rheology that can be evaluated here".format(
+                name, law_type))
+        return law_type, struct
+
+    def library(self, law_types=RHEOLOGY_TYPES):
+        """
+        The names of every rheology of these types.
+        """
+        return [name for name, struct in self.column.components.items()
+                if isinstance(struct, dict) and Column.text(struct, "Type", "").strip() in law_types]
+
+    def grid(self, material, *arrays):
+        """
+        The arrays broadcast together as floats, and the material number at
+        each point.
+        """
+        arrays = np.broadcast_arrays(*[np.asarray(array, dtype=float) for array in arrays])
+        return arrays + [np.full(arrays[0].shape, self.material_number(material), dtype=int)]
+
+    def number(self, struct, name, default=None):
+        if name not in struct:
+            if default is None:
+                raise ModelError("'{0}' is missing from a rheology".format(name))
+            return default
+        return self.column.number(struct[name])
+
+    def density(self, material, temperature, pressure):
+        temperature, pressure, numbers = self.grid(material, temperature, pressure)
+        return self.column.evaluate("DensityProperty", temperature, numbers, pressure=pressure)
+
+    def melt_fraction(self, material, temperature, pressure):
+        temperature, pressure, numbers = self.grid(material, temperature, pressure)
+        struct = self.column.materials[numbers.flat[0]][1] if numbers.size else {}
+        if "MeltFractionProperty" not in struct:
+            return np.zeros(temperature.shape)
+        return self.column.evaluate("MeltFractionProperty", temperature, numbers, pressure=pressure)
+
+    def viscous_law(self, law_type, struct, temperature, pressure, strain_rate):
+        """
+        The viscosity (Pa s) from a viscous creep law.
+        """
+        if law_type == "MaterialViscosity":
+            return np.full(temperature.shape, self.number(struct, "eta0"))
+
+        if law_type == "FrankKamenetskii":
+            return self.number(struct, "eta0") * np.exp(-self.number(struct, "theta") * temperature)
+
+        if law_type == "HKViscousCreep":
+            # eta = 0.5 * A^(-1/n) * eII^(1/n - 1) * d^(p/n) * fH2O^(-r/n) * exp((E + P*V) / (n*R*T))
+            n = self.number(struct, "StressExponent")
+            activation = (self.number(struct, "ActivationEnergy") +
+                          pressure * self.number(struct, "ActivationVolume", 0.0))
+            return (0.5 * self.number(struct, "PreExponentialFactor") ** (-1 / n) * strain_rate ** (1 / n - 1) *
+                    self.number(struct, "GrainSize", 1.0) ** (self.number(struct, "GrainSizeExponent", 0.0) / n) *
+                    self.number(struct, "WaterFugacity", 1.0) ** (-self.number(struct, "WaterFugacityExponent", 0.0) / n) *
+                    np.exp(activation / (n * GAS_CONSTANT * temperature)))
+
+        # ViscousCreep: diffusion and dislocation creep acting together, with strain rates
+        # A * (stress / G)^n * (b / d)^m * exp(-(E + P*V) / (R*T)).
+        shear_modulus = self.number(struct, "shear_modulus", 1.0)
+        grain_ratio = self.number(struct, "burgers_vector", 1.0) / self.number(struct, "GrainSize", 1.0)
+        inverse = np.zeros(temperature.shape)
+        for mechanism, default_n in (("diffusion", 1.0), ("dislocation", None)):
+            if not xml_bool(Column.text(struct, "enable_" + mechanism, "False")):
+                continue
+            n = self.number(struct, mechanism + "_stress_exponent", default_n)
+            rate = (self.number(struct, mechanism + "_material_constant") *
+                    grain_ratio ** self.number(struct, mechanism + "_grainsize_exponent", 0.0) *
+                    np.exp(-(self.number(struct, mechanism + "_activation_energy") +
+                             pressure * self.number(struct, mechanism + "_activation_volume", 0.0)) /
+                           (GAS_CONSTANT * temperature)))
+            stress = shear_modulus * (strain_rate / rate) ** (1 / n)
+            inverse += 2 * strain_rate / stress
+        if not np.any(inverse):
+            raise ModelError("Neither diffusion nor dislocation creep is enabled")
+        viscosity = 1 / inverse
+        if xml_bool(Column.text(struct, "enable_limit_eta", "False")):
+            viscosity = np.clip(viscosity, self.number(struct, "min_limit_eta"), self.number(struct, "max_limit_eta"))
+        return viscosity
+
+    def yield_law(self, law_type, struct, pressure, strain_rate, strain):
+        """
+        The yield stress (Pa) of a yield law or stress limiter.
+        """
+        if law_type == "DruckerPrager":
+            cohesion = self.number(struct, "cohesion")
+            friction = self.number(struct, "frictionCoefficient")
+            weakening = Column.text(struct, "StrainWeakening")
+            if weakening and weakening.strip() in self.column.components:
+                # Linear between the original and softened values, fully softened at softeningStrain.
+                softening = self.number(self.column.components[weakening.strip()], "softeningStrain")
+                fraction = np.clip(strain / softening, 0.0, 1.0)
+                cohesion = cohesion + fraction * (self.number(struct, "cohesionAfterSoftening", cohesion) - cohesion)
+                friction = friction + fraction * (
+                    self.number(struct, "frictionCoefficientAfterSoftening", friction) - friction)
+            return cohesion + friction * np.maximum(pressure, 0.0)
+
+        if law_type == "VonMises":
+            return np.full(pressure.shape, self.number(struct, "cohesion"))
+
+        if law_type == "SimpleStressLimiter":
+            return np.full(pressure.shape, self.number(struct, "maxYieldStress"))
+
+        # vanHunenStressLimiter: max viscosity = yieldStress * refSR^(-1/n) * eII^(1/n - 1)
+        n = self.number(struct, "powerlawIndex")
+        return 2 * self.number(struct, "yieldStress") * (strain_rate / self.number(struct, "referenceStrainRate")) ** (1 / n)
+
+    def viscosity(self, material, temperature, pressure, strain_rate, strain=0.0, substitutes=None):
+        """
+        The effective viscosity (Pa s) of a material, at temperatures (K),
+        pressures (Pa), strain rates (second invariant, 1/s) and accumulated
+        plastic strains.
+        """
+        return self.evaluate(material, temperature, pressure, strain_rate, strain, substitutes)[0]
+
+    def yield_stress(self, material, temperature, pressure, strain_rate, strain=0.0, substitutes=None):
+        """
+        The lowest yield stress (Pa) of a material's yield laws and stress
+        limiters (infinite if it has none).
+        """
+        return self.evaluate(material, temperature, pressure, strain_rate, strain, substitutes)[1]
+
+    def strength(self, material, temperature, pressure, strain_rate, strain=0.0, substitutes=None):
+        """
+        The stress (Pa) needed to deform a material at the strain rate.
+        """
+        viscosity = self.viscosity(material, temperature, pressure, strain_rate, strain, substitutes)
+        return 2 * viscosity * np.broadcast_to(strain_rate, viscosity.shape)
+
+    def evaluate(self, material, temperature, pressure, strain_rate, strain=0.0, substitutes=None):
+        """
+        The effective viscosity and the yield stress of a material, at
+        every point of the temperature, pressure, strain rate and strain
+        arrays (broadcast together).
+        """
+        temperature, pressure, strain_rate, strain, numbers = self.grid(
+            material, temperature, pressure, strain_rate, strain)
+        viscosity = None
+        yield_stress = np.full(temperature.shape, np.inf)
+        for name in self.laws(material, substitutes):
+            law_type, struct = self.law(name)
+            if law_type in VISCOUS_LAWS:
+                viscosity = self.viscous_law(law_type, struct, temperature, pressure, strain_rate)
+                continue
+            if viscosity is None:
+                raise ModelError("The material '{0}' has a {1} ({2}) before any viscous law".format(
+                    material, law_type, name))
+            if law_type in MELT_LAWS:
+                melt = self.column.evaluate(struct["MeltFraction"].text, temperature, numbers, pressure=pressure)
+                lower = self.number(struct, "MeltFraction_LowerLimit")
+                upper = self.number(struct, "MeltFraction_UpperLimit")
+                aux = np.clip(1 + (melt - lower) / (lower - upper), 0.0, 1.0)
+                viscosity = viscosity * (aux + self.number(struct, "max_linear_decrease") * (1 - aux))
+            elif law_type in YIELD_LAWS:
+                stress = self.yield_law(law_type, struct, pressure, strain_rate, strain)
+                yield_stress = np.minimum(yield_stress, stress)
+                viscosity = np.minimum(viscosity, stress / (2 * strain_rate))
+                if law_type == "VonMises" and "minimumViscosity" in struct:
+                    viscosity = np.maximum(viscosity, self.number(struct, "minimumViscosity"))
+            elif law_type in LIMITER_LAWS:
+                viscosity = np.clip(viscosity, self.number(struct, "minViscosity"), self.number(struct, "maxViscosity"))
+        if viscosity is None:
+            raise ModelError("The material '{0}' has no viscous law".format(material))
+        return viscosity, yield_stress
+
+
+def xml_bool(text):
+    return text.strip().lower() in ("true", "1", "yes")
+
+
+# === Strength envelopes ======================================================
+
+def read_geotherm(filename):
+    """
+    y (m) and temperature (K) from a geotherm_1d.txt.
+    """
+    data = np.loadtxt(filename, usecols=(0, 1), ndmin=2)
+    order = np.argsort(data[:, 0])
+    return data[order, 0], data[order, 1]
+
+
+def lithostatic_pressure(rheology, materials, y, temperature, gravity, iterations=20):
+    """
+    The pressure (Pa) at each y from the weight of what's above it, with
+    pressure-dependent densities iterated to a fixed point.
+    """
+    pressure = np.zeros(len(y))
+    for _ in range(iterations):
+        density = np.empty(len(y))
+        for number in np.unique(materials):
+            mask = materials == number
+            density[mask] = rheology.density(rheology.material_names[number], temperature[mask], pressure[mask])
+        # Integrate from the top down (y is in increasing order).
+        weight = 0.5 * (density[1:] + density[:-1]) * gravity * np.diff(y)
+        new_pressure = np.concatenate([np.cumsum(weight[::-1])[::-1], [0.0]])
+        if np.allclose(new_pressure, pressure, rtol=1e-9, atol=1.0):
+            return new_pressure
+        pressure = new_pressure
+    return pressure
+
+
+def envelope(rheology, y, temperature, strain_rate, strain=0.0, x=None, z=None, substitutes=None):
+    """
+    The strength envelope down the column at x (and z): a dict of the
+    material, pressure, viscosity, yield stress and strength at each y, the
+    integrated strength (N/m, i.e. Pa m) and the same per material.
+    """
+    column = rheology.column
+    if x is None:
+        x = column.domain("X")[0]
+    materials = column.material_index(x, y, z)
+    pressure = lithostatic_pressure(rheology, materials, y, temperature,
+                                    column.number(column.params.get("gravity", Param("9.81", "m*s^-2"))))
+    viscosity = np.empty(len(y))
+    yield_stress = np.empty(len(y))
+    for number in np.unique(materials):
+        mask = materials == number
+        viscosity[mask], yield_stress[mask] = rheology.evaluate(
+            rheology.material_names[number], temperature[mask], pressure[mask], strain_rate, strain, substitutes)
+    strength = 2 * viscosity * strain_rate
+
+    # Trapezoidal integration, with each interval split between the materials at its ends.
+    interval = 0.5 * (strength[1:] + strength[:-1]) * np.diff(y)
+    layers = {}
+    for number in np.unique(materials):
+        share = 0.5 * ((materials[1:] == number).astype(float) + (materials[:-1] == number))
+        layers[rheology.material_names[number]] = float(np.sum(interval * share))
+    return {"y": y, "temperature": temperature, "pressure": pressure,
+            "materials": [rheology.material_names[number] for number in materials],
+            "viscosity": viscosity, "yield_stress": yield_stress, "strength": strength,
+            "integrated_strength": float(np.sum(interval)), "layer_strength": layers}
+
+
+def load_geotherm(rheology, args):
+    if args.geotherm:
+        return read_geotherm(args.geotherm)
+    geotherm = lmrGeotherm.solve(args.xml_files + [args.thermal_xml], {"x": 1, "y": args.resolution, "z": 0}, 2)
+    return geotherm["y"], geotherm["temperature"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the rheologies and strength of an LMR model.")
+    parser.add_argument("--xml_files", nargs="+", default=["lmrMain.xml"],
+                        help="The XMLs Underworld would be given. Default lmrMain.xml.")
+    parser.add_argument("--thermal_xml", default="lmrThermalEquilibration.xml",
+                        help="Added to the XMLs to solve the geotherm. Default lmrThermalEquilibration.xml.")
+    parser.add_argument("--geotherm",
+                        help="A geotherm_1d.txt to use, instead of solving for the 1D steady-state geotherm.")
+    parser.add_argument("--resolution", type=int, default=200,
+                        help="Number of points vertically, when solving for the geotherm. Default 200.")
+    parser.add_argument("--strain_rate", type=float, default=1e-15,
+                        help="Strain rate (second invariant, 1/s). Default 1e-15.")
+    parser.add_argument("--strain", type=float, default=0.0,
+                        help="Accumulated plastic strain, for strain weakening. Default 0.")
+    parser.add_argument("--x", type=float,
+                        help="Where the column is, in m. Default the left side of the model.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("envelope", help="Print the strength envelope down a column.")
+    screen = commands.add_parser("screen", help="Compare the strength with different laws for a material.")
+    screen.add_argument("material",
+                        help="The material to try the laws on, e.g. lowercrust.")
+    screen.add_argument("laws", nargs="+",
+                        help="Names (or patterns, like 'viscSRT*') of the rheologies to try.")
+    args = parser.parse_args()
+
+    try:
+        rheology = Rheology(args.xml_files)
+        y, temperature = load_geotherm(rheology, args)
+    except ModelError as err:
+        sys.exit("ERROR - {0}".format(err))
+    rheology_kwargs = {"strain_rate": args.strain_rate, "strain": args.strain, "x": args.x}
+
+    if args.command == "screen":
+        return screen_laws(rheology, y, temperature, args.material, args.laws, rheology_kwargs)
+
+    try:
+        result = envelope(rheology, y, temperature, **rheology_kwargs)
+    except ModelError as err:
+        sys.exit("ERROR - {0}".format(err))
+    print("       y (km)  T (C)  P (MPa)  viscosity (Pa s)  strength (MPa)  material")
+    for index in reversed(range(len(y))):
+        print("{0:13.2f} {1:6.0f} {2:8.1f} {3:17.3e} {4:15.2f}  {5}".format(
+            y[index] / 1e3, temperature[index] - 273.15, result["pressure"][index] / 1e6,
+            result["viscosity"][index], result["strength"][index] / 1e6, result["materials"][index]))
+    print("\nIntegrated strength {0:.4g} N/m".format(result["integrated_strength"]))
+    for name, value in sorted(result["layer_strength"].items(), key=lambda item: -item[1]):
+        print("    {0:<30} {1:.4g} N/m".format(name, value))
+    return 0
+
+
+def screen_laws(rheology, y, temperature, material, patterns, rheology_kwargs):
+    """
+    Print the integrated strength with each law substituted for the
+    material's rheology of the same kind. The law is swapped in every
+    material that uses it (e.g. lowercrust and lowercrustMarkers), so the
+    strength is of all of those in the column.
+    """
+    try:
+        current = rheology.laws(material)
+        kinds = dict((name, rheology.law(name)[0]) for name in current)
+        in_column = set(envelope(rheology, y, temperature, **rheology_kwargs)["materials"])
+    except ModelError as err:
+        sys.exit("ERROR - {0}".format(err))
+    candidates = [name for name in rheology.library() if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    if not candidates:
+        sys.exit("ERROR - None of the rheologies match {0}".format(" ".join(patterns)))
+
+    def sharing(law):
+        return sorted(name for name in rheology.material_names if law in rheology.laws(name))
+    shared = set(name for law in current for name in sharing(law))
+    if not shared & in_column:
+        sys.exit("ERROR - Neither {0} nor the materials that share its rheologies are in the column at x = {1:g} m, "
+                 "which has {2}. Choose another column with --x.".format(
+                     material, rheology_kwargs["x"] if rheology_kwargs["x"] is not None else rheology.column.domain("X")[0],
+                     ", ".join(sorted(in_column))))
+
+    print("{0:<55} {1:>14} {2:>14}  {3}".format("Rheology", "strength (N/m)", "total (N/m)", "materials"))
+    for candidate in candidates:
+        candidate_type = rheology.law(candidate)[0]
+        replaced = []
+        for group in (VISCOUS_LAWS, MELT_LAWS, YIELD_LAWS, LIMITER_LAWS):
+            if candidate_type in group:
+                replaced = [name for name in current if kinds[name] in group]
+        if candidate_type in YIELD_LAWS:
+            # A yield law replaces the yield law, a stress limiter the stress limiter.
+            replaced = [name for name in replaced if (kinds[name] in ("DruckerPrager", "VonMises")) ==
+                        (candidate_type in ("DruckerPrager", "VonMises"))]
+        if not replaced:
+            print("{0:<55} {1}".format(candidate, "(the material has no {0} to replace)".format(candidate_type)))
+            continue
+        try:
+            result = envelope(rheology, y, temperature, substitutes={replaced[0]: candidate}, **rheology_kwargs)
+        except ModelError as err:
+            print("{0:<55} unable to evaluate: {1}".format(candidate, err))
+            continue
+        materials = [name for name in sharing(replaced[0]) if name in in_column]
+        print("{0:<55} {1:14.4g} {2:14.4g}  {3}{4}".format(
+            candidate, sum(result["layer_strength"].get(name, 0.0) for name in materials), result["integrated_strength"],
+            " + ".join(materials) or "(none in the column)", "  (current)" if candidate in current else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
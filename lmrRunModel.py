@@ -7,6 +7,17 @@ import subprocess
 import fileinput
 import glob
 import copy
+import json
+import time
+import datetime
+import threading
+import math
+import multiprocessing
+import gzip
+import re
+import hashlib
+import socket
+from multiprocessing.queues import SimpleQueue
 
 # Python lXML - http://lxml.de/
 have_lxml = True
@@ -20,6 +31,24 @@ except ImportError:
            'http://lxml.de/, or from your package manager.')
     from xml.etree import cElementTree as ElementTree
 
+# The 1D steady-state solver for the thermal equilibration phase.
+import lmrGeotherm
+# Rasterizes the material layout, to check it before launching.
+import lmrLayout
+# Post-processing run on each checkpoint while Underworld is running.
+import lmrHooks
+# The helpers the scripts use to read checkpoints.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+import checkpoint_io
+from checkpoint_io import SECONDS_PER_YEAR
+
+# h5py is only used to check checkpoints can be read before restarting from them.
+have_h5py = True
+try:
+    import h5py
+except ImportError:
+    have_h5py = False
+
 
 def load_xml(input_xml='lmrStart.xml', xsd_location='LMR.xsd'):
     """
@@ -57,7 +86,8 @@ def load_xml(input_xml='lmrStart.xml', xsd_location='LMR.xsd'):
                 elif element.items():
                     self.update({element.tag: dict(element.items())})
                 else:
-                    self.update({element.tag: element.text.strip()})  # Line modified by LMondy to strip
+                    # Line modified by LMondy to strip. Empty elements (e.g. <health_monitor/>) are "".
+                    self.update({element.tag: (element.text or "").strip()})
     """
     ===== end of xml2dict =================
     """
@@ -114,7 +144,7 @@ def process_xml(raw_dict):
                                                  "--elementResJ={resolution[y]} "
                                                  "--elementResK={resolution[z]}"),
                     "dims":                     "--dim={dims}",
-                    "output_path":              "--outputPath={output_path}",
+                    "output_path":              "--outputPath={uw_output_path}",
                     "output_pictures":          "--components.window.Type=DummyComponent",
                     "max_time":                 "--end={max_time}",
                     "max_timesteps":            "--maxTimeSteps={max_timesteps}",
@@ -139,8 +169,36 @@ def process_xml(raw_dict):
     model_dict["checkpoint_every_x_years"] = float(checkpoint_frequency_options["every_x_years"])
     model_dict["checkpoint_every_x_steps"] = int(checkpoint_frequency_options["every_x_timesteps"])
 
+    try:
+        model_dict["adaptive_checkpointing"] = xmlbool(checkpoint_frequency_options["adaptive"])
+    except KeyError:
+        model_dict["adaptive_checkpointing"] = False
+
+    for option, default in (("max_lost_work_in_hours", 6.0),
+                            ("max_checkpoint_overhead", 0.05),
+                            ("mean_time_between_failures_in_hours", 168.0)):
+        try:
+            model_dict[option] = float(checkpoint_frequency_options[option])
+        except KeyError:
+            model_dict[option] = default
+
     model_dict["output_pictures"] = xmlbool(output_controls["output_pictures"])
     model_dict["write_log_file"] = xmlbool(output_controls["write_log_file"])
+
+    try:
+        model_dict["compress_log_file"] = xmlbool(output_controls["compress_log_file"])
+    except KeyError:
+        model_dict["compress_log_file"] = False
+
+    try:
+        model_dict["log_segment_size"] = int(float(output_controls["log_segment_size_in_mb"]) * 1024 ** 2)
+    except KeyError:
+        model_dict["log_segment_size"] = 64 * 1024 ** 2
+
+    try:
+        model_dict["log_console_summary"] = xmlbool(output_controls["log_console_summary"])
+    except KeyError:
+        model_dict["log_console_summary"] = False
     # </Output_Controls>
 
 
@@ -151,6 +209,11 @@ def process_xml(raw_dict):
     model_dict["update_xml_information"] = xmlbool(therm_equil["update_xml_information"])
     model_dict["preserve_thermal_checkpoints"] = xmlbool(therm_equil["preserve_thermal_equilibration_checkpoints"])
 
+    try:
+        model_dict["use_1d_steady_state_solver"] = xmlbool(therm_equil["use_1d_steady_state_solver"])
+    except KeyError:
+        model_dict["use_1d_steady_state_solver"] = False
+
     thermal_output_controls = therm_equil["output_controls"]
 
     model_dict["thermal_description"] = thermal_output_controls["description"]
@@ -244,11 +307,112 @@ def process_xml(raw_dict):
         model_dict["verbose_run"] = xmlbool(uw_exec["verbose_run"])
     except KeyError:
         model_dict["verbose_run"] = False
+
+    try:
+        model_dict["resource_sample_interval"] = float(uw_exec["resource_sample_interval"])
+    except KeyError:
+        model_dict["resource_sample_interval"] = 10.0
+
+    try:
+        model_dict["preflight_check"] = xmlbool(uw_exec["preflight_check"])
+    except KeyError:
+        model_dict["preflight_check"] = True
+
+    try:
+        model_dict["walltime_in_hours"] = float(uw_exec["walltime_in_hours"])
+    except KeyError:
+        model_dict["walltime_in_hours"] = 0.0
+
+    try:
+        model_dict["scratch_directory"] = os.path.expandvars(os.path.expanduser(uw_exec["scratch_directory"] or ""))
+    except KeyError:
+        model_dict["scratch_directory"] = ""
+
+    # The health monitor is on if <health_monitor> is there, unless <enabled> is false.
+    health_monitor = uw_exec.get("health_monitor", None)
+    model_dict["health_monitor"] = "health_monitor" in uw_exec
+    if not isinstance(health_monitor, dict):
+        health_monitor = {}
+    try:
+        model_dict["health_monitor"] = model_dict["health_monitor"] and xmlbool(health_monitor["enabled"])
+    except KeyError:
+        pass
+    for option, convert, default in (("max_unconverged_timesteps", int, 10),
+                                     ("min_dt_fraction", float, 1e-4),
+                                     ("max_residual", float, 1e6),
+                                     ("ignore_first_timesteps", int, 5)):
+        try:
+            model_dict[option] = convert(health_monitor[option])
+        except KeyError:
+            model_dict[option] = default
+
+    # The launch profile is on if <launch_profile> is there, unless <enabled> is false.
+    launch_profile = uw_exec.get("launch_profile", None)
+    model_dict["launch_profile"] = "launch_profile" in uw_exec
+    if not isinstance(launch_profile, dict):
+        launch_profile = {}
+    try:
+        model_dict["launch_profile"] = model_dict["launch_profile"] and xmlbool(launch_profile["enabled"])
+    except KeyError:
+        pass
+    for option, convert, default in (("binding", str, "auto"),
+                                     ("ranks_per_socket", int, 0),
+                                     ("hosts", str, ""),
+                                     ("mpi_flavour", str, "auto")):
+        try:
+            model_dict[option] = convert(launch_profile[option] or default)
+        except KeyError:
+            model_dict[option] = default
+
+    # The checkpoint hooks are on if <checkpoint_hooks> is there, unless <enabled> is false.
+    checkpoint_hooks = uw_exec.get("checkpoint_hooks", None)
+    hooks_on = "checkpoint_hooks" in uw_exec
+    if not isinstance(checkpoint_hooks, dict):
+        checkpoint_hooks = {}
+    try:
+        hooks_on = hooks_on and xmlbool(checkpoint_hooks["enabled"])
+    except KeyError:
+        pass
+    try:
+        model_dict["checkpoint_hooks"] = (checkpoint_hooks["hooks"] or "").replace(",", " ").split()
+    except KeyError:
+        model_dict["checkpoint_hooks"] = ["xdmf", "statistics"]
+    if not hooks_on:
+        model_dict["checkpoint_hooks"] = []
+    try:
+        model_dict["hook_workers"] = int(checkpoint_hooks["workers"])
+    except KeyError:
+        model_dict["hook_workers"] = 1
+
+    try:
+        model_dict["memoize_runs"] = xmlbool(uw_exec["memoize_runs"])
+    except KeyError:
+        model_dict["memoize_runs"] = False
+
+    try:
+        model_dict["fingerprint_registry"] = os.path.expandvars(os.path.expanduser(uw_exec["fingerprint_registry"]))
+    except KeyError:
+        model_dict["fingerprint_registry"] = os.path.expanduser("~/.lmr/fingerprints.jsonl")
     # </Underworld_Execution>
 
     return model_dict, command_dict
 
 
+def get_uw_param(xml_file, name, default=None):
+    """
+    Return the value of the top-level <param name="..."> in an Underworld XML
+    file, or the default if it isn't there.
+    """
+    try:
+        root = ElementTree.parse(xml_file).getroot()
+    except Exception:
+        return default
+    for element in root:
+        if str(element.tag).endswith("param") and element.get("name") == name and element.text:
+            return element.text.strip()
+    return default
+
+
 def get_textual_resolution(res):
     """
     Return a string of the resolution with x's between.
@@ -258,6 +422,16 @@ def get_textual_resolution(res):
                               res["z"])))
 
 
+def uses_direct_solver(model_dict):
+    """
+    Whether the run (at model_dict["resolution"]) is solved with MUMPS,
+    rather than multigrid.
+    """
+    smaller_model = model_dict["resolution"]["x"] * model_dict["resolution"]["y"] < 1e6
+    return (((model_dict["dims"] == 2 and smaller_model) or model_dict["force_direct_solve"])
+            and not model_dict["force_multigrid_solve"] or model_dict["run_thermal_equilibration_phase"])
+
+
 def prepare_job(model_dict, command_dict):
     """
     Prepare output paths, resolutions, and special functions for thermal equilibration.
@@ -293,18 +467,21 @@ def prepare_job(model_dict, command_dict):
         model_dict["max_time"] = cp(model_dict["thermal_max_time"])
 
         model_dict["logfile"] = "log_initial-condition_{thermal_description}.txt".format(thermal_description=model_dict["nice_thermal_description"])
+        model_dict["resource_file"] = "resources_initial-condition_{thermal_description}.txt".format(thermal_description=model_dict["nice_thermal_description"])
     else:
         model_dict["resolution"] = copy.deepcopy(model_dict["model_resolution"])
         model_dict["output_path"] = copy.deepcopy(model_dict["model_output_path"])
         model_dict["logfile"] = "log_result_{model_description}.txt".format(model_description=model_dict["nice_description"])
+        model_dict["resource_file"] = "resources_result_{model_description}.txt".format(model_description=model_dict["nice_description"])
 
+    model_dict["run_history_file"] = os.path.join(os.getcwd(), "lmr_run_history.jsonl")
+    model_dict["particles_per_cell"] = int(get_uw_param("lmrNumerics.xml", "particlesPerCell", 40))
 
-    # Select solvers
-    smaller_model = model_dict["resolution"]["x"] * model_dict["resolution"]["y"] < 1e6
 
-    if (((model_dict["dims"] == 2 and smaller_model) or model_dict["force_direct_solve"])
-         and not model_dict["force_multigrid_solve"] or model_dict["run_thermal_equilibration_phase"]):
+    # Select solvers
+    if uses_direct_solver(model_dict):
         print "SOLVERS: using MUMPS"
+        model_dict["solver_type"] = "mumps"
 
         solvers = ["-Uzawa_velSolver_pc_factor_mat_solver_package mumps",
                    "-mat_mumps_icntl_14 200",
@@ -315,6 +492,7 @@ def prepare_job(model_dict, command_dict):
 
     else:
         print "SOLVERS: using Multigrid"
+        model_dict["solver_type"] = "multigrid"
 
         def multigrid_test(number):
             if number == 0:
@@ -387,6 +565,11 @@ def prepare_job(model_dict, command_dict):
 
     command_dict["solver"] = " ".join(solvers)
 
+    model_dict["memoized"] = False
+    if model_dict["memoize_runs"]:
+        recall_run(model_dict, command_dict)
+        if model_dict["memoized"]:
+            return model_dict, command_dict
 
     # Prepare file system for UW run.
     output_dir = model_dict["output_path"]
@@ -395,15 +578,30 @@ def prepare_job(model_dict, command_dict):
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
 
+    # With staging, Underworld writes to scratch and a CheckpointMover copies to output_path.
+    if model_dict["scratch_directory"]:
+        # Made by run_model(), so a run that doesn't launch Underworld doesn't leave an empty folder in scratch.
+        model_dict["uw_output_path"] = os.path.join(model_dict["scratch_directory"], os.path.basename(output_dir))
+    else:
+        model_dict["uw_output_path"] = output_dir
+
+    # A fresh run overwrites files in place, so mustn't write through links made by deduplicate_results.py.
+    if not model_dict["restarting"]:
+        break_hard_links(output_dir)
+
     if model_dict["restarting"]:
         if model_dict["restart_timestep"] == -1:
-            # If no restart timestep is specified, automatically find the last one.
-            model_dict["restart_timestep"] = find_last_timestep(model_dict["output_path"])
+            # If no restart timestep is specified, automatically find the last one that is complete.
+            model_dict["restart_timestep"] = find_last_valid_timestep(model_dict["output_path"], model_dict["uw_output_path"])
         else:
-            last_timestep = find_last_timestep(model_dict["output_path"])
+            last_timestep = find_last_timestep(model_dict["output_path"], model_dict["uw_output_path"])
             if last_timestep != model_dict["restart_timestep"]:
                 raise ValueError("You have asked to restart the model at timestep {}, but "
                                  "there is no checkpoint of that number".format(model_dict["restart_timestep"]))
+            problems = checkpoint_problems(model_dict["output_path"], model_dict["uw_output_path"], last_timestep)
+            if problems:
+                raise ValueError("=== ERROR ===\nYou have asked to restart the model at timestep {0}, but "
+                                 "that checkpoint is damaged:\n  {1}".format(last_timestep, "\n  ".join(problems)))
 
         # When we restart, we need to preserve the original XMLs stored in result/xmls.
         # To do so, find the last xmls folder, and increment the number.
@@ -415,6 +613,9 @@ def prepare_job(model_dict, command_dict):
         elif len(xml_folders) == 1:
             xmls_dir = os.path.join(output_dir, "xmls_restart_1")
 
+        if model_dict["uw_output_path"] != output_dir:
+            stage_restart_files(output_dir, model_dict["uw_output_path"], model_dict["restart_timestep"])
+
     if not os.path.isdir(xmls_dir):
         os.mkdir(xmls_dir)
     for files in os.listdir("./"):
@@ -429,9 +630,24 @@ def prepare_job(model_dict, command_dict):
         last_ts = find_last_timestep(model_dict["thermal_output_path"])
         modify_initialcondition_xml(last_ts, xmls_dir, model_dict["thermal_output_path"])
 
+    if model_dict["adaptive_checkpointing"] and not model_dict["run_thermal_equilibration_phase"]:
+        adapt_checkpoint_interval(model_dict)
+
+    model_dict["xmls_dir"] = xmls_dir
+    write_model_settings(model_dict)
+
     return model_dict, command_dict
 
 
+def write_model_settings(model_dict):
+    """
+    The settings from lmrStart.xml only reach Underworld on the command line, so keep them with the
+    XMLs, for scripts/sweep_table.py to find what differs between runs.
+    """
+    with open(os.path.join(model_dict["xmls_dir"], "lmr_model.json"), "w") as settings:
+        json.dump(model_dict, settings, indent=1, sort_keys=True, default=str)
+
+
 def run_model(model_dict, command_dict):
 
     first = command_dict["parallel_runner"]
@@ -459,11 +675,48 @@ def run_model(model_dict, command_dict):
         print "LMR will now run the following command:\n{com}".format(com=together.format(**model_dict))
         sys.stdout.flush()
 
+    sampler = None
+    pump = None
+    mover = None
+    monitor = None
+    hooks = None
+    completed = False
+    if model_dict["health_monitor"] and not model_dict["run_thermal_equilibration_phase"]:
+        monitor = HealthMonitor(model_dict)
+    if model_dict["checkpoint_hooks"] and not model_dict["run_thermal_equilibration_phase"]:
+        hooks = CheckpointHooks(model_dict)
+        hooks.start()
+    if model_dict["uw_output_path"] != model_dict["output_path"]:
+        if not os.path.isdir(model_dict["uw_output_path"]):
+            os.makedirs(model_dict["uw_output_path"])
+        mover = CheckpointMover(model_dict["uw_output_path"], model_dict["output_path"])
+        mover.start()
     try:
-        # The sys.stdout is set in main()
-        model_run = subprocess.Popen(command, shell=False, stdout=sys.stdout, stderr=subprocess.STDOUT)
+        # The sys.stdout is set in main(). A CompressedLog isn't a real file, and the
+        # health monitor needs to see the output, so then Underworld's output is
+        # piped and copied on a background thread. Otherwise Underworld writes straight to it.
+        if isinstance(sys.stdout, CompressedLog) or monitor is not None:
+            model_run = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            pump = pump_output(model_run.stdout, sys.stdout, [monitor] if monitor is not None else [])
+        else:
+            model_run = subprocess.Popen(command, shell=False, stdout=sys.stdout, stderr=subprocess.STDOUT)
+
+        if monitor is not None:
+            monitor.watch(model_run)
+
+        if model_dict["resource_sample_interval"] > 0:
+            sampler = ProcessTreeSampler(model_run.pid, model_dict["resource_sample_interval"], model_dict["resource_file"])
+            sampler.start()
 
         model_run.wait()
+        if pump is not None:
+            pump.join()
+
+        if monitor is not None and monitor.reason is not None:
+            model_dict["health_abort"] = monitor.reason
+            raise IOError("\n=== ERROR ===\nThe health monitor stopped Underworld at timestep {0}: {1}\n"
+                          "The reason is recorded in {2}".format(monitor.timestep, monitor.reason,
+                                                                 os.path.join(model_dict["output_path"], "health_monitor.txt")))
 
         if model_run.returncode != 0:
             error_msg = '\n\nUnderworld did not exit nicely - have a look at its output to try and determine the problem.'
@@ -476,8 +729,11 @@ def run_model(model_dict, command_dict):
                               '  - Increasing the model resolution\n'
                               '  - Using fewer CPUs')
             raise IOError(error_msg)
+        completed = True
     except KeyboardInterrupt:
         model_run.terminate()
+        if pump is not None:
+            pump.join()
         if model_dict["run_thermal_equilibration_phase"]:
             print ('\n=== WARNING ===\nUnderworld thermal equilibration stopped - will interpolate with the '
                    'last timestep to be outputted.')
@@ -487,6 +743,671 @@ def run_model(model_dict, command_dict):
         raise OSError(("\n=== ERROR ===\nIssue finding a file. Computer says:\n\t{oserr}\nThe LMR is trying to run this command:\n"
                        "\t {first} {uwbinary} {input_xmls} ...\n\nMake sure all the commands (e.g. {first}) are correct, and all"
                        " the files exist (e.g. {uwbinary}).".format(oserr=oserr, first=first.format(**model_dict), **model_dict)))
+    finally:
+        if mover is not None:
+            mover.finish()
+        if sampler is not None:
+            sampler.stop()
+            record_run_resources(model_dict, sampler, model_run.returncode)
+        if hooks is not None:
+            if completed:
+                hooks.finish()
+            else:
+                # Don't hold up the error (or the cores of a cancelled job) with the hooks that are left.
+                hooks.abort()
+
+
+class CompressedLog(object):
+    """
+    A file-like log that writes into a folder of gzip compressed segments,
+    starting a new segment once the current one holds segment_size bytes of
+    (uncompressed) output. main() sets it as sys.stdout, and run_model() pipes
+    Underworld's output into it with pump_output().
+
+    When a segment is finished, a line is added to index.txt in the folder,
+    recording which timesteps it covers, so recent output can be searched
+    without decompressing the whole history (see scripts/search_log.py).
+
+    If console_summary is true, timestep, convergence, warning and error lines
+    are also printed to the screen.
+    """
+    timestep_re = re.compile(r"^TimeStep = (\d+)")
+    summary_re = re.compile(r"^(TimeStep = |Non linear solver - Converged|=== |SOLVERS:|PREFLIGHT:)|error|Error|ERROR|abort|Abort")
+
+    def __init__(self, log_dir, segment_size, console_summary=False):
+        self.log_dir = log_dir
+        self.segment_size = segment_size
+        self.console_summary = console_summary
+        self.lock = threading.Lock()
+        self.partial_line = ""
+        self.last_flush = time.time()
+
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        # Carry on from the last segment if the model is restarted.
+        existing = sorted(glob.glob(os.path.join(log_dir, "log.*.txt.gz")))
+        self.segment_number = int(existing[-1].split(".")[-3]) + 1 if existing else 0
+        self.open_segment()
+
+    def open_segment(self):
+        self.segment_name = "log.{0:05d}.txt.gz".format(self.segment_number)
+        self.segment = gzip.open(os.path.join(self.log_dir, self.segment_name), "wb")
+        self.segment_bytes = 0
+        self.segment_lines = 0
+        self.first_timestep = None
+        self.last_timestep = None
+        self.opened = datetime.datetime.now().isoformat()
+
+    def close_segment(self):
+        self.segment.close()
+        with open(os.path.join(self.log_dir, "index.txt"), "a") as index:
+            index.write(json.dumps({"segment": self.segment_name,
+                                    "lines": self.segment_lines,
+                                    "bytes": self.segment_bytes,
+                                    "first_timestep": self.first_timestep,
+                                    "last_timestep": self.last_timestep,
+                                    "opened": self.opened,
+                                    "closed": datetime.datetime.now().isoformat()}) + "\n")
+
+    def write(self, text):
+        with self.lock:
+            self.segment.write(text)
+            self.segment_bytes += len(text)
+            lines = (self.partial_line + text).split("\n")
+            self.partial_line = lines.pop()
+            for line in lines:
+                self.segment_lines += 1
+                match = self.timestep_re.match(line)
+                if match:
+                    self.last_timestep = int(match.group(1))
+                    if self.first_timestep is None:
+                        self.first_timestep = self.last_timestep
+                if self.console_summary and self.summary_re.search(line):
+                    sys.__stdout__.write(line + "\n")
+                    sys.__stdout__.flush()
+
+            if self.segment_bytes >= self.segment_size and not self.partial_line:
+                self.close_segment()
+                self.segment_number += 1
+                self.open_segment()
+            elif time.time() - self.last_flush > 10:
+                # A sync flush, so the segment can be read while it is still being written.
+                self.segment.flush()
+                self.last_flush = time.time()
+
+    def flush(self):
+        with self.lock:
+            self.segment.flush()
+            self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+
+def pump_output(stream, destination, listeners):
+    """
+    Copy everything from stream to destination on a background thread, until
+    it is closed, passing each line to the listeners as well. Returns the thread.
+    """
+    # A CompressedLog flushes itself. Anything else (the screen, a plain log file) is flushed every line.
+    flush = not isinstance(destination, CompressedLog)
+
+    def pump():
+        for line in iter(stream.readline, b""):
+            destination.write(line)
+            if flush:
+                destination.flush()
+            for listener in listeners:
+                listener(line)
+        stream.close()
+
+    thread = threading.Thread(target=pump)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class HealthMonitor(object):
+    """
+    Watches Underworld's output for signs the model has gone bad:
+      - the non-linear solver using all of its iterations, timestep after timestep,
+      - dt collapsing to a tiny fraction of what it was,
+      - residuals blowing up (or becoming nan).
+    Called with each line of output by pump_output(). When a rule triggers,
+    the reason is recorded in health_monitor.txt, and Underworld is stopped
+    once any checkpoint it is writing has been finished.
+    """
+    timestep_re = re.compile(r"^TimeStep = (\d+), Start time = \S+ \+ (\S+) prev timeStep dt")
+    residual_re = re.compile(r"^Non linear solver - Residual (\S+);")
+    iterations_re = re.compile(r"^Non linear solver - Converged after (\d+) iterations")
+    quiet_time = 1          # Seconds since the last checkpoint file was written, before it counts as finished
+    max_checkpoint_wait = 300
+
+    def __init__(self, model_dict):
+        self.max_iterations = model_dict["nonLinear_solver"]["max_iterations"]
+        self.max_unconverged = model_dict["max_unconverged_timesteps"]
+        self.min_dt_fraction = model_dict["min_dt_fraction"]
+        self.max_residual = model_dict["max_residual"]
+        self.ignore_timesteps = model_dict["ignore_first_timesteps"]
+        self.output_path = model_dict["output_path"]
+        self.uw_output_path = model_dict["uw_output_path"]
+        self.model_run = None
+        self.seen_timesteps = 0
+        self.timestep = None
+        self.largest_dt = 0.0
+        self.unconverged = 0
+        self.reason = None
+
+    def watch(self, model_run):
+        self.model_run = model_run
+
+    def __call__(self, line):
+        if self.reason is not None:
+            return
+        match = self.timestep_re.match(line)
+        if match:
+            self.timestep = int(match.group(1))
+            self.seen_timesteps += 1
+            try:
+                dt = float(match.group(2))
+            except ValueError:
+                return
+            if self.seen_timesteps > self.ignore_timesteps and self.min_dt_fraction > 0 and dt > 0 \
+                    and dt < self.min_dt_fraction * self.largest_dt:
+                self.trigger("min_dt_fraction", "dt has fallen to {0:.3g}, {1:.2g} of the largest dt so far ({2:.3g})".format(
+                    dt, dt / self.largest_dt, self.largest_dt))
+            self.largest_dt = max(self.largest_dt, dt)
+            return
+
+        match = self.residual_re.match(line)
+        if match:
+            try:
+                residual = float(match.group(1))
+            except ValueError:
+                residual = float("nan")
+            if math.isnan(residual) or math.isinf(residual):
+                self.trigger("max_residual", "the non-linear residual is {0}".format(residual))
+            elif self.seen_timesteps > self.ignore_timesteps and 0 < self.max_residual < residual:
+                self.trigger("max_residual", "the non-linear residual is {0:.3g}, above the limit of {1:.3g}".format(
+                    residual, self.max_residual))
+            return
+
+        match = self.iterations_re.match(line)
+        if match:
+            if int(match.group(1)) >= self.max_iterations:
+                self.unconverged += 1
+            else:
+                self.unconverged = 0
+            if self.seen_timesteps > self.ignore_timesteps and 0 < self.max_unconverged <= self.unconverged:
+                self.trigger("max_unconverged_timesteps",
+                             "the non-linear solver has used all {0} iterations for {1} timesteps in a row".format(
+                                 self.max_iterations, self.unconverged))
+
+    def trigger(self, rule, reason):
+        self.reason = reason
+        with open(os.path.join(self.output_path, "health_monitor.txt"), "a") as record:
+            record.write(json.dumps({"date": datetime.datetime.now().isoformat(),
+                                     "timestep": self.timestep,
+                                     "rule": rule,
+                                     "reason": reason}) + "\n")
+        # Stopping waits on the output folder, so is done on its own thread to keep the output flowing.
+        stopper = threading.Thread(target=self.stop)
+        stopper.daemon = True
+        stopper.start()
+
+    def checkpoint_in_progress(self):
+        """
+        A checkpoint is being written if the newest one has fewer files than
+        the one before, or one of its files has just been written.
+        """
+        try:
+            steps = {}
+            for filename in glob.glob(os.path.join(self.uw_output_path, "*.h5")):
+                step = checkpoint_io.step_of(filename)
+                if step is not None and not os.path.basename(filename).startswith("Mesh."):
+                    steps.setdefault(step, []).append(os.path.getmtime(filename))
+        except OSError:
+            return True  # A file went while looking (e.g. moved out of scratch), so look again.
+        if not steps:
+            return False
+        order = sorted(steps)
+        if len(order) > 1 and len(steps[order[-1]]) < len(steps[order[-2]]):
+            return True
+        return time.time() - max(steps[order[-1]]) < self.quiet_time
+
+    def stop(self):
+        """
+        Wait for any checkpoint Underworld is writing to be finished, so the
+        run can be restarted from it, then stop Underworld.
+        """
+        started = time.time()
+        while self.checkpoint_in_progress() and time.time() - started < self.max_checkpoint_wait:
+            time.sleep(0.5)
+        if self.model_run is not None and self.model_run.poll() is None:
+            self.model_run.terminate()
+
+
+class ProcessTreeSampler(threading.Thread):
+    """
+    Samples the memory (RSS) and CPU time of a process and all of its
+    descendants (i.e. mpirun and every Underworld rank) every few seconds,
+    and keeps the per-rank high-water marks.
+
+    Each sample is appended to the resource file as one JSON line as soon as
+    it is taken, so there is still a record if the job is killed.
+    Only works where there is a /proc filesystem (i.e. Linux).
+    """
+    def __init__(self, root_pid, interval, resource_file):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.root_pid = root_pid
+        self.interval = interval
+        self.resource_file = resource_file
+        self.start_time = time.time()
+        self.samples = 0
+        self.peak_total_rss = 0
+        self.peak_rank_rss = {}
+        self.rank_cpu_time = {}
+        self.total_cpu_time = {}
+        self.finished = threading.Event()
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            print ("=== WARNING ===\nThere is no /proc filesystem on this computer, so the LMR cannot "
+                   "record how much memory and CPU time Underworld uses.")
+            return
+        with open(self.resource_file, "a") as resource_log:
+            self.finished.wait(self.interval)
+            while not self.finished.is_set():
+                sample = self.sample()
+                if sample is not None:
+                    resource_log.write(json.dumps(sample) + "\n")
+                    resource_log.flush()
+                self.finished.wait(self.interval)
+
+    def stop(self):
+        self.finished.set()
+        self.join(self.interval + 5)
+
+    def descendants(self):
+        children = {}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open("/proc/{0}/stat".format(pid)) as stat:
+                    # The process name is in brackets, and may contain spaces.
+                    ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except (IOError, OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(pid))
+
+        tree = []
+        todo = [self.root_pid]
+        while todo:
+            parent = todo.pop()
+            tree.append(parent)
+            todo.extend(children.get(parent, []))
+        leaves = [pid for pid in tree if pid not in children]
+        return tree, leaves
+
+    def rank_of(self, pid, default):
+        """
+        MPI tells each process which rank it is through its environment.
+        """
+        try:
+            with open("/proc/{0}/environ".format(pid), "rb") as environ:
+                for variable in environ.read().split(b"\0"):
+                    for name in (b"OMPI_COMM_WORLD_RANK=", b"PMI_RANK=", b"PMIX_RANK=", b"SLURM_PROCID="):
+                        if variable.startswith(name):
+                            return int(variable[len(name):])
+        except (IOError, OSError, ValueError):
+            pass
+        return default
+
+    def sample(self):
+        tree, leaves = self.descendants()
+        leaves = sorted(leaves)
+        total_rss = 0
+        ranks = {}
+        for pid in tree:
+            try:
+                with open("/proc/{0}/stat".format(pid)) as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+                with open("/proc/{0}/status".format(pid)) as status:
+                    high_water = [int(line.split()[1]) * 1024 for line in status if line.startswith("VmHWM:")]
+            except (IOError, OSError, IndexError, ValueError):
+                continue  # The process has finished since we looked.
+            # Fields counted from after the process name: state is 0, utime 11, stime 12, rss 21.
+            rss = int(fields[21]) * self.page_size
+            cpu_time = (int(fields[11]) + int(fields[12])) / self.clock_ticks
+            total_rss += rss
+            self.total_cpu_time[pid] = cpu_time
+            if pid in leaves:
+                rank = self.rank_of(pid, leaves.index(pid))
+                ranks[rank] = rss
+                self.peak_rank_rss[rank] = max([self.peak_rank_rss.get(rank, 0), rss] + high_water)
+                self.rank_cpu_time[rank] = cpu_time
+
+        if not ranks:
+            return None
+        self.samples += 1
+        self.peak_total_rss = max(self.peak_total_rss, total_rss)
+        return {"time": round(time.time() - self.start_time, 2),
+                "total_rss": total_rss,
+                "total_cpu_time": round(sum(self.total_cpu_time.values()), 2),
+                "rank_rss": dict((str(rank), rss) for rank, rss in sorted(ranks.items()))}
+
+    def summary(self):
+        wall_time = time.time() - self.start_time
+        cpu_time = sum(self.rank_cpu_time.values())
+        return {"wall_time": round(wall_time, 2),
+                "samples": self.samples,
+                "ranks": len(self.peak_rank_rss),
+                "peak_total_rss": self.peak_total_rss,
+                "peak_rank_rss": max(self.peak_rank_rss.values()) if self.peak_rank_rss else 0,
+                "peak_rss_by_rank": dict((str(rank), rss) for rank, rss in sorted(self.peak_rank_rss.items())),
+                "cpu_time": round(cpu_time, 2),
+                "cpu_efficiency": round(cpu_time / (wall_time * len(self.rank_cpu_time)), 3) if self.rank_cpu_time else 0}
+
+
+def get_total_memory():
+    """
+    Return how much memory this computer has in bytes, or 0 if unknown.
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def cpu_list(text):
+    """
+    The CPU numbers in a Linux CPU list, like "0-3,8-11".
+    """
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def detect_topology():
+    """
+    The sockets, physical cores, hardware threads and NUMA domains of this
+    computer, from /sys. Anything that can't be read is assumed to be one
+    socket and one NUMA domain, with a core per CPU.
+    """
+    cores = set()
+    sockets = set()
+    for topology in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/topology"):
+        try:
+            with open(os.path.join(topology, "physical_package_id")) as package, \
+                    open(os.path.join(topology, "core_id")) as core:
+                socket_id = int(package.read())
+                cores.add((socket_id, int(core.read())))
+                sockets.add(socket_id)
+        except (IOError, ValueError):
+            continue
+    try:
+        threads = multiprocessing.cpu_count()
+    except NotImplementedError:
+        threads = len(cores) or 1
+    numa_nodes = 0
+    for node in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        try:
+            with open(node) as cpulist:
+                numa_nodes += bool(cpu_list(cpulist.read()))
+        except (IOError, ValueError):
+            continue
+    return {"sockets": len(sockets) or 1,
+            "cores": len(cores) or threads,
+            "threads": threads,
+            "numa_nodes": numa_nodes or 1}
+
+
+def detect_mpi_flavour(parallel_command):
+    """
+    Which MPI launcher parallel_command is: openmpi, mpich (Hydra, which
+    Intel MPI uses too) or srun. Only mpirun/mpiexec are asked for their
+    version, as parallel_command can be anything. None if unknown.
+    """
+    name = os.path.basename(parallel_command.split()[0]) if parallel_command.split() else ""
+    if name == "srun":
+        return "srun"
+    if name not in ("mpirun", "mpiexec", "orterun", "mpiexec.hydra"):
+        return None
+    try:
+        version = subprocess.Popen(parallel_command.split() + ["--version"], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT).communicate()[0].decode("utf-8", "replace")
+    except OSError:
+        return None
+    if "Open MPI" in version or "OpenRTE" in version:
+        return "openmpi"
+    if "HYDRA" in version or "MPICH" in version or "Intel(R) MPI" in version:
+        return "mpich"
+    return None
+
+
+# How each launcher maps ranks (core: fill one socket first; socket and numa: round-robin over
+# them) and binds each to a core, puts ranks_per_socket ranks on each socket, and reads a hostfile.
+LAUNCH_FLAGS = {
+    "openmpi": {"core": "--bind-to core --map-by core",
+                "socket": "--bind-to core --map-by socket",
+                "numa": "--bind-to core --map-by numa",
+                "ranks_per_socket": "--bind-to core --map-by ppr:{ranks_per_socket}:socket",
+                "hostfile": "--hostfile {hostfile}",
+                "hostfile_line": "{host} slots={slots}\n"},
+    "mpich":   {"core": "-bind-to core -map-by core",
+                "socket": "-bind-to core -map-by socket",
+                "numa": "-bind-to core -map-by numa",
+                "ranks_per_socket": "-bind-to core -map-by socket -ppn {ranks_per_node}",
+                "hostfile": "-f {hostfile}",
+                "hostfile_line": "{host}:{slots}\n"},
+    "srun":    {"core": "--cpu-bind=cores --distribution=block:block",
+                "socket": "--cpu-bind=cores --distribution=block:cyclic",
+                "numa": "--cpu-bind=cores --distribution=block:cyclic --mem-bind=local",
+                "ranks_per_socket": "--cpu-bind=cores --ntasks-per-socket={ranks_per_socket}"},
+}
+
+
+def launch_profile(model_dict, topology, flavour):
+    """
+    The extra launcher flags for the <launch_profile>, and a record of what
+    was chosen and why. Writes the hostfile to the output folder if hosts
+    are given.
+    """
+    record = {"binding": model_dict["binding"].strip(), "mpi_flavour": flavour, "topology": topology,
+              "ranks_per_socket": model_dict["ranks_per_socket"], "hosts": None, "flags": ""}
+    if flavour not in LAUNCH_FLAGS:
+        record["note"] = "unknown MPI launcher, so no flags were added"
+        return "", record
+    flags = LAUNCH_FLAGS[flavour]
+    extra = []
+
+    # Hosts are "name:slots name:slots ..." or the path to a hostfile.
+    hosts = model_dict["hosts"].strip()
+    host_count = 1
+    if hosts:
+        if flavour == "srun":
+            record["note"] = "srun places ranks on the nodes of the allocation, so <hosts> is ignored"
+        else:
+            if os.path.isfile(os.path.expanduser(hosts)):
+                hostfile = os.path.abspath(os.path.expanduser(hosts))
+                with open(hostfile) as existing:
+                    host_count = len([line for line in existing if line.strip() and not line.startswith("#")])
+            else:
+                hostfile = os.path.join(model_dict["output_path"], "lmr_hostfile")
+                entries = [entry.split(":") for entry in hosts.split()]
+                with open(hostfile, "w") as hostfile_out:
+                    for entry in entries:
+                        hostfile_out.write(flags["hostfile_line"].format(
+                            host=entry[0], slots=entry[1] if len(entry) > 1 else topology["cores"]))
+                host_count = len(entries)
+            record["hosts"] = hostfile
+            extra.append(flags["hostfile"].format(hostfile=hostfile))
+
+    try:
+        cpus = int(model_dict["cpus"])
+    except (KeyError, ValueError):
+        cpus = 0
+    binding = record["binding"]
+    if binding == "auto":
+        # Spread the ranks over the sockets (or NUMA domains), so they share the memory bandwidth evenly.
+        binding = "socket" if topology["sockets"] > 1 else "numa" if topology["numa_nodes"] > 1 else "core"
+    ranks_per_socket = model_dict["ranks_per_socket"]
+    if ranks_per_socket > 0:
+        if cpus and cpus > ranks_per_socket * topology["sockets"] * host_count:
+            raise ValueError("=== ERROR ===\nYou have asked for {0} CPUs, but only {1} ranks per socket on {2} "
+                             "socket(s) and {3} node(s) in <launch_profile>.".format(
+                                 cpus, ranks_per_socket, topology["sockets"], host_count))
+        binding = "ranks_per_socket"
+    if binding != "none" and host_count == 1 and cpus > topology["cores"]:
+        # Binding more ranks than there are cores makes most launchers refuse to start.
+        record["note"] = "more ranks ({0}) than cores ({1}), so the ranks aren't bound".format(cpus, topology["cores"])
+        binding = "none"
+    if binding in flags:
+        extra.insert(0, flags[binding].format(ranks_per_socket=ranks_per_socket,
+                                              ranks_per_node=ranks_per_socket * topology["sockets"]))
+    elif binding != "none":
+        raise ValueError("=== ERROR ===\nUnknown <binding> '{0}' in <launch_profile>. Use auto, core, socket, "
+                         "numa or none.".format(binding))
+    if flavour == "openmpi" and model_dict["verbose_run"]:
+        extra.append("--report-bindings")
+    record["layout"] = binding
+    record["flags"] = " ".join(extra)
+    return record["flags"], record
+
+
+def apply_launch_profile(model_dict, command_dict):
+    """
+    Add the <launch_profile> flags to the parallel command. What was chosen
+    is kept in the run's lmr_model.json, and with its resources, to compare
+    the throughput of different profiles.
+    """
+    topology = detect_topology()
+    flavour = model_dict["mpi_flavour"].strip()
+    if flavour == "auto":
+        flavour = detect_mpi_flavour(model_dict["parallel_command"])
+    flags, record = launch_profile(model_dict, topology, flavour)
+    model_dict["launch_flags"] = flags
+    model_dict["launch_profile_record"] = record
+    if flags:
+        command_dict["parallel_runner"] += " {launch_flags}"
+    model_dict["launch_command"] = " ".join(command_dict["parallel_runner"].format(**model_dict).split())
+    # prepare_job() wrote the settings before this was chosen, and the resource record needs a sample.
+    write_model_settings(model_dict)
+    print "LAUNCH: {0} socket(s), {1} cores, {2} NUMA domain(s); {3} launcher, {4}{5}".format(
+        topology["sockets"], topology["cores"], topology["numa_nodes"], flavour or "unknown",
+        "flags: " + flags if flags else "no flags added", " ({0})".format(record["note"]) if "note" in record else "")
+    sys.stdout.flush()
+
+
+def read_last_frequent_output(path):
+    """
+    Return the (timestep, time) of the last line in FrequentOutput.dat, or
+    (0, 0.0) if there isn't one yet.
+    """
+    last_line = None
+    try:
+        with open(os.path.join(path, "FrequentOutput.dat"), "rb") as freq:
+            # Only the end is read, as long runs have millions of lines.
+            freq.seek(0, os.SEEK_END)
+            start = max(0, freq.tell() - 8192)
+            freq.seek(start)
+            lines = freq.read().decode("ascii", "replace").split("\n")
+            if start > 0:
+                lines = lines[1:]  # Probably only part of a line.
+            for line in lines[:-1]:  # The last is after the last newline, so may still be being written.
+                if line.strip() and not line.lstrip().startswith("#"):
+                    last_line = line
+    except IOError:
+        pass
+    if last_line is None:
+        return 0, 0.0
+    columns = last_line.split()
+    return int(float(columns[0])), float(columns[1])
+
+
+def record_run_resources(model_dict, sampler, returncode):
+    """
+    Print a summary of the resources Underworld used, and append it to the
+    run history so later runs can be sized from it.
+    """
+    summary = sampler.summary()
+    if summary["samples"] == 0:
+        return
+
+    mem_total = get_total_memory()
+    timesteps, model_time = read_last_frequent_output(model_dict["output_path"])
+
+    gb = 1024 ** 3
+    print ("\n=== RESOURCES ===\n"
+           "Wall time: {wall_time:.0f} s over {ranks} ranks, CPU efficiency {cpu_efficiency:.0%}\n"
+           "Peak memory: {total:.2f} GB in total, {rank:.2f} GB on the largest rank\n"
+           "Timeline and per-rank high-water marks are in {resource_file}").format(
+               total=summary["peak_total_rss"] / gb, rank=summary["peak_rank_rss"] / gb,
+               resource_file=model_dict["resource_file"], **summary)
+    if mem_total:
+        print "At its peak, Underworld used {0:.1%} of this computer's memory ({1:.1f} GB).".format(
+            summary["peak_total_rss"] / mem_total, mem_total / gb)
+    sys.stdout.flush()
+
+    record = {"date": datetime.datetime.now().isoformat(),
+              "description": model_dict["nice_thermal_description"] if model_dict["run_thermal_equilibration_phase"] else model_dict["nice_description"],
+              "thermal": model_dict["run_thermal_equilibration_phase"],
+              "dims": model_dict["dims"],
+              "resolution": model_dict["resolution"],
+              "solver_type": model_dict.get("solver_type"),
+              "particles_per_cell": model_dict.get("particles_per_cell"),
+              "max_time": model_dict["max_time"],
+              "first_timestep": model_dict["restart_timestep"] if model_dict["restarting"] else 0,
+              "timesteps": timesteps,
+              "model_time": model_time,
+              "node_memory": mem_total,
+              "returncode": returncode,
+              "health_abort": model_dict.get("health_abort"),
+              "launch_profile": model_dict.get("launch_profile_record")}
+    record.update(summary)
+    with open(model_dict["resource_file"], "a") as resource_log:
+        resource_log.write(json.dumps({"summary": record}) + "\n")
+    try:
+        with open(model_dict["run_history_file"], "a") as history:
+            history.write(json.dumps(record, sort_keys=True) + "\n")
+    except IOError as err:
+        print "=== WARNING ===\nUnable to add this run to {0}: {1}".format(model_dict["run_history_file"], err)
+
+
+def solve_1d_geotherm(model_dict):
+    """
+    Solve the thermal equilibration phase as 1D steady-state conduction with
+    lmrGeotherm, instead of running Underworld. Returns False if the model
+    can't be solved that way, so Underworld should be run as normal.
+    """
+    try:
+        geotherm = lmrGeotherm.solve(model_dict["input_xmls"].split(), model_dict["thermal_model_resolution"],
+                                     model_dict["dims"])
+        lmrGeotherm.write_initial_condition(model_dict["output_path"], geotherm,
+                                            model_dict["max_time"] * SECONDS_PER_YEAR)
+    except lmrGeotherm.ModelError as err:
+        print ("=== WARNING ===\nThe thermal equilibration phase can't be solved in 1D, so Underworld will "
+               "be run instead:\n{0}".format(err))
+        return False
+    print ("GEOTHERM: solved 1D steady-state conduction in {0:.3f} seconds ({1} iterations). Surface heat "
+           "flow {2:.2f} mW/m^2. Written to {3}").format(geotherm["seconds"], geotherm["iterations"],
+                                                        geotherm["surface_heat_flow"] * 1e3, model_dict["output_path"])
+    return True
+
 
 def post_model_run(model_dict):
     """
@@ -505,14 +1426,523 @@ def post_model_run(model_dict):
                         pass
 
 
-def find_last_timestep(path):
+def canonical_xml(xml_file):
+    """
+    A string of everything in an XML file that matters to Underworld, so files
+    that only differ in whitespace, comments, attribute order or the way
+    numbers are written (1e3, 1000, 1000.0) give the same string.
+    """
+    def canonical_text(text):
+        text = (text or "").strip()
+        try:
+            return repr(float(text))
+        except ValueError:
+            return text.lower() if text.lower() in ("true", "false") else " ".join(text.split())
+
+    def walk(element, parts):
+        if not isinstance(element.tag, str):
+            return  # A comment or processing instruction.
+        parts.append("<{0} {1}>{2}".format(element.tag, sorted(element.attrib.items()), canonical_text(element.text)))
+        for child in element:
+            walk(child, parts)
+        parts.append("</>")
+
+    parts = []
+    walk(ElementTree.parse(xml_file).getroot(), parts)
+    return "".join(parts)
+
+
+def file_sha256(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as data:
+        for chunk in iter(lambda: data.read(4 * 1024 ** 2), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def config_fingerprint(model_dict, command_dict):
+    """
+    A SHA-256 of the complete effective configuration of this run: the
+    Underworld XMLs, the Underworld command line, and the Underworld binary.
+
+    lmrStart.xml isn't included itself, as everything in it that reaches
+    Underworld is in the command line. Neither are the parts of the command
+    line that don't change the result: mpirun and the CPUs, the output
+    folder, and the restart timestep. A thermo-mechanical run also includes
+    the fingerprint of the initial condition it starts from.
+    """
+    sha = hashlib.sha256()
+    sha.update(b"thermal" if model_dict["run_thermal_equilibration_phase"] else b"mechanical")
+    if model_dict["run_thermal_equilibration_phase"] and model_dict["use_1d_steady_state_solver"]:
+        sha.update(b"1d steady state")
+
+    for xml_file in sorted(glob.glob("lmr*.xml")):
+        try:
+            text = canonical_xml(xml_file)
+        except Exception:  # Not valid XML, so fingerprint it as it is.
+            with open(xml_file, "rb") as raw:
+                text = raw.read().decode("utf-8", "replace")
+        if "LMRStarterKit" in text.split(">", 1)[0]:
+            continue
+        sha.update("{0}\n{1}\n".format(xml_file, text).encode("utf-8"))
+
+    values = dict(model_dict, xmls_dir="", uw_root="", uw_output_path="")
+    for key in sorted(command_dict):
+        if key in ("parallel_runner", "output_path", "restart", "uwbinary"):
+            continue
+        sha.update("{0}={1}\n".format(key, " ".join(command_dict[key].format(**values).split())).encode("utf-8"))
+
+    sha.update(file_sha256(model_dict["uwbinary"]).encode("utf-8"))
+
+    if not model_dict["run_thermal_equilibration_phase"] and model_dict["update_xml_information"]:
+        try:
+            with open(os.path.join(model_dict["thermal_output_path"], "lmr_fingerprint.txt")) as thermal:
+                sha.update(thermal.read().strip().encode("utf-8"))
+        except IOError:
+            sha.update(os.path.basename(model_dict["thermal_output_path"]).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def run_finished(model_dict):
+    timestep, model_time = read_last_frequent_output(model_dict["output_path"])
+    return ((model_dict["max_timesteps"] > 0 and timestep >= model_dict["max_timesteps"]) or
+            model_time >= model_dict["max_time"] * SECONDS_PER_YEAR * (1 - 1e-6))
+
+
+def remember_run(model_dict, status):
+    """
+    Record in the registry that the run with this fingerprint is (being) done in output_path.
+    """
+    registry = model_dict["fingerprint_registry"]
+    try:
+        if not os.path.isdir(os.path.dirname(registry)):
+            os.makedirs(os.path.dirname(registry))
+        with open(registry, "a") as record:
+            record.write(json.dumps({"fingerprint": model_dict["fingerprint"],
+                                     "output_path": os.path.realpath(model_dict["output_path"]),
+                                     "status": status,
+                                     "host": socket.gethostname(),
+                                     "pid": os.getpid(),
+                                     "date": datetime.datetime.now().isoformat()}, sort_keys=True) + "\n")
+    except (IOError, OSError) as err:
+        print "=== WARNING ===\nUnable to record this run in {0}: {1}".format(registry, err)
+
+
+def run_alive(entry):
+    """
+    Whether the run that wrote a registry entry might still be going.
+    """
+    if entry["host"] == socket.gethostname():
+        try:
+            os.kill(entry["pid"], 0)
+        except OSError:
+            return False
+        return entry["pid"] != os.getpid()
+    # Can't see processes on other computers, so go by whether it has written anything lately.
+    try:
+        return time.time() - os.path.getmtime(os.path.join(entry["output_path"], "FrequentOutput.dat")) < 600
+    except OSError:
+        return False
+
+
+def recall_run(model_dict, command_dict):
+    """
+    Look up this run's fingerprint in the registry. If an identical run has
+    finished, use its results instead of running again (model_dict["memoized"]).
+    If one was started but didn't finish, restart it from its last checkpoint.
+    A result in a different folder is used by linking output_path to it.
+    """
+    model_dict["fingerprint"] = config_fingerprint(model_dict, command_dict)
+    output_path = model_dict["output_path"]
+
+    latest = {}
+    try:
+        with open(model_dict["fingerprint_registry"]) as registry:
+            for line in registry:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["fingerprint"] == model_dict["fingerprint"]:
+                    latest[entry["output_path"]] = entry
+    except IOError:
+        pass
+
+    def holds_this_run(entry):
+        # The folder must still be there, and not have been reused for something else since.
+        try:
+            with open(os.path.join(entry["output_path"], "lmr_fingerprint.txt")) as stamp:
+                return stamp.read().strip() == model_dict["fingerprint"]
+        except IOError:
+            return False
+
+    def has_checkpoints(path):
+        # Including any still in <scratch_directory>, if the run was killed before they were moved.
+        paths = [path]
+        if model_dict["scratch_directory"]:
+            paths.append(os.path.join(model_dict["scratch_directory"], os.path.basename(path)))
+        return any(glob.glob(os.path.join(search_path, "VelocityField.*.h5")) for search_path in paths)
+
+    candidates = [candidate for candidate in latest.values() if holds_this_run(candidate)]
+    # Prefer a finished run, then the one in this run's own folder.
+    candidates.sort(key=lambda candidate: (candidate["status"] != "complete",
+                                           candidate["output_path"] != os.path.realpath(output_path)))
+    for entry in candidates:
+        if entry["status"] != "complete" and (run_alive(entry) or not has_checkpoints(entry["output_path"])):
+            continue
+        if entry["output_path"] != os.path.realpath(output_path):
+            if os.path.isdir(output_path) and has_checkpoints(output_path):
+                print ("=== WARNING ===\nAn identical run is in {0}, but {1} already has other checkpoints in it, "
+                       "so it will be run again.").format(entry["output_path"], output_path)
+                break
+            if os.path.islink(output_path):
+                os.remove(output_path)
+            elif os.path.isdir(output_path) and os.listdir(output_path):
+                # Never delete what's in it (notes, logs, files set up by hand), just move it out of the way.
+                replaced = "{0}.replaced.{1}".format(output_path.rstrip(os.sep), time.strftime("%Y%m%d-%H%M%S"))
+                os.rename(output_path, replaced)
+                print ("=== WARNING ===\nAn identical run is in {0}, so {1} will link to it. What was in {1} "
+                       "has been moved to {2}.").format(entry["output_path"], output_path, replaced)
+            elif os.path.isdir(output_path):
+                os.rmdir(output_path)
+            os.symlink(entry["output_path"], output_path)
+
+        if entry["status"] == "complete":
+            print "MEMOIZED: an identical run has already finished in {0}, so it won't be run again.".format(entry["output_path"])
+            model_dict["memoized"] = True
+        else:
+            print "MEMOIZED: an identical run was started in {0}, and will be restarted from its last checkpoint.".format(
+                entry["output_path"])
+            model_dict["restarting"] = True
+            model_dict["restart_timestep"] = -1
+            command_dict["restart"] = "--restartTimestep={restart_timestep}"
+        break
+
+    if not model_dict["memoized"]:
+        if not os.path.isdir(output_path):
+            os.mkdir(output_path)
+        with open(os.path.join(output_path, "lmr_fingerprint.txt"), "w") as stamp:
+            stamp.write(model_dict["fingerprint"] + "\n")
+        remember_run(model_dict, "started")
+
+
+def load_run_history(history_file):
+    history = []
+    try:
+        with open(history_file) as hist:
+            for line in hist:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    pass  # A half written line from a run that was killed.
+    except IOError:
+        pass
+    return history
+
+
+def least_squares(rows, targets):
+    """
+    Solve the normal equations for a small linear least squares problem, by
+    Gaussian elimination. Returns None if the problem is singular.
+    """
+    n = len(rows[0])
+    a = [[sum(row[i] * row[j] for row in rows) for j in range(n)] +
+         [sum(row[i] * t for row, t in zip(rows, targets))] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-12:
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(n):
+            if r != col:
+                factor = a[r][col] / a[col][col]
+                a[r] = [x - factor * y for x, y in zip(a[r], a[col])]
+    return [a[i][n] / a[i][i] for i in range(n)]
+
+
+def predict_run(model_dict, cpus, history):
+    """
+    Estimate the memory per rank, wall time per timestep, and total wall
+    time to reach max_time, from previous runs of the same kind (2D/3D,
+    thermal/mechanical and solver) in the run history.
+
+    With enough previous runs the estimates are least squares fits:
+        memory per rank = a + b * elements/rank + c * particles/rank
+        log(time per step) = a + b * log(elements) + c * log(ranks)
+    With fewer, the closest previous run is scaled to this one. Returns None
+    if there is nothing comparable in the history.
+    """
+    def elements(res, dims):
+        return res["x"] * res["y"] * (res["z"] if dims == 3 else 1)
+
+    similar = [run for run in history
+               if run.get("dims") == model_dict["dims"]
+               and run.get("thermal") == model_dict["run_thermal_equilibration_phase"]
+               and run.get("solver_type") == model_dict.get("solver_type")
+               and run.get("ranks", 0) > 0 and run.get("resolution")]
+    if not similar:
+        return None
+
+    new_elements = elements(model_dict["resolution"], model_dict["dims"])
+    ppc = model_dict.get("particles_per_cell") or 40
+    prediction = {"based_on": len(similar)}
+
+    # Memory per rank
+    mem_runs = [run for run in similar if run.get("peak_rank_rss", 0) > 0]
+    if mem_runs:
+        rows = [[1.0, elements(run["resolution"], run["dims"]) / run["ranks"],
+                 elements(run["resolution"], run["dims"]) * (run.get("particles_per_cell") or 40) / run["ranks"]]
+                for run in mem_runs]
+        new_row = [1.0, new_elements / cpus, new_elements * ppc / cpus]
+        fit = least_squares(rows, [run["peak_rank_rss"] for run in mem_runs]) if len(mem_runs) > 3 else None
+        if fit is not None and fit[1] >= 0 and fit[2] >= 0:
+            prediction["memory_per_rank"] = sum(f * x for f, x in zip(fit, new_row))
+        else:
+            row, closest = min(zip(rows, mem_runs), key=lambda pair: abs(math.log(pair[0][2] / new_row[2])))
+            prediction["memory_per_rank"] = closest["peak_rank_rss"] * new_row[2] / row[2]
+
+    # Time per timestep
+    time_runs = [run for run in similar
+                 if run.get("timesteps", 0) - run.get("first_timestep", 0) > 0 and run.get("wall_time", 0) > 0]
+    if time_runs:
+        def step_time(run):
+            return run["wall_time"] / (run["timesteps"] - run.get("first_timestep", 0))
+
+        rows = [[1.0, math.log(elements(run["resolution"], run["dims"])), math.log(run["ranks"])] for run in time_runs]
+        fit = least_squares(rows, [math.log(step_time(run)) for run in time_runs]) if len(time_runs) > 3 else None
+        if fit is not None:
+            prediction["time_per_step"] = math.exp(fit[0] + fit[1] * math.log(new_elements) + fit[2] * math.log(cpus))
+        else:
+            # Direct solvers scale worse than linearly with the problem size.
+            exponent = 1.0 if model_dict.get("solver_type") == "multigrid" else 1.5
+            closest = min(time_runs, key=lambda run: abs(math.log(elements(run["resolution"], run["dims"]) / new_elements)))
+            prediction["time_per_step"] = (step_time(closest)
+                                           * (new_elements / elements(closest["resolution"], closest["dims"])) ** exponent
+                                           * closest["ranks"] / cpus)
+
+        # The timestep size is set by the Courant condition, so it shrinks with the cell size.
+        dt_runs = [run for run in time_runs if run.get("model_time", 0) > 0]
+        if dt_runs and "time_per_step" in prediction:
+            closest = min(dt_runs, key=lambda run: abs(run["resolution"]["x"] - model_dict["resolution"]["x"]))
+            dt = closest["model_time"] / closest["timesteps"] * closest["resolution"]["x"] / model_dict["resolution"]["x"]
+            steps = int(math.ceil(model_dict["max_time"] * SECONDS_PER_YEAR / dt)) if model_dict["max_time"] > 0 else None
+            # A maximum of 0 (or less) timesteps means no limit, as in run_finished.
+            if model_dict["max_timesteps"] > 0:
+                steps = min(steps, model_dict["max_timesteps"]) if steps is not None else model_dict["max_timesteps"]
+            if steps is not None:
+                prediction["timesteps"] = steps
+                prediction["total_time"] = steps * prediction["time_per_step"]
+
+    return prediction
+
+
+def preflight_check(model_dict):
+    """
+    Before launching, estimate what the run will need from previous runs, and
+    refuse to start if it obviously won't fit in this computer's memory, or
+    warn if it looks too big for the memory or the walltime.
+    """
+    try:
+        cpus = int(model_dict["cpus"])
+    except (KeyError, ValueError):
+        # supercomputer_mpi_format - the scheduler knows how many.
+        cpus = int(os.environ.get("SLURM_NTASKS", os.environ.get("PBS_NP", 0)))
+    if cpus <= 0:
+        return
+
+    try:
+        available_cores = multiprocessing.cpu_count()
+    except NotImplementedError:
+        available_cores = 0
+    local_run = "cpus" in model_dict
+    if local_run and available_cores and cpus > available_cores:
+        print ("=== WARNING ===\nYou have asked for {0} CPUs, but this computer only has {1}. The model will "
+               "run, but much slower than it should.".format(cpus, available_cores))
+
+    prediction = predict_run(model_dict, cpus, load_run_history(model_dict["run_history_file"]))
+    if prediction is None:
+        print ("PREFLIGHT: no similar runs in {0} yet, so no estimate of memory or run time "
+               "can be made.".format(model_dict["run_history_file"]))
+        return
+
+    gb = 1024 ** 3
+    print "PREFLIGHT: estimates from {0} previous similar run(s):".format(prediction["based_on"])
+    if "memory_per_rank" in prediction:
+        print "    memory: {0:.2f} GB per rank, {1:.2f} GB in total".format(
+            prediction["memory_per_rank"] / gb, prediction["memory_per_rank"] * cpus / gb)
+    if "time_per_step" in prediction:
+        print "    time per timestep: {0:.1f} s".format(prediction["time_per_step"])
+    if "total_time" in prediction:
+        print "    total: {0:.1f} hours for about {1} timesteps".format(prediction["total_time"] / 3600, prediction["timesteps"])
+    sys.stdout.flush()
+
+    mem_total = get_total_memory()
+    if local_run and mem_total and "memory_per_rank" in prediction:
+        needed = prediction["memory_per_rank"] * cpus
+        if needed > 1.5 * mem_total:
+            raise ValueError("=== ERROR ===\nThis model is expected to need about {0:.1f} GB of memory, but this computer "
+                             "only has {1:.1f} GB. Try a lower resolution, or run it on a bigger machine. To launch it "
+                             "anyway, set <preflight_check> to false in lmrStart.xml.".format(needed / gb, mem_total / gb))
+        elif needed > 0.8 * mem_total:
+            print ("=== WARNING ===\nThis model is expected to need about {0:.1f} GB of the {1:.1f} GB of memory on this "
+                   "computer. It may be killed for running out of memory.".format(needed / gb, mem_total / gb))
+
+    if model_dict["walltime_in_hours"] > 0 and "total_time" in prediction:
+        if prediction["total_time"] > model_dict["walltime_in_hours"] * 3600:
+            print ("=== WARNING ===\nThis model is expected to take about {0:.1f} hours to reach its maximum time, but "
+                   "the walltime is {1:.1f} hours. Make sure it checkpoints often enough to be restarted.".format(
+                       prediction["total_time"] / 3600, model_dict["walltime_in_hours"]))
+    sys.stdout.flush()
+
+
+def check_material_layout(model_dict):
+    """
+    Rasterize the material layout onto the model's elements, and refuse to
+    start if the shapes are broken (missing, empty, or leaving parts of the
+    model without a material). The layout is written to the output folder,
+    to look at in ParaView.
+    """
+    try:
+        layout = lmrLayout.rasterize(model_dict["input_xmls"].split(), model_dict["resolution"], model_dict["dims"])
+    except lmrGeotherm.ModelError as err:
+        print "=== WARNING ===\nUnable to check the material layout: {0}".format(err)
+        return
+    print "PREFLIGHT: checked the material layout of {0} elements in {1:.3f} seconds".format(
+        layout["index"].size, layout["seconds"])
+    for warning in layout["warnings"]:
+        print "=== WARNING ===\n{0}".format(warning)
+    try:
+        lmrLayout.write_layout(model_dict["output_path"], layout)
+    except (IOError, OSError) as err:
+        print "=== WARNING ===\nUnable to write the material layout to {0}: {1}".format(model_dict["output_path"], err)
+    sys.stdout.flush()
+    if layout["problems"]:
+        raise ValueError("=== ERROR ===\nThe material layout in lmrMaterials.xml is broken:\n  - {0}\nSee "
+                         "MaterialLayout.png in {1}. To launch it anyway, set <preflight_check> to false in "
+                         "lmrStart.xml.".format("\n  - ".join(layout["problems"]), model_dict["output_path"]))
+
+
+def measure_checkpoint_costs(path):
+    """
+    Work out from the files already in an output folder how long Underworld
+    takes to write a checkpoint, and how long a timestep takes (in wall
+    clock seconds, and in model years).
+
+    A checkpoint's write time is the spread of the modification times of its
+    files (scaled up, since the first file was already written when it got
+    its time). The time per timestep is the gap between one checkpoint
+    finishing and the next one starting, over the steps in between. Medians
+    are used, so restarts don't throw the numbers out.
+    Returns None if there aren't at least two checkpoints.
+    """
+    def median(values):
+        values = sorted(values)
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+    checkpoints = {}
+    for filename in glob.glob(os.path.join(path, "*.[0-9][0-9][0-9][0-9][0-9].*")):
+        parts = os.path.basename(filename).split(".")
+        if len(parts) < 3 or not parts[-2].isdigit() or parts[-1] not in ("h5", "xmf") or parts[0] == "Mesh":
+            continue
+        try:
+            checkpoints.setdefault(int(parts[-2]), []).append(os.path.getmtime(filename))
+        except OSError:
+            pass
+
+    steps = sorted(step for step in checkpoints if step > 0 and len(checkpoints[step]) > 1)
+    if len(steps) < 2:
+        return None
+
+    write_times = []
+    for step in steps:
+        times = checkpoints[step]
+        write_times.append((max(times) - min(times)) * len(times) / (len(times) - 1))
+
+    step_times = []
+    for previous, step in zip(steps[:-1], steps[1:]):
+        gap = min(checkpoints[step]) - max(checkpoints[previous])
+        if gap > 0:
+            step_times.append(gap / (step - previous))
+    if not step_times:
+        return None
+
+    last_step, last_time = read_last_frequent_output(path)
+    return {"checkpoints": len(steps),
+            "write_time": median(write_times),
+            "seconds_per_step": median(step_times),
+            "years_per_step": last_time / SECONDS_PER_YEAR / last_step if last_step > 0 else 0.0}
+
+
+def adapt_checkpoint_interval(model_dict):
+    """
+    Choose the checkpoint interval from the measured checkpoint write time C
+    and the mean time between failures M, using Daly's optimum
+        T = sqrt(2CM) - C
+    limited so that no more than max_lost_work_in_hours is lost in a crash,
+    and no more than max_checkpoint_overhead of the run goes on checkpoints.
+    The new interval replaces every_x_years and every_x_timesteps for this run.
+    """
+    costs = measure_checkpoint_costs(model_dict["output_path"])
+    if costs is None:
+        print ("CHECKPOINTS: adaptive checkpointing needs at least two checkpoints in {0} to measure from. "
+               "Using the intervals in lmrStart.xml for now.".format(model_dict["output_path"]))
+        return
+
+    write_time = max(costs["write_time"], 1e-3)
+    mtbf = model_dict["mean_time_between_failures_in_hours"] * 3600
+    max_lost_work = model_dict["max_lost_work_in_hours"] * 3600
+    min_interval = write_time / model_dict["max_checkpoint_overhead"]
+
+    if write_time < 2 * mtbf:
+        interval = math.sqrt(2 * write_time * mtbf) - write_time
+    else:
+        interval = mtbf
+    interval = max(interval, min_interval)
+    if interval > max_lost_work:
+        if min_interval > max_lost_work:
+            print ("=== WARNING ===\nCheckpoints take {0:.0f} s to write, so keeping the checkpoint overhead under "
+                   "{1:.0%} means losing up to {2:.1f} hours in a crash, more than max_lost_work_in_hours. Favouring "
+                   "less lost work.".format(write_time, model_dict["max_checkpoint_overhead"], min_interval / 3600))
+        interval = max_lost_work
+
+    steps = max(1, int(round(interval / costs["seconds_per_step"])))
+    model_dict["checkpoint_every_x_steps"] = steps
+    if costs["years_per_step"] > 0:
+        model_dict["checkpoint_every_x_years"] = steps * costs["years_per_step"]
+
+    overhead = write_time / (interval + write_time)
+    expected_loss = (interval + write_time) / 2 / mtbf
+    print ("CHECKPOINTS: measured {write:.1f} s to write a checkpoint and {step:.2f} s per timestep, from {n} checkpoints.\n"
+           "    Checkpointing every {steps} timesteps (~{years:.4g} years, {hours:.2f} hours).\n"
+           "    Expected overhead: {overhead:.1%} writing checkpoints, {loss:.1%} lost to failures.").format(
+               write=write_time, step=costs["seconds_per_step"], n=costs["checkpoints"], steps=steps,
+               years=model_dict["checkpoint_every_x_years"], hours=interval / 3600, overhead=overhead, loss=expected_loss)
+
+    costs.update({"date": datetime.datetime.now().isoformat(),
+                  "interval_seconds": interval,
+                  "checkpoint_every_x_steps": steps,
+                  "checkpoint_every_x_years": model_dict["checkpoint_every_x_years"],
+                  "expected_checkpoint_overhead": overhead,
+                  "expected_failure_loss": expected_loss})
+    with open(os.path.join(model_dict["output_path"], "checkpoint_interval.txt"), "a") as record:
+        record.write(json.dumps(costs, sort_keys=True) + "\n")
+
+
+def find_last_timestep(path, scratch_path=None):
+    """
+    Return the last timestep checkpointed in path. When checkpoints are being
+    staged, the newest may still be in scratch_path, so look there too.
+    """
+    search_paths = [path] if scratch_path is None or scratch_path == path else [path, scratch_path]
     try:
         # The below line does this:
         #   1) Get the base filename
         #   2) The filename is then split by '.', as the file we're looking for looks like this: VelocityField.00475.h5
         #   3) The second last chunk of the file name (the timestep number) is taken, and converted to int.
         #   4) Get the largest timestep
-        last_ts = max( [int(os.path.basename(filename).split(".")[-2]) for filename in glob.glob(os.path.join(path, "VelocityField.*.h5"))] )
+        last_ts = max( [int(os.path.basename(filename).split(".")[-2]) for search_path in search_paths
+                        for filename in glob.glob(os.path.join(search_path, "VelocityField.*.h5"))] )
     except ValueError:  # You should really catch explicit exceptions...
         if not os.path.isdir(path):
             error_msg = ("\n=== ERROR ===\nThe LMR is looking for folder:\n'{path}'\n"
@@ -528,6 +1958,476 @@ def find_last_timestep(path):
     return last_ts
 
 
+def read_recorded_checksums(path):
+    """
+    The checksums the CheckpointMover recorded in checkpoint_checksums.txt, by file name.
+    """
+    checksums = {}
+    try:
+        with open(os.path.join(path, "checkpoint_checksums.txt")) as record:
+            for line in record:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short when a run was killed.
+                checksums[entry["file"]] = entry
+    except IOError:
+        pass
+    return checksums
+
+
+def inspect_checkpoint_file(args):
+    """
+    Check a checkpoint file is the size and checksum it was written with (if
+    recorded), and that it opens and can be read to the end (if h5py is
+    available). Returns (filename, {dataset: shape}, problem), where problem
+    is None if the file is fine. Run in worker processes by checkpoint_problems.
+    """
+    filename, recorded = args
+    try:
+        size = os.path.getsize(filename)
+        if size == 0:
+            return filename, None, "{0} is empty".format(filename)
+        if recorded is not None:
+            if size != recorded["size"]:
+                return filename, None, "{0} is {1} bytes, but {2} were written".format(filename, size, recorded["size"])
+            sha1 = hashlib.sha1()
+            with open(filename, "rb") as data:
+                for chunk in iter(lambda: data.read(4 * 1024 ** 2), b""):
+                    sha1.update(chunk)
+            if sha1.hexdigest() != recorded["sha1"]:
+                return filename, None, "{0} does not match the checksum recorded when it was written".format(filename)
+
+        shapes = {}
+        if have_h5py:
+            with h5py.File(filename, "r") as h5file:
+                for name, dataset in h5file.items():
+                    if isinstance(dataset, h5py.Dataset):
+                        shapes[name] = dataset.shape
+                        if dataset.shape and dataset.shape[0] > 0:
+                            dataset[-1]  # Reading the last row catches files cut short.
+        return filename, shapes, None
+    except Exception as err:  # A damaged HDF5 file can raise all sorts of errors.
+        return filename, None, "{0} can't be read ({1})".format(filename, err)
+
+
+def checkpoint_problems(path, scratch_path, timestep, processes=None):
+    """
+    Check that every file Underworld needs to restart from timestep is there
+    and readable, checking the files in parallel. Returns a list of
+    problems, which is empty if the checkpoint is fine.
+
+    The files needed are those written at any of the last three checkpoints
+    (a checkpoint cut short has fewer). Mesh fields must have the same
+    shapes as in the first checkpoint.
+    """
+    search_paths = [path] if scratch_path is None or scratch_path == path else [path, scratch_path]
+
+    def files_at(step):
+        # Prefer the result folder, for files the CheckpointMover has already moved out of scratch.
+        found = {}
+        for search_path in reversed(search_paths):
+            for filename in glob.glob(os.path.join(search_path, "*.{0:05d}.h5".format(step))):
+                if not os.path.basename(filename).startswith("Mesh."):
+                    found[os.path.basename(filename)] = filename
+        return found
+
+    steps = sorted(set(checkpoint_io.step_of(filename) for search_path in search_paths
+                       for filename in glob.glob(os.path.join(search_path, "VelocityField.*.h5"))))
+    required = set(".".join(name.split(".")[:-2]) for step in steps[-3:] for name in files_at(step))
+    files = files_at(timestep)
+    problems = ["{0}.{1:05d}.h5 is missing".format(prefix, timestep)
+                for prefix in sorted(required) if "{0}.{1:05d}.h5".format(prefix, timestep) not in files]
+
+    reference = files_at(steps[0]) if steps and steps[0] != timestep else {}
+    checksums = read_recorded_checksums(path)
+    jobs = [(filename, checksums.get(name)) for name, filename in sorted(files.items())]
+    jobs += [(filename, None) for name, filename in sorted(reference.items())]
+
+    pool = multiprocessing.Pool(max(1, min(processes or multiprocessing.cpu_count(), len(jobs))))
+    try:
+        results = dict((filename, (shapes, problem)) for filename, shapes, problem
+                       in pool.imap_unordered(inspect_checkpoint_file, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+    for name, filename in sorted(files.items()):
+        shapes, problem = results[filename]
+        if problem:
+            problems.append(problem)
+            continue
+        reference_name = "{0}.{1:05d}.h5".format(".".join(name.split(".")[:-2]), steps[0])
+        if "Swarm" in name or reference_name not in reference:
+            continue  # Swarms change size as particles move between cells.
+        reference_shapes = results[reference[reference_name]][0] or {}
+        for dataset, shape in sorted(reference_shapes.items()):
+            if shapes.get(dataset, shape) != shape:
+                problems.append("{0} has {1} of shape {2}, but {3} has {4}".format(
+                    filename, dataset, shapes[dataset], reference_name, shape))
+    return problems
+
+
+def find_last_valid_timestep(path, scratch_path=None):
+    """
+    Like find_last_timestep, but skips checkpoints that are incomplete or
+    damaged, e.g. because the run was killed while writing them.
+    """
+    find_last_timestep(path, scratch_path)  # Gives a helpful error if there are no checkpoints at all.
+    search_paths = [path] if scratch_path is None or scratch_path == path else [path, scratch_path]
+    steps = sorted(set(checkpoint_io.step_of(filename) for search_path in search_paths
+                       for filename in glob.glob(os.path.join(search_path, "VelocityField.*.h5"))), reverse=True)
+    for step in steps:
+        problems = checkpoint_problems(path, scratch_path, step)
+        if not problems:
+            print "CHECKPOINT: timestep {0} is complete and readable".format(step)
+            return step
+        print "=== WARNING ===\nNot restarting from timestep {0}, the checkpoint is damaged:\n  {1}".format(
+            step, "\n  ".join(problems))
+    raise ValueError("=== ERROR ===\nNone of the checkpoints in {0} can be restarted from.".format(path))
+
+
+def break_hard_links(path):
+    """
+    Give every hard linked file under path its own copy again, so writing
+    to it doesn't change the other files it is linked to.
+    """
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            linked = os.path.join(root, filename)
+            if os.path.islink(linked) or os.stat(linked).st_nlink < 2:
+                continue
+            shutil.copy2(linked, linked + ".unlinked")
+            os.rename(linked + ".unlinked", linked)
+
+
+def copy_verified(source, destination):
+    """
+    Copy a file, check the copy reads back identically, and return its SHA-1.
+    The copy only appears under its real name once it has been checked.
+    """
+    partial = destination + ".partial"
+    source_hash = hashlib.sha1()
+    with open(source, "rb") as src:
+        with open(partial, "wb") as dst:
+            for chunk in iter(lambda: src.read(4 * 1024 ** 2), b""):
+                source_hash.update(chunk)
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+    copy_hash = hashlib.sha1()
+    with open(partial, "rb") as dst:
+        for chunk in iter(lambda: dst.read(4 * 1024 ** 2), b""):
+            copy_hash.update(chunk)
+    if copy_hash.hexdigest() != source_hash.hexdigest():
+        os.remove(partial)
+        raise IOError("The copy of {0} to {1} does not match the original".format(source, destination))
+
+    shutil.copystat(source, partial)
+    os.rename(partial, destination)
+    return source_hash.hexdigest()
+
+
+def stage_restart_files(output_path, scratch_path, restart_timestep):
+    """
+    Underworld can only restart from checkpoints in its own output folder, so
+    copy the restart checkpoint (and the files that go with every timestep)
+    back from the result folder into scratch, if they aren't there already.
+    """
+    if not os.path.isdir(scratch_path):
+        os.makedirs(scratch_path)
+    for filename in os.listdir(output_path):
+        source = os.path.join(output_path, filename)
+        step = checkpoint_io.step_of(filename)
+        if not os.path.isfile(source) or (step is not None and step != restart_timestep and not filename.startswith("Mesh.")):
+            continue
+        destination = os.path.join(scratch_path, filename)
+        if not os.path.exists(destination):
+            copy_verified(source, destination)
+
+
+class CheckpointMover(threading.Thread):
+    """
+    Moves checkpoints from the scratch folder Underworld writes into, to the
+    result folder, in the background.
+
+    A timestep's checkpoint is complete once files of a later timestep have
+    appeared. Complete checkpoints are copied, verified, recorded in
+    checkpoint_checksums.txt, and deleted from scratch. Files that don't
+    belong to a timestep (FrequentOutput.dat, XDMF files, the mesh) are
+    copied whenever they change, and left in scratch.
+    When the run is over, finish() moves everything that is left, and removes
+    the scratch folder once it is empty.
+    """
+    poll_interval = 10
+
+    def __init__(self, scratch_path, output_path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scratch_path = scratch_path
+        self.output_path = output_path
+        self.finished = threading.Event()
+        self.synced = {}
+
+    def run(self):
+        while not self.finished.wait(self.poll_interval):
+            try:
+                self.move(final=False)
+            except (IOError, OSError) as err:
+                print "=== WARNING ===\nProblem moving checkpoints from {0}: {1}. Will try again.".format(self.scratch_path, err)
+
+    def move(self, final):
+        files = [filename for filename in os.listdir(self.scratch_path)
+                 if os.path.isfile(os.path.join(self.scratch_path, filename)) and not filename.endswith(".partial")]
+        steps = [checkpoint_io.step_of(filename) for filename in files]
+        newest = max([step for step in steps if step is not None] or [None])
+
+        checksums = []
+        for filename, step in zip(files, steps):
+            source = os.path.join(self.scratch_path, filename)
+            destination = os.path.join(self.output_path, filename)
+            if step is None or filename.startswith("Mesh."):
+                stat = os.stat(source)
+                if self.synced.get(filename) != (stat.st_size, stat.st_mtime) or final:
+                    copy_verified(source, destination)
+                    self.synced[filename] = (stat.st_size, stat.st_mtime)
+            elif final or step < newest:
+                checksums.append({"file": filename, "size": os.path.getsize(source),
+                                  "sha1": copy_verified(source, destination)})
+                os.remove(source)
+
+        if checksums:
+            with open(os.path.join(self.output_path, "checkpoint_checksums.txt"), "a") as record:
+                for entry in checksums:
+                    record.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def finish(self):
+        self.finished.set()
+        self.join()
+        try:
+            self.move(final=True)
+            # The files that don't belong to a timestep were copied, but left in scratch.
+            for filename in self.synced:
+                if os.path.isfile(os.path.join(self.scratch_path, filename)):
+                    os.remove(os.path.join(self.scratch_path, filename))
+            left = os.listdir(self.scratch_path)
+            if left:
+                print "=== WARNING ===\n{0} file(s) weren't moved, so are still in {1}: {2}".format(
+                    len(left), self.scratch_path, ", ".join(sorted(left)))
+            else:
+                os.rmdir(self.scratch_path)
+        except (IOError, OSError) as err:
+            print ("=== WARNING ===\nProblem moving the last checkpoints from {0} to {1}: {2}\n"
+                   "Anything left is still in {0}.").format(self.scratch_path, self.output_path, err)
+
+
+class CheckpointHooks(threading.Thread):
+    """
+    Runs the <checkpoint_hooks> on each checkpoint in the result folder once
+    it is complete (files of a later timestep have appeared, and with
+    <scratch_directory>, the CheckpointMover has moved it), while Underworld
+    is still running.
+
+    The hooks run in a pool of low priority worker processes. No more than
+    hook_workers are given out at once, and only while the load average
+    leaves a core idle, so they never compete with Underworld; the rest wait
+    here. When the run is over, finish() runs whatever is left on every core,
+    or if Underworld didn't finish, abort() stops them.
+    """
+    poll_interval = 10
+
+    def __init__(self, model_dict):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.hooks = model_dict["checkpoint_hooks"]
+        self.workers = max(1, model_dict["hook_workers"])
+        self.output_path = model_dict["output_path"]
+        self.uw_output_path = model_dict["uw_output_path"]
+        self.record_file = os.path.join(self.output_path, "checkpoint_hooks.jsonl")
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.failed = 0
+        self.given_out = set()
+        self.pending = []
+        # The workers say which of them runs each hook, as a worker that dies never reports back.
+        self.started = SimpleQueue()
+        self.worker_of = {}
+
+        for hook in self.hooks:
+            if ":" not in hook and hook not in lmrHooks.BUILT_IN:
+                raise ValueError("=== ERROR ===\nThere is no built-in checkpoint hook called '{0}' in <checkpoint_hooks> "
+                                 "(there are: {1}). Hooks of your own are written as module:function.".format(
+                                     hook, ", ".join(sorted(lmrHooks.BUILT_IN))))
+        # Hooks that already succeeded before a restart aren't run again.
+        try:
+            with open(self.record_file) as record:
+                for line in record:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("status") == "ok":
+                        self.given_out.add((entry["timestep"], entry["hook"]))
+        except IOError:
+            pass
+        self.done_before = len(self.given_out)
+
+        try:
+            self.cores = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.cores = 1
+        # Started before Underworld, so the workers aren't forked from a process with its threads running.
+        self.pool = multiprocessing.Pool(self.workers, initializer=lmrHooks.lower_priority, initargs=(self.started,))
+
+    def run(self):
+        while not self.finished.wait(self.poll_interval):
+            try:
+                self.dispatch(final=False)
+            except (IOError, OSError) as err:
+                print "=== WARNING ===\nProblem looking for checkpoints for the hooks in {0}: {1}. Will try again.".format(
+                    self.output_path, err)
+
+    def complete_steps(self, final):
+        def steps_in(path):
+            return set(step for step in (checkpoint_io.step_of(filename) for filename in os.listdir(path)
+                                         if filename.endswith(".h5") and not filename.startswith("Mesh."))
+                       if step is not None)
+        steps = steps_in(self.output_path)
+        if final:
+            return sorted(steps)
+        unmoved = steps_in(self.uw_output_path) if self.uw_output_path != self.output_path else set()
+        newest = max(steps | unmoved or [None])
+        return sorted(step for step in steps if step < newest and step not in unmoved)
+
+    def idle_core(self):
+        try:
+            return os.getloadavg()[0] + 1 <= self.cores
+        except (AttributeError, OSError):
+            return True
+
+    def dispatch(self, final):
+        """
+        Give out the hooks of the complete checkpoints that haven't been run,
+        oldest first, as long as there is room.
+        """
+        self.note_started()
+        for step in self.complete_steps(final):
+            for hook in self.hooks:
+                if (step, hook) in self.given_out:
+                    continue
+                with self.lock:
+                    if not final and (self.running >= self.workers or not self.idle_core()):
+                        return
+                    self.running += 1
+                self.given_out.add((step, hook))
+                self.pending.append((step, hook, self.pool.apply_async(lmrHooks.run, (hook, self.output_path, step),
+                                                                       callback=self.record)))
+
+    def record(self, entry):
+        # Called on the pool's result thread.
+        with self.lock:
+            self.running -= 1
+            if entry["status"] != "ok":
+                self.failed += 1
+            with open(self.record_file, "a") as record:
+                record.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def note_started(self):
+        # Read often enough that the workers never block on a full pipe.
+        while not self.started.empty():
+            hook, step, pid = self.started.get()
+            self.worker_of[(step, hook)] = pid
+
+    def worker_died(self, step, hook):
+        pid = self.worker_of.get((step, hook))
+        if pid is None:
+            return False  # Not started yet.
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        return False
+
+    def wait(self):
+        """
+        Wait for the hooks given out to finish, and close the pool. A hook
+        whose worker died (e.g. killed for using too much memory) is recorded
+        as failed, as the pool never gives it to another.
+        """
+        self.pool.close()
+        lost = []
+        suspects = set()
+        while True:
+            self.note_started()
+            pending = [item for item in self.pending if not item[2].ready() and item not in lost]
+            if not pending:
+                break
+            # Only once it is seen twice, as a worker may have just exited after finishing its last hook.
+            dead = set((step, hook) for step, hook, _ in pending if self.worker_died(step, hook))
+            for item in pending:
+                if item[:2] in dead & suspects:
+                    lost.append(item)
+                    self.record({"hook": item[1], "timestep": item[0], "status": "failed", "seconds": None,
+                                 "error": "Lost: its worker process died, e.g. killed for using too much memory"})
+            suspects = dead
+            pending[0][2].wait(1)
+        if lost:
+            print "=== WARNING ===\nThe worker process running {0} checkpoint hook(s) died.".format(len(lost))
+            self.pool.terminate()  # Otherwise the pool waits for their results forever.
+        self.pool.join()
+        self.pending = []
+
+    def finish(self):
+        """
+        Run the hooks on every checkpoint left, on every core now that
+        Underworld has finished.
+        """
+        self.finished.set()
+        self.join()
+        started = time.time()
+        self.wait()
+        self.pool = multiprocessing.Pool(max(self.workers, self.cores), initializer=lmrHooks.lower_priority,
+                                         initargs=(self.started,))
+        given_out = len(self.given_out)
+        try:
+            self.dispatch(final=True)
+        except (IOError, OSError) as err:
+            print "=== WARNING ===\nProblem running the hooks on the last checkpoints in {0}: {1}".format(self.output_path, err)
+        self.wait()
+        print "HOOKS: ran {0} hook(s) on the checkpoints ({1} after Underworld finished, taking {2:.0f} s), {3} failed. See {4}".format(
+            len(self.given_out) - self.done_before, len(self.given_out) - given_out, time.time() - started, self.failed, self.record_file)
+        sys.stdout.flush()
+
+    def abort(self):
+        """
+        Stop the hooks when Underworld didn't finish (it failed, or the run
+        was cancelled), and record the ones that didn't run as skipped, so
+        they are run after a restart.
+        """
+        self.finished.set()
+        self.join()
+        self.pool.terminate()
+        self.pool.join()
+        skipped = [(step, hook) for step, hook, result in self.pending if not result.ready()]
+        ran = len(self.given_out) - self.done_before - len(skipped)
+        try:
+            skipped += [(step, hook) for step in self.complete_steps(final=True) for hook in self.hooks
+                        if (step, hook) not in self.given_out]
+        except (IOError, OSError):
+            pass
+        with self.lock:
+            with open(self.record_file, "a") as record:
+                for step, hook in skipped:
+                    record.write(json.dumps({"hook": hook, "timestep": step, "status": "skipped", "seconds": None,
+                                             "error": "Underworld didn't finish"}, sort_keys=True) + "\n")
+        self.pending = []
+        print "HOOKS: ran {0} hook(s) on the checkpoints, {1} failed. Skipped {2}, as Underworld didn't finish. See {3}".format(
+            ran, self.failed, len(skipped), self.record_file)
+        sys.stdout.flush()
+
+
 def modify_initialcondition_xml(last_ts, xml_path, initial_condition_path):
     new_temp_file = os.path.join(initial_condition_path, "TemperatureField.{0:05d}.h5".format(last_ts))
     new_mesh_file = os.path.join(initial_condition_path, "Mesh.linearMesh.{0:05d}.h5".format(0)) # UW2.0 will only produce Meshfile 0
@@ -588,21 +2488,52 @@ def main():
     # STEP 2
     model_dict, command_dict = prepare_job(model_dict, command_dict)
 
+    if model_dict["memoized"]:
+        # An identical run has already finished, so there's nothing to do.
+        return
+
+    if model_dict["preflight_check"]:
+        check_material_layout(model_dict)
+
+    if model_dict["run_thermal_equilibration_phase"] and model_dict["use_1d_steady_state_solver"]:
+        # STEP 3, without Underworld
+        if solve_1d_geotherm(model_dict):
+            if model_dict["memoize_runs"]:
+                remember_run(model_dict, "complete")
+            return
+
+    if model_dict["preflight_check"]:
+        preflight_check(model_dict)
+
+    if model_dict["launch_profile"]:
+        apply_launch_profile(model_dict, command_dict)
+
     if model_dict["write_log_file"]:
         try:
-            log_file = open(model_dict["logfile"], "a")
+            if model_dict["compress_log_file"]:
+                log_file = CompressedLog(os.path.splitext(model_dict["logfile"])[0],
+                                         model_dict["log_segment_size"],
+                                         model_dict["log_console_summary"])
+            else:
+                log_file = open(model_dict["logfile"], "a")
             sys.stdout = log_file
         except IOError as err:
-            raise IOErrr("Problem writing to log file {log_file}! Computer says:\n{err}".format(log_file = model_dict["logfile"], err = err))
+            raise IOError("Problem writing to log file {log_file}! Computer says:\n{err}".format(log_file = model_dict["logfile"], err = err))
 
-    # STEP 3
-    run_model(model_dict, command_dict)
-
-    # STEP 4
-    post_model_run(model_dict)
-
-    if model_dict["write_log_file"]:
-        log_file.close()
+    try:
+        # STEP 3
+        run_model(model_dict, command_dict)
+
+        # STEP 4
+        post_model_run(model_dict)
+
+        if model_dict["memoize_runs"]:
+            remember_run(model_dict, "complete" if run_finished(model_dict) else "started")
+    finally:
+        # Even if the run failed, as that's the log most worth reading.
+        if model_dict["write_log_file"]:
+            sys.stdout = sys.__stdout__
+            log_file.close()
 
 
 if __name__ == '__main__':
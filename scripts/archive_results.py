@@ -0,0 +1,253 @@
+"""
+=================
+ Archive results
+=================
+
+Packs a finished result_* (or initial-condition_*) folder into a few large
+files, which are far quicker to copy over a network filesystem or to tape
+than tens of thousands of small .h5 and .xmf files.
+
+An archive called, say, reference_model is made of:
+    reference_model.00000.tar, reference_model.00001.tar, ...
+        Uncompressed tar files (volumes) of at most --volume_size GB each.
+        They are ordinary tar files, so can be unpacked with tar if needed.
+    reference_model.catalog.json
+        Where each file is in the volumes (volume, byte offset, size), its
+        SHA-1, and which timestep and field it belongs to.
+
+The catalog lets single files and timesteps be read straight out of the
+volumes without unpacking anything else.
+
+Run by:
+    python archive_results.py pack <result folder> <archive name>
+    python archive_results.py list <archive name>
+    python archive_results.py extract <archive name> <timestep> <destination folder>
+    python archive_results.py unpack <archive name> <destination folder>
+
+For example:
+    python archive_results.py pack result_208x96x0_reference_model /archive/reference_model
+    python archive_results.py extract /archive/reference_model 1200 ./step_1200 --fields VelocityField TemperatureField
+    python archive_results.py unpack /archive/reference_model result_208x96x0_reference_model
+
+extract always includes the mesh (Mesh.*), since the fields can't be read
+without it. unpack restores the folder exactly as it was, so a model can be
+restarted from it.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tarfile
+
+import checkpoint_io
+
+
+CHUNK_SIZE = 4 * 1024 ** 2
+
+
+def sha1_of(fileobj, size):
+    sha1 = hashlib.sha1()
+    remaining = size
+    while remaining > 0:
+        chunk = fileobj.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        sha1.update(chunk)
+        remaining -= len(chunk)
+    return sha1.hexdigest()
+
+
+def catalog_filename(archive):
+    return archive + ".catalog.json"
+
+
+def volume_filename(archive, volume):
+    return "{0}.{1:05d}.tar".format(archive, volume)
+
+
+def load_catalog(archive):
+    try:
+        with open(catalog_filename(archive)) as catalog_file:
+            return json.load(catalog_file)
+    except IOError:
+        sys.exit("ERROR - Can't find the archive catalog {0}".format(catalog_filename(archive)))
+
+
+def pack(result_dir, archive, volume_size):
+    names = []
+    for root, dirs, files in os.walk(result_dir):
+        dirs.sort()
+        for filename in files:
+            names.append(os.path.relpath(os.path.join(root, filename), result_dir))
+
+    # Timestep order keeps each checkpoint together in one place in the volumes.
+    def order(name):
+        step = checkpoint_io.step_of(name)
+        return (-1 if step is None else step, name)
+    names.sort(key=order)
+
+    entries = []
+    volume = -1
+    tar = None
+    for name in names:
+        path = os.path.join(result_dir, name)
+        size = os.path.getsize(path)
+        if tar is None or (tar.fileobj.tell() > 0 and tar.fileobj.tell() + size > volume_size):
+            if tar is not None:
+                tar.close()
+            volume += 1
+            tar = tarfile.open(volume_filename(archive, volume), "w", format=tarfile.PAX_FORMAT)
+
+        info = tar.gettarinfo(path, arcname=name)
+        with open(path, "rb") as source:
+            tar.addfile(info, source)
+        # The data ends (padded to a whole block) where the tar file is now up to.
+        blocks = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+        offset = tar.offset - blocks * tarfile.BLOCKSIZE
+        with open(path, "rb") as source:
+            sha1 = sha1_of(source, size)
+
+        step = checkpoint_io.step_of(name)
+        entries.append({"name": name,
+                        "volume": volume,
+                        "offset": offset,
+                        "size": size,
+                        "mtime": info.mtime,
+                        "sha1": sha1,
+                        "timestep": step,
+                        "field": checkpoint_io.field_of(name) if step is not None else None})
+    if tar is not None:
+        tar.close()
+
+    catalog = {"source": os.path.basename(os.path.normpath(result_dir)),
+               "volumes": [os.path.basename(volume_filename(archive, number)) for number in range(volume + 1)],
+               "files": entries}
+    with open(catalog_filename(archive) + ".partial", "w") as catalog_file:
+        json.dump(catalog, catalog_file, indent=1, sort_keys=True)
+    os.rename(catalog_filename(archive) + ".partial", catalog_filename(archive))
+
+    total = sum(entry["size"] for entry in entries)
+    print("Packed {0} files ({1:.1f} MB) from {2} into {3} volume(s) of {4}".format(
+        len(entries), total / 1024.0 ** 2, result_dir, volume + 1, archive))
+
+
+def list_archive(archive):
+    catalog = load_catalog(archive)
+    steps = {}
+    others = []
+    for entry in catalog["files"]:
+        if entry["timestep"] is None:
+            others.append(entry)
+        else:
+            steps.setdefault(entry["timestep"], []).append(entry)
+
+    print("{0}: {1} files in {2} volume(s)".format(catalog["source"], len(catalog["files"]), len(catalog["volumes"])))
+    for entry in others:
+        print("    {0:<40} {1:>12d} bytes".format(entry["name"], entry["size"]))
+    for step in sorted(steps):
+        size = sum(entry["size"] for entry in steps[step])
+        fields = sorted(entry["field"] for entry in steps[step])
+        print("Timestep {0:>6d} {1:>12d} bytes  {2}".format(step, size, " ".join(fields)))
+
+
+def copy_out(archive, catalog, entry, destination_dir):
+    """
+    Copy one file out of its volume, by seeking straight to it, and check its SHA-1.
+    """
+    destination = os.path.join(destination_dir, entry["name"])
+    if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+
+    volume = os.path.join(os.path.dirname(os.path.abspath(archive)), catalog["volumes"][entry["volume"]])
+    sha1 = hashlib.sha1()
+    with open(volume, "rb") as source:
+        source.seek(entry["offset"])
+        with open(destination + ".partial", "wb") as target:
+            remaining = entry["size"]
+            while remaining > 0:
+                chunk = source.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                target.write(chunk)
+                remaining -= len(chunk)
+
+    if sha1.hexdigest() != entry["sha1"]:
+        os.remove(destination + ".partial")
+        raise IOError("{0} in {1} is damaged (SHA-1 mismatch)".format(entry["name"], volume))
+    os.rename(destination + ".partial", destination)
+    os.utime(destination, (entry["mtime"], entry["mtime"]))
+
+
+def extract(archive, timestep, destination_dir, fields):
+    catalog = load_catalog(archive)
+    wanted = [entry for entry in catalog["files"] if entry["timestep"] == timestep
+              and not entry["field"].startswith("Mesh.") and (not fields or entry["field"] in fields)]
+    if not wanted:
+        sys.exit("ERROR - Timestep {0} is not in {1}".format(timestep, archive))
+    # A deforming mesh is written again at every checkpoint, so only the latest at or before the timestep
+    # applies to it, as in checkpoint_io.mesh_file().
+    meshes = {}
+    for entry in catalog["files"]:
+        if entry["timestep"] is not None and entry["timestep"] <= timestep and entry["field"].startswith("Mesh.") \
+                and entry["timestep"] >= meshes.get(entry["field"], entry)["timestep"]:
+            meshes[entry["field"]] = entry
+    wanted += sorted(meshes.values(), key=lambda entry: entry["name"])
+    for entry in wanted:
+        copy_out(archive, catalog, entry, destination_dir)
+    print("Extracted {0} files into {1}".format(len(wanted), destination_dir))
+
+
+def unpack(archive, destination_dir):
+    catalog = load_catalog(archive)
+    for entry in catalog["files"]:
+        copy_out(archive, catalog, entry, destination_dir)
+    print("Unpacked {0} files into {1}".format(len(catalog["files"]), destination_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack LMR result folders into indexed archives, and read them back.")
+    commands = parser.add_subparsers(dest="command")
+
+    pack_parser = commands.add_parser("pack", help="Pack a result folder into an archive.")
+    pack_parser.add_argument("result_dir")
+    pack_parser.add_argument("archive", help="Archive name, e.g. /archive/reference_model")
+    pack_parser.add_argument("--volume_size", type=float, default=16,
+                             help="Largest volume size, in GB. Default 16.")
+
+    list_parser = commands.add_parser("list", help="List the timesteps and fields in an archive.")
+    list_parser.add_argument("archive")
+
+    extract_parser = commands.add_parser("extract", help="Extract one timestep (and the mesh).")
+    extract_parser.add_argument("archive")
+    extract_parser.add_argument("timestep", type=int)
+    extract_parser.add_argument("destination_dir")
+    extract_parser.add_argument("--fields", nargs="+",
+                                help="Only these fields, e.g. VelocityField materialSwarm. Default all.")
+
+    unpack_parser = commands.add_parser("unpack", help="Unpack a whole archive back to the original folder layout.")
+    unpack_parser.add_argument("archive")
+    unpack_parser.add_argument("destination_dir")
+
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        if not os.path.isdir(args.result_dir):
+            sys.exit("ERROR - {0} is not a folder".format(args.result_dir))
+        pack(args.result_dir, args.archive, int(args.volume_size * 1024 ** 3))
+    elif args.command == "list":
+        list_archive(args.archive)
+    elif args.command == "extract":
+        extract(args.archive, args.timestep, args.destination_dir, args.fields)
+    elif args.command == "unpack":
+        unpack(args.archive, args.destination_dir)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,389 @@
+"""
+============
+ Batch jobs
+============
+
+Writes SLURM or PBS batch scripts for a whole study (one or more models, and
+any sweep of values over them), so it takes one submission rather than one
+hand-written script per model.
+
+Each model gets a thermal equilibration job and a mechanical job. Jobs that
+need the same resources are grouped into array jobs, and the mechanical
+arrays only start once the thermal arrays they need have finished
+successfully. Models that share a thermal equilibration (e.g. a sweep of
+velocities) share one thermal job.
+
+The CPUs come from each model's lmrStart.xml, the nodes from how many cores
+a node has (--cores_per_node), and the walltime from <walltime_in_hours>, or
+if that's 0, from the estimate lmrRunModel.py's preflight check makes from
+previous runs (plus a margin), or else --default_walltime. A thermal phase
+solved by <use_1d_steady_state_solver> only needs one CPU for a few minutes.
+
+Run by:
+    python batch_jobs.py write ~/models/rift_*/lmrStart.xml --study_dir rift_study --scheduler slurm
+    rift_study/submit.sh
+
+A sweep writes a start XML for each combination of values (the descriptions
+get the values added, so results don't overwrite each other), e.g.:
+    python batch_jobs.py write lmrStart.xml --study_dir velocities \
+        --sweep Underworld_Execution/CPUs=8,16 --sweep Output_Controls/description=slow,fast
+
+Fixed overrides (-o PATH=VALUE) work as for job_daemon.py.
+
+To try a study out without a cluster, the stand-in scheduler runs the scripts
+directly, in dependency order, with the array index set as the scheduler
+would (a failed job stops the jobs that depend on it):
+    python batch_jobs.py run_local rift_study [--processes 4]
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+
+from xml.etree import ElementTree
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+LMR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LMR_DIR)
+
+import lmrRunModel  # noqa: E402
+
+LMR_NAMESPACE = "https://bitbucket.org/lmondy/lithosphericmodellingrecipe"
+
+# The scheduler directives. Everything after them is the same for both.
+HEADERS = {
+    "slurm": ("#!/bin/bash\n"
+              "#SBATCH --job-name={name}\n"
+              "#SBATCH --nodes={nodes}\n"
+              "#SBATCH --ntasks={cpus}\n"
+              "#SBATCH --time={walltime}\n"
+              "#SBATCH --array=0-{last_task}\n"
+              "#SBATCH --output={log_dir}/{name}_%A_%a.out\n"
+              "{directives}"
+              "TASK=${{SLURM_ARRAY_TASK_ID:-0}}\n"),
+    "pbs": ("#!/bin/bash\n"
+            "#PBS -N {name}\n"
+            "#PBS -l select={nodes}:ncpus={cpus_per_node}:mpiprocs={cpus_per_node}\n"
+            "#PBS -l walltime={walltime}\n"
+            "{array}"
+            "#PBS -j oe\n"
+            "#PBS -o {log_dir}/\n"
+            "{directives}"
+            "TASK=${{PBS_ARRAY_INDEX:-0}}\n"),
+}
+
+BODY = ("set -e\n"
+        "# Each line of the task list is: <model folder> <tab> <start XML>\n"
+        "LINE=$(sed -n \"$((TASK + 1))p\" {task_list})\n"
+        "cd \"$(printf '%s' \"$LINE\" | cut -f1)\"\n"
+        "exec {python} {run_model} \"$(printf '%s' \"$LINE\" | cut -f2)\"\n")
+
+# How submit.sh submits an array, and makes it wait for others.
+SUBMIT = {
+    "slurm": {"command": "sbatch --parsable{depend} {script} | cut -d';' -f1",
+              "depend": " --dependency=afterok:{ids}"},
+    "pbs": {"command": "qsub{depend} {script}",
+            "depend": " -W depend=afterok:{ids}"},
+}
+
+# The array index variable the stand-in scheduler sets.
+TASK_VARIABLE = {"slurm": "SLURM_ARRAY_TASK_ID", "pbs": "PBS_ARRAY_INDEX"}
+
+
+def parse_overrides(overrides):
+    parsed = {}
+    for override in overrides:
+        if "=" not in override:
+            sys.exit("ERROR - Overrides look like PATH=VALUE, not {0}".format(override))
+        path, value = override.split("=", 1)
+        parsed[path.strip("/")] = value
+    return parsed
+
+
+def write_start_xml(start_xml, overrides, destination):
+    """
+    Write the start XML with the overrides applied.
+    """
+    ElementTree.register_namespace("lmr", LMR_NAMESPACE)
+    ElementTree.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    tree = ElementTree.parse(start_xml)
+    root = tree.getroot()
+    for path, value in sorted(overrides.items()):
+        element = root.find(path)
+        if element is None:
+            raise ValueError("The override {0} doesn't match anything in {1}".format(path, start_xml))
+        element.text = " {0} ".format(value)
+    tree.write(destination, encoding="UTF-8", xml_declaration=True)
+
+
+def variants(start_xml, fixed, sweeps):
+    """
+    The overrides for each combination of the sweep values. The values are
+    added to the description (and the thermal description, if a thermal
+    setting is swept), so each variant writes to its own folders.
+    """
+    root = ElementTree.parse(start_xml).getroot()
+
+    def text(path):
+        element = root.find(path)
+        return element.text.strip() if element is not None and element.text else ""
+
+    names = sorted(sweeps)
+    for values in itertools.product(*[sweeps[name] for name in names]):
+        overrides = dict(fixed)
+        overrides.update(zip(names, values))
+        for description, prefix in (("Output_Controls/description", ""),
+                                    ("Thermal_Equilibration/output_controls/description", "Thermal_Equilibration/")):
+            # A swept description is its own suffix; the other swept values are added to it.
+            swept = [(name, value) for name, value in zip(names, values)
+                     if name.startswith(prefix) and name != description]
+            if not swept:
+                continue
+            parts = [overrides.get(description, text(description))]
+            parts += [value if name.endswith("description") else name.split("/")[-1] + value
+                      for name, value in swept]
+            overrides[description] = "_".join(part for part in parts if part)
+        yield overrides
+
+
+def format_walltime(hours):
+    minutes = int(math.ceil(hours * 60))
+    return "{0:02d}:{1:02d}:00".format(minutes // 60, minutes % 60)
+
+
+def phase_resources(model_dict, thermal, cpus_per_node, default_walltime, history):
+    """
+    The CPUs, nodes and walltime (hours) one phase of a model needs.
+    """
+    if thermal and model_dict["use_1d_steady_state_solver"]:
+        return 1, 1, 0.25
+    try:
+        cpus = int(model_dict["cpus"])
+    except (KeyError, ValueError):
+        cpus = cpus_per_node
+    nodes = int(math.ceil(cpus / float(cpus_per_node)))
+
+    if model_dict["walltime_in_hours"] > 0:
+        return cpus, nodes, model_dict["walltime_in_hours"]
+    phase = dict(model_dict, run_thermal_equilibration_phase=thermal,
+                 dims=3 if model_dict["model_resolution"]["z"] > 0 else 2,
+                 resolution=model_dict["thermal_model_resolution" if thermal else "model_resolution"],
+                 max_time=model_dict["thermal_max_time" if thermal else "max_time"],
+                 max_timesteps=model_dict["thermal_max_timesteps" if thermal else "max_timesteps"])
+    phase["solver_type"] = "mumps" if lmrRunModel.uses_direct_solver(phase) else "multigrid"
+    prediction = lmrRunModel.predict_run(phase, cpus, history)
+    if prediction and "total_time" in prediction:
+        # A margin for the estimate, and for writing the last checkpoint.
+        return cpus, nodes, prediction["total_time"] * 1.5 / 3600 + 0.25
+    return cpus, nodes, default_walltime
+
+
+def plan_study(start_xmls, fixed, sweeps, study_dir, cpus_per_node, default_walltime):
+    """
+    The thermal and mechanical tasks of every model and variant, grouped
+    into arrays by the resources they need.
+    """
+    study_dir = os.path.abspath(study_dir)  # Each task runs from its model's folder.
+    xml_dir = os.path.join(study_dir, "xmls")
+    if not os.path.isdir(xml_dir):
+        os.makedirs(xml_dir)
+
+    thermal_tasks = {}  # The thermal output folder -> task, so models that share one share the job.
+    tasks = []
+    for model_number, start_xml in enumerate(start_xmls):
+        start_xml = os.path.abspath(start_xml)
+        cwd = os.path.dirname(start_xml)
+        history = lmrRunModel.load_run_history(os.path.join(cwd, "lmr_run_history.jsonl"))
+        for variant_number, overrides in enumerate(variants(start_xml, fixed, sweeps)):
+            for thermal in (True, False):
+                xml = os.path.join(xml_dir, "{0:03d}_{1:03d}_{2}.xml".format(
+                    model_number, variant_number, "thermal" if thermal else "mechanical"))
+                overrides["Thermal_Equilibration/run_thermal_equilibration_phase"] = "true" if thermal else "false"
+                write_start_xml(start_xml, overrides, xml)
+                model_dict, _ = lmrRunModel.process_xml(lmrRunModel.load_xml(xml, os.path.join(cwd, "LMR.xsd")))
+                thermal_folder = os.path.join(cwd, "initial-condition_{0}_{1}".format(
+                    lmrRunModel.get_textual_resolution(model_dict["thermal_model_resolution"]),
+                    model_dict["thermal_description"]))
+                if thermal and thermal_folder in thermal_tasks:
+                    os.remove(xml)
+                    continue
+                task = {"phase": "thermal" if thermal else "mechanical", "cwd": cwd, "xml": xml,
+                        "thermal_folder": thermal_folder,
+                        "resources": phase_resources(model_dict, thermal, cpus_per_node, default_walltime, history)}
+                if thermal:
+                    thermal_tasks[thermal_folder] = task
+                tasks.append(task)
+
+    arrays = []
+    for phase in ("thermal", "mechanical"):
+        groups = {}
+        for task in tasks:
+            if task["phase"] == phase:
+                groups.setdefault(task["resources"], []).append(task)
+        for resources, group in sorted(groups.items()):
+            name = "{0}_{1}_{2}".format(os.path.basename(study_dir), phase, len(arrays))
+            depends_on = []
+            if phase == "mechanical":
+                needed = set(task["thermal_folder"] for task in group)
+                depends_on = [array["name"] for array in arrays
+                              if array["phase"] == "thermal" and needed & set(array["thermal_folders"])]
+            arrays.append({"name": name, "phase": phase, "cpus": resources[0], "nodes": resources[1],
+                           "walltime": format_walltime(resources[2]),
+                           "tasks": [[task["cwd"], task["xml"]] for task in group],
+                           "thermal_folders": [task["thermal_folder"] for task in group],
+                           "depends_on": depends_on})
+    return arrays
+
+
+def write_study(study_dir, arrays, scheduler, cpus_per_node, directives):
+    """
+    Write a script and task list per array, submit.sh, and study.json (for
+    the stand-in scheduler).
+    """
+    study_dir = os.path.abspath(study_dir)
+    log_dir = os.path.join(study_dir, "logs")
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    prefix = "#SBATCH " if scheduler == "slurm" else "#PBS "
+    submit_lines = ["#!/bin/bash", "# Submits the whole study, in dependency order.", "set -e",
+                    "cd {0}".format(quote(study_dir))]
+    for array in arrays:
+        array["task_list"] = os.path.join(study_dir, array["name"] + ".tasks")
+        with open(array["task_list"], "w") as task_list:
+            for cwd, xml in array["tasks"]:
+                task_list.write("{0}\t{1}\n".format(cwd, xml))
+        array["script"] = os.path.join(study_dir, "{0}.{1}".format(array["name"], "slurm" if scheduler == "slurm" else "pbs"))
+        last_task = len(array["tasks"]) - 1
+        with open(array["script"], "w") as script:
+            script.write(HEADERS[scheduler].format(
+                name=array["name"], nodes=array["nodes"], cpus=array["cpus"], walltime=array["walltime"],
+                cpus_per_node=min(array["cpus"], cpus_per_node), last_task=last_task, log_dir=quote(log_dir),
+                array="#PBS -J 0-{0}\n".format(last_task) if last_task > 0 else "",
+                directives="".join(prefix + directive + "\n" for directive in directives)))
+            script.write(BODY.format(task_list=quote(array["task_list"]), python=quote(sys.executable),
+                                     run_model=quote(os.path.join(LMR_DIR, "lmrRunModel.py"))))
+        os.chmod(array["script"], 0o755)
+
+        depend = ""
+        if array["depends_on"]:
+            depend = SUBMIT[scheduler]["depend"].format(
+                ids=":".join("${{{0}}}".format(name) for name in array["depends_on"]))
+        submit_lines.append("{0}=$({1})".format(array["name"], SUBMIT[scheduler]["command"].format(
+            depend=depend, script=quote(os.path.basename(array["script"])))))
+        submit_lines.append('echo "{0}: ${{{0}}} ({1} task(s))"'.format(array["name"], len(array["tasks"])))
+
+    submit = os.path.join(study_dir, "submit.sh")
+    with open(submit, "w") as submit_file:
+        submit_file.write("\n".join(submit_lines) + "\n")
+    os.chmod(submit, 0o755)
+    with open(os.path.join(study_dir, "study.json"), "w") as study:
+        json.dump({"scheduler": scheduler, "arrays": arrays}, study, indent=1, sort_keys=True)
+    return submit
+
+
+def run_local(study_dir, processes):
+    """
+    The stand-in scheduler: run every task of every array, after the arrays
+    it depends on, with the array index set. Returns the number of failed
+    (or skipped) tasks.
+    """
+    with open(os.path.join(study_dir, "study.json")) as study_file:
+        study = json.load(study_file)
+    log_dir = os.path.join(study_dir, "logs")
+    succeeded = {}
+    failures = 0
+    for array in study["arrays"]:
+        blocked = [name for name in array["depends_on"] if not succeeded.get(name)]
+        if blocked:
+            print("{0}: not run, as {1} didn't finish successfully".format(array["name"], ", ".join(blocked)))
+            succeeded[array["name"]] = False
+            failures += len(array["tasks"])
+            continue
+
+        results = {}
+        lock = threading.Semaphore(max(1, processes))
+
+        def run_task(index):
+            with lock:
+                env = dict(os.environ)
+                env[TASK_VARIABLE[study["scheduler"]]] = str(index)
+                with open(os.path.join(log_dir, "{0}_local_{1}.out".format(array["name"], index)), "w") as log:
+                    results[index] = subprocess.call(["bash", array["script"]], stdout=log,
+                                                     stderr=subprocess.STDOUT, env=env)
+
+        threads = [threading.Thread(target=run_task, args=(index,)) for index in range(len(array["tasks"]))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = sorted(index for index, code in results.items() if code != 0)
+        succeeded[array["name"]] = not failed
+        failures += len(failed)
+        print("{0}: {1} of {2} task(s) succeeded{3}".format(
+            array["name"], len(array["tasks"]) - len(failed), len(array["tasks"]),
+            " (failed: {0}, see {1})".format(" ".join(str(index) for index in failed), log_dir) if failed else ""))
+        sys.stdout.flush()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write SLURM or PBS array jobs for a study of LMR models.")
+    commands = parser.add_subparsers(dest="command")
+
+    write = commands.add_parser("write", help="Write the batch scripts for a study.")
+    write.add_argument("start_xmls", nargs="+",
+                       help="The start XML (e.g. lmrStart.xml) of each model, in its model folder.")
+    write.add_argument("--study_dir", required=True,
+                       help="Where to write the scripts.")
+    write.add_argument("--scheduler", choices=sorted(HEADERS), default="slurm",
+                       help="Which scheduler to write scripts for. Default slurm.")
+    write.add_argument("--cores_per_node", type=int, default=lmrRunModel.detect_topology()["cores"],
+                       help="Cores on each compute node. Default: the cores on this computer.")
+    write.add_argument("--default_walltime", type=float, default=24.0,
+                       help="Walltime in hours for jobs with no <walltime_in_hours> and no estimate. Default 24.")
+    write.add_argument("-o", "--override", action="append", default=[], metavar="PATH=VALUE",
+                       help="Change a value in every start XML, e.g. Underworld_Execution/CPUs=8")
+    write.add_argument("--sweep", action="append", default=[], metavar="PATH=VALUE,VALUE,...",
+                       help="Run every model with each of these values.")
+    write.add_argument("--directive", action="append", default=[],
+                       help="An extra scheduler directive for every script, e.g. --directive='--account=ab12'.")
+    write.add_argument("--submit", action="store_true",
+                       help="Run submit.sh once the scripts are written.")
+
+    local = commands.add_parser("run_local", help="Run a study's scripts here, as a scheduler would.")
+    local.add_argument("study_dir")
+    local.add_argument("--processes", type=int, default=1,
+                       help="How many tasks of an array to run at once. Default 1.")
+    args = parser.parse_args()
+
+    if args.command == "run_local":
+        return 1 if run_local(args.study_dir, args.processes) else 0
+
+    sweeps = dict((path, values.split(",")) for path, values in parse_overrides(args.sweep).items())
+    try:
+        arrays = plan_study(args.start_xmls, parse_overrides(args.override), sweeps, args.study_dir,
+                            args.cores_per_node, args.default_walltime)
+    except (ValueError, IOError) as err:
+        sys.exit("ERROR - {0}".format(err))
+    submit = write_study(args.study_dir, arrays, args.scheduler, args.cores_per_node, args.directive)
+    for array in arrays:
+        print("{0}: {1} task(s), {2} CPUs on {3} node(s), walltime {4}{5}".format(
+            array["name"], len(array["tasks"]), array["cpus"], array["nodes"], array["walltime"],
+            ", after " + " ".join(array["depends_on"]) if array["depends_on"] else ""))
+    print("Submit the study with {0}".format(submit))
+    if args.submit:
+        return subprocess.call([submit])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
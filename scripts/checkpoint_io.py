@@ -0,0 +1,109 @@
+"""
+===============
+ Checkpoint IO
+===============
+
+Helpers shared by the scripts that read Underworld checkpoints from a
+result folder:
+    <Field>.NNNNN.h5           A mesh field at timestep NNNNN, in the dataset "data".
+    Mesh.linearMesh.NNNNN.h5   The mesh, in the dataset "vertices". Underworld
+                               only writes it again when the mesh deforms.
+    materialSwarm.NNNNN.h5     The material particles.
+
+Mesh nodes are ordered x fastest, then y, then z, so node (i, j, k) of a
+mesh with (nx, ny, nz) nodes is row i + nx * (j + ny * k).
+
+Not run directly, imported by the other scripts.
+"""
+
+import glob
+import os
+
+try:
+    import numpy as np
+    import h5py
+except ImportError:
+    np = None
+    h5py = None
+
+# Underworld's model times are in seconds.
+SECONDS_PER_YEAR = 3.15569e7
+
+
+def step_of(filename):
+    """
+    Return the timestep of a file like VelocityField.00475.h5, or None for
+    files that don't belong to a timestep.
+    """
+    parts = os.path.basename(filename).split(".")
+    if len(parts) >= 3 and len(parts[-2]) == 5 and parts[-2].isdigit():
+        return int(parts[-2])
+    return None
+
+
+def field_of(filename):
+    """
+    VelocityField.00475.h5 -> VelocityField
+    """
+    return ".".join(os.path.basename(filename).split(".")[:-2])
+
+
+def checkpoint_steps(path, reference_field="VelocityField"):
+    """
+    The checkpointed timesteps in path, in order.
+    """
+    return sorted(step_of(filename) for filename in glob.glob(os.path.join(path, "{0}.*.h5".format(reference_field))))
+
+
+def checkpoint_files(path, step):
+    """
+    The .h5 files of a timestep, except the mesh.
+    """
+    return sorted(filename for filename in glob.glob(os.path.join(path, "*.{0:05d}.h5".format(step)))
+                  if not os.path.basename(filename).startswith("Mesh."))
+
+
+def mesh_file(path, step):
+    """
+    The mesh file that applies to a timestep: the latest one written at or
+    before it.
+    """
+    meshes = [(step_of(filename), filename) for filename in glob.glob(os.path.join(path, "Mesh.linearMesh.*.h5"))]
+    meshes = sorted(mesh for mesh in meshes if mesh[0] is not None and mesh[0] <= step)
+    if not meshes:
+        raise IOError("No Mesh.linearMesh.*.h5 at or before timestep {0} in {1}".format(step, path))
+    return meshes[-1][1]
+
+
+def mesh_shape(vertices):
+    """
+    Work out the number of nodes along each axis, (nx, ny) or (nx, ny, nz),
+    from the node order.
+    """
+    count, dims = vertices.shape
+
+    def run_length(column, stride):
+        # How many strides until the coordinate on this axis changes.
+        values = vertices[::stride, column]
+        changed = np.nonzero(values != values[0])[0]
+        return int(changed[0]) if len(changed) else len(values)
+
+    nx = run_length(1, 1)
+    if dims == 2:
+        return (nx, count // nx)
+    layer = run_length(2, 1)
+    return (nx, layer // nx, count // layer)
+
+
+def read_mesh(path, step):
+    """
+    Return (vertices, node shape) for a timestep.
+    """
+    with h5py.File(mesh_file(path, step), "r") as h5file:
+        vertices = h5file["vertices"][...]
+    return vertices, mesh_shape(vertices)
+
+
+def read_field(filename, dataset="data"):
+    with h5py.File(filename, "r") as h5file:
+        return h5file[dataset][...]
@@ -0,0 +1,312 @@
+"""
+==============
+ Compare runs
+==============
+
+Checks that two runs of a model give the same results, e.g. after changing
+the solver options in lmrRunModel.py's prepare_job, switching to another
+Underworld build, or moving to new hardware.
+
+The checkpoints of the two result folders are paired up by model time (from
+FrequentOutput.dat, so runs with different timesteps still line up), or by
+timestep if either doesn't have the time (e.g. timestep 0). Every dataset of
+every field, swarm and mesh file the two checkpoints have in common is
+compared, a chunk of rows at a time so even huge 3D checkpoints take little
+memory, giving:
+    L2          The L2 norm of the difference.
+    Linf        The largest difference.
+    relative    L2 relative to the L2 norm of the reference.
+A dataset is within tolerance if its relative difference is no more than
+--rtol (or its largest difference no more than --atol). --tolerance sets
+them for particular fields, e.g. --tolerance TemperatureField=1e-4. A
+dataset that only one of the checkpoints has is a difference too.
+
+Swarm datasets are compared particle by particle, which only means anything
+if the particles are in the same order: the same number of CPUs, and no
+particles added or removed by population control. Leave them out with
+--skip materialSwarm otherwise.
+
+The checkpoints are compared in parallel, in order of model time. With
+--stop_at_first, it stops at the first checkpoint that isn't within
+tolerance. The norms can also be written to a JSON file with --report. The
+exit code is 1 if any checkpoint differs by more than the tolerance.
+
+Run by:
+    python compare_runs.py <reference result folder> <result folder> [--rtol 1e-6] [--atol 0]
+           [--tolerance VelocityField=1e-4 ...] [--skip materialSwarm ...] [--stop_at_first]
+           [--report comparison.json] [--processes 8]
+"""
+
+from __future__ import division
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+
+import checkpoint_io
+from frequent_output import FrequentOutput
+
+if checkpoint_io.h5py is None:
+    sys.exit("This script requires numpy and h5py\n")
+
+np = checkpoint_io.np
+h5py = checkpoint_io.h5py
+
+# How much of a dataset to read at once.
+CHUNK_BYTES = 64 * 1024 ** 2
+
+
+def checkpoint_times(path):
+    """
+    The model time (in seconds) of each checkpoint, by timestep, or None if
+    there's no FrequentOutput.dat.
+    """
+    steps = checkpoint_io.checkpoint_steps(path)
+    try:
+        freq = FrequentOutput(path)
+    except IOError:
+        return dict((step, None) for step in steps)
+    times = {}
+    for step in steps:
+        try:
+            times[step] = freq.time_of(step)
+        except KeyError:
+            times[step] = None
+    return times
+
+
+def pair_checkpoints(reference, candidate, time_tolerance):
+    """
+    The (reference timestep, candidate timestep, model time) of each pair of
+    checkpoints at the same model time (or the same timestep, if either has
+    no time, like timestep 0), and the timesteps of each that have no
+    partner.
+    """
+    reference_times, candidate_times = checkpoint_times(reference), checkpoint_times(candidate)
+    by_time = sorted((time, step) for step, time in candidate_times.items() if time is not None)
+    times = np.array([time for time, _ in by_time])
+    pairs = []
+    for step, time in sorted(reference_times.items()):
+        if time is None or candidate_times.get(step, 0) is None:
+            if step in candidate_times:
+                pairs.append((step, step, time))
+            continue
+        if len(times):
+            index = int(np.argmin(np.abs(times - time)))
+            if abs(times[index] - time) <= time_tolerance * max(abs(time), 1.0):
+                pairs.append((step, by_time[index][1], time))
+    paired = set(reference_step for reference_step, _, _ in pairs), set(candidate for _, candidate, _ in pairs)
+    return (pairs, sorted(step for step in reference_times if step not in paired[0]),
+            sorted(step for step in candidate_times if step not in paired[1]))
+
+
+def checkpoint_datasets(path, step):
+    """
+    {(field, dataset): (filename, dataset)} of a checkpoint, including the
+    mesh.
+    """
+    filenames = checkpoint_io.checkpoint_files(path, step)
+    try:
+        filenames.append(checkpoint_io.mesh_file(path, step))
+    except IOError:
+        pass
+    datasets = {}
+    for filename in filenames:
+        field = checkpoint_io.field_of(filename)
+        try:
+            with h5py.File(filename, "r") as h5file:
+                names = []
+                h5file.visititems(lambda name, item: names.append(name) if isinstance(item, h5py.Dataset) else None)
+        except IOError:
+            continue
+        for name in names:
+            datasets[(field, name)] = (filename, name)
+    return datasets
+
+
+def compare_dataset(reference_file, candidate_file, name):
+    """
+    The norms of the difference between two datasets, read a chunk of rows at
+    a time.
+    """
+    with h5py.File(reference_file, "r") as reference_h5, h5py.File(candidate_file, "r") as candidate_h5:
+        reference, candidate = reference_h5[name], candidate_h5[name]
+        if reference.shape != candidate.shape:
+            return {"error": "the shapes differ: {0} and {1}".format(reference.shape, candidate.shape)}
+        squared_difference, squared_reference, largest = 0.0, 0.0, 0.0
+        if reference.shape:
+            row_bytes = max(1, int(np.prod(reference.shape[1:])) * 8)
+            rows = max(1, CHUNK_BYTES // row_bytes)
+            for start in range(0, reference.shape[0], rows):
+                first = reference[start:start + rows].astype(np.float64)
+                second = candidate[start:start + rows].astype(np.float64)
+                difference = np.abs(first - second)
+                # NaN in one and not the other is as different as it gets; NaN in both is the same.
+                difference[np.isnan(first) & np.isnan(second)] = 0
+                difference[np.isnan(first) != np.isnan(second)] = np.inf
+                if difference.size:
+                    squared_difference += float(np.sum(difference ** 2))
+                    squared_reference += float(np.nansum(first ** 2))
+                    largest = max(largest, float(np.max(difference)))
+        else:
+            difference = abs(float(reference[()]) - float(candidate[()]))
+            squared_difference, squared_reference, largest = difference ** 2, float(reference[()]) ** 2, difference
+    l2 = math.sqrt(squared_difference)
+    reference_l2 = math.sqrt(squared_reference)
+    relative = l2 / reference_l2 if reference_l2 else (0.0 if l2 == 0 else float("inf"))
+    return {"L2": l2, "Linf": largest, "relative": relative}
+
+
+def tolerance_of(field, name, settings):
+    """
+    The relative tolerance of a field's dataset: its own (as field/dataset
+    or field), or --rtol.
+    """
+    for key in ("{0}/{1}".format(field, name), field):
+        if key in settings["tolerances"]:
+            return settings["tolerances"][key]
+    return settings["rtol"]
+
+
+def compare_checkpoint(args):
+    """
+    Compare every dataset two checkpoints have in common. Run in the pool.
+    """
+    settings, reference_step, candidate_step, model_time = args
+    reference = checkpoint_datasets(settings["reference"], reference_step)
+    candidate = checkpoint_datasets(settings["candidate"], candidate_step)
+    result = {"reference_timestep": reference_step, "candidate_timestep": candidate_step,
+              "time_in_years": None if model_time is None else model_time / checkpoint_io.SECONDS_PER_YEAR,
+              "datasets": {}, "missing": [], "within_tolerance": True}
+    for key in sorted(set(reference) | set(candidate)):
+        field, name = key
+        if field in settings["skip"] or "{0}/{1}".format(field, name) in settings["skip"]:
+            continue
+        if key not in reference or key not in candidate:
+            result["missing"].append("{0}/{1} is only in the {2}".format(
+                field, name, "reference" if key in reference else "candidate"))
+            result["within_tolerance"] = False
+            continue
+        try:
+            norms = compare_dataset(reference[key][0], candidate[key][0], name)
+        except (IOError, KeyError, TypeError, ValueError) as err:
+            norms = {"error": str(err)}
+        norms["within_tolerance"] = "error" not in norms and (norms["relative"] <= tolerance_of(field, name, settings)
+                                                              or norms["Linf"] <= settings["atol"])
+        result["datasets"]["{0}/{1}".format(field, name)] = norms
+        result["within_tolerance"] = result["within_tolerance"] and norms["within_tolerance"]
+    return result
+
+
+def describe(norms):
+    if "error" in norms:
+        return norms["error"]
+    return "L2 {0:.3e}  Linf {1:.3e}  relative {2:.3e}".format(norms["L2"], norms["Linf"], norms["relative"])
+
+
+def summary(result):
+    """
+    A line about a checkpoint's comparison.
+    """
+    line = "Timestep {0:>6d}".format(result["reference_timestep"])
+    if result["candidate_timestep"] != result["reference_timestep"]:
+        line += " (candidate {0})".format(result["candidate_timestep"])
+    if result["time_in_years"] is not None:
+        line += " at {0:.6g} years".format(result["time_in_years"])
+    if not result["datasets"]:
+        return line + ": no datasets in common"
+    worst, norms = max(result["datasets"].items(), key=lambda item: item[1].get("relative", float("inf")))
+    return line + ": {0} ({1} datasets, largest relative difference {2:.3e} in {3})".format(
+        "OK" if result["within_tolerance"] else "DIFFERENT", len(result["datasets"]),
+        norms.get("relative", float("inf")), worst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the checkpoints of two runs are the same, to a "
+                                                 "tolerance.")
+    parser.add_argument("reference",
+                        help="The result folder to compare against.")
+    parser.add_argument("candidate",
+                        help="The result folder to check.")
+    parser.add_argument("--rtol", type=float, default=1e-6,
+                        help="The largest difference allowed, relative to the reference's L2 norm. Default 1e-6.")
+    parser.add_argument("--atol", type=float, default=0.0,
+                        help="Differences no bigger than this are always allowed. Default 0.")
+    parser.add_argument("--tolerance", nargs="+", default=[], metavar="FIELD=RTOL",
+                        help="The relative tolerance of particular fields (or field/dataset).")
+    parser.add_argument("--skip", nargs="+", default=[], metavar="FIELD",
+                        help="Fields (or field/dataset) not to compare, e.g. materialSwarm.")
+    parser.add_argument("--time_tolerance", type=float, default=1e-6,
+                        help="How close (relatively) the model times of checkpoints must be to pair them. "
+                             "Default 1e-6.")
+    parser.add_argument("--stop_at_first", action="store_true",
+                        help="Stop at the first checkpoint that isn't within tolerance.")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the norms of every dataset, not just those that aren't within tolerance.")
+    parser.add_argument("--report",
+                        help="Write every norm of every checkpoint to this JSON file.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="How many checkpoints to compare at once. Default: one per CPU.")
+    args = parser.parse_args()
+
+    tolerances = {}
+    for tolerance in args.tolerance:
+        field, _, value = tolerance.partition("=")
+        try:
+            tolerances[field] = float(value)
+        except ValueError:
+            sys.exit("ERROR - Tolerances are given as FIELD=RTOL, not {0}".format(tolerance))
+    settings = {"reference": args.reference, "candidate": args.candidate, "rtol": args.rtol, "atol": args.atol,
+                "tolerances": tolerances, "skip": set(args.skip)}
+
+    pairs, reference_only, candidate_only = pair_checkpoints(args.reference, args.candidate, args.time_tolerance)
+    if not pairs:
+        sys.exit("ERROR - {0} and {1} have no checkpoints at the same model time".format(
+            args.reference, args.candidate))
+    if reference_only:
+        print("Only in the reference: timesteps {0}".format(" ".join(str(step) for step in reference_only)))
+    if candidate_only:
+        print("Only in the candidate: timesteps {0}".format(" ".join(str(step) for step in candidate_only)))
+
+    results = []
+    pool = multiprocessing.Pool(max(1, args.processes))
+    try:
+        # In order, so the first that isn't within tolerance is found first.
+        for result in pool.imap(compare_checkpoint, [(settings, reference_step, candidate_step, model_time)
+                                                     for reference_step, candidate_step, model_time in pairs]):
+            results.append(result)
+            print(summary(result))
+            for name, norms in sorted(result["datasets"].items()):
+                if args.verbose or not norms["within_tolerance"]:
+                    print("    {0:<40} {1}{2}".format(name, describe(norms),
+                                                      "" if norms["within_tolerance"] else "  <-- DIFFERENT"))
+            for missing in result["missing"]:
+                print("    {0}".format(missing))
+            if args.stop_at_first and not result["within_tolerance"]:
+                print("Stopping at the first difference.")
+                pool.terminate()
+                break
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.report:
+        with open(args.report, "w") as report:
+            json.dump({"reference": os.path.abspath(args.reference), "candidate": os.path.abspath(args.candidate),
+                       "rtol": args.rtol, "atol": args.atol, "tolerances": tolerances,
+                       "reference_only": reference_only, "candidate_only": candidate_only,
+                       "checkpoints": results}, report, indent=1, sort_keys=True)
+
+    different = [result["reference_timestep"] for result in results if not result["within_tolerance"]]
+    if different:
+        print("{0} of the {1} checkpoints compared are DIFFERENT, the first at timestep {2}".format(
+            len(different), len(results), different[0]))
+        return 1
+    print("All {0} checkpoints compared are within tolerance".format(len(results)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+=====================
+ Deduplicate results
+=====================
+
+Much of what a run writes is byte-for-byte the same as something already on
+disk: the mesh, fields that don't change between checkpoints (e.g.
+MaterialIndexField in a thermal run), and the copies of every lmr*.xml in
+xmls/ and xmls_restart_N/. Across a parameter sweep even more is shared.
+
+This script finds identical files in one or more result folders and replaces
+the copies with hard links to a single file, so they only take up space once.
+
+Only files that are written once and never changed are considered:
+*.h5, the per-timestep XDMF.NNNNN.xmf files and *.xml. Files that get
+appended to (FrequentOutput.dat, XDMF.FilesField.xdmf, logs) are left alone.
+Files changed in the last --min_age seconds are skipped too, so it is safe
+to run on a model that is still going. lmrRunModel.py breaks the links in
+a result folder before a fresh (not restarted) run overwrites it.
+
+Each folder gets a content_index.json of the SHA-1 of every file, so only
+new or changed files are hashed again next time. Hashing is done in parallel.
+Hard links can't cross filesystems, so files are only linked to others on
+the same filesystem.
+
+The script runs in test-mode by default. Run with --for_real to link files.
+
+Run by:
+    python deduplicate_results.py <result folder> [<result folder> ...] [--for_real]
+
+For example, a whole sweep:
+    python deduplicate_results.py result_* initial-condition_* --for_real
+"""
+
+import argparse
+import filecmp
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+
+INDEX_NAME = "content_index.json"
+
+WRITTEN_ONCE = re.compile(r"(\.h5|^XDMF\.\d{5}\.xmf|\.xml)$")
+
+
+def sha1_of_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as data:
+        for chunk in iter(lambda: data.read(4 * 1024 ** 2), b""):
+            sha1.update(chunk)
+    return path, sha1.hexdigest()
+
+
+def load_index(result_dir):
+    try:
+        with open(os.path.join(result_dir, INDEX_NAME)) as index_file:
+            return json.load(index_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_index(result_dir, index):
+    filename = os.path.join(result_dir, INDEX_NAME)
+    with open(filename + ".partial", "w") as index_file:
+        json.dump(index, index_file, indent=0, sort_keys=True)
+    os.rename(filename + ".partial", filename)
+
+
+def candidate_files(result_dir, min_age):
+    """
+    (path, stat) of the files in result_dir that are written once, and old
+    enough not to be still being written.
+    """
+    now = time.time()
+    for root, dirs, files in os.walk(result_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if not WRITTEN_ONCE.search(filename):
+                continue
+            path = os.path.join(root, filename)
+            stat = os.lstat(path)
+            if not os.path.isfile(path) or os.path.islink(path) or now - stat.st_mtime < min_age:
+                continue
+            yield path, stat
+
+
+def link(original, duplicate, duplicate_stat):
+    """
+    Replace duplicate with a hard link to original. Only done if duplicate
+    hasn't changed since it was hashed and really is identical, and the
+    swap is atomic, so the file is never missing.
+    """
+    stat = os.stat(duplicate)
+    if (stat.st_size, stat.st_mtime) != (duplicate_stat.st_size, duplicate_stat.st_mtime):
+        return False
+    if not filecmp.cmp(original, duplicate, shallow=False):
+        return False
+    temporary = duplicate + ".dedup"
+    os.link(original, temporary)
+    os.rename(temporary, duplicate)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replace identical files in LMR result folders with hard links.")
+    parser.add_argument("result_dirs", nargs="+",
+                        help="The result folders to deduplicate. Files are shared between all of them.")
+    parser.add_argument("--min_age", type=float, default=600,
+                        help="Leave files changed in the last this many seconds alone. Default 600.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="How many files to hash at once. Default: one per CPU.")
+    parser.add_argument("--for_real", action="store_true", default=False,
+                        help="The script runs in test-mode by default. Add this flag to really link files.")
+    args = parser.parse_args()
+
+    files = []  # (result_dir, path, stat)
+    indexes = {}
+    for result_dir in args.result_dirs:
+        if not os.path.isdir(result_dir):
+            sys.exit("ERROR - {0} is not a folder".format(result_dir))
+        indexes[result_dir] = load_index(result_dir)
+        files.extend((result_dir, path, stat) for path, stat in candidate_files(result_dir, args.min_age))
+
+    # Only files with the same size can be the same, so only those need hashing.
+    sizes = {}
+    for result_dir, path, stat in files:
+        sizes.setdefault((stat.st_dev, stat.st_size), []).append((result_dir, path, stat))
+    groups = [group for group in sizes.values() if len(group) > 1]
+
+    hashes = {}
+    to_hash = []
+    for group in groups:
+        for result_dir, path, stat in group:
+            entry = indexes[result_dir].get(os.path.relpath(path, result_dir))
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                hashes[path] = entry["sha1"]
+            else:
+                to_hash.append(path)
+
+    pool = multiprocessing.Pool(max(1, args.processes))
+    try:
+        hashes.update(pool.imap_unordered(sha1_of_file, to_hash, chunksize=4))
+    finally:
+        pool.close()
+        pool.join()
+
+    linked = 0
+    saved = 0
+    for group in groups:
+        by_hash = {}
+        for result_dir, path, stat in group:
+            by_hash.setdefault(hashes[path], []).append((path, stat))
+        for same in by_hash.values():
+            # Keep the file with the most links already, so repeated runs converge on one copy.
+            same.sort(key=lambda item: (-item[1].st_nlink, item[0]))
+            original, original_stat = same[0]
+            for duplicate, stat in same[1:]:
+                if stat.st_ino == original_stat.st_ino:
+                    continue  # Already linked.
+                if not args.for_real:
+                    print("TEST - Linking {0} -> {1}".format(duplicate, original))
+                    linked += 1
+                    saved += stat.st_size
+                elif link(original, duplicate, stat):
+                    linked += 1
+                    saved += stat.st_size
+
+    if args.for_real:
+        for result_dir, path, stat in files:
+            if path in hashes:
+                stat = os.stat(path)
+                indexes[result_dir][os.path.relpath(path, result_dir)] = {
+                    "size": stat.st_size, "mtime": stat.st_mtime, "sha1": hashes[path]}
+        for result_dir, index in indexes.items():
+            save_index(result_dir, index)
+
+    print("{0} {1} duplicate files, {2:.1f} MB, out of {3} files checked ({4} hashed)".format(
+        "Linked" if args.for_real else "Found", linked, saved / 1024.0 ** 2, len(files), len(to_hash)))
+    if not args.for_real:
+        print("\nTest complete. To actually do this, run with the --for_real flag")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
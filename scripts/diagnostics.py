@@ -0,0 +1,378 @@
+"""
+=============
+ Diagnostics
+=============
+
+Measures the things we track through a run, for every checkpoint, from the
+mesh, temperature, strain rate and material index files, rather than by hand
+in ParaView:
+    topography             The elevation of the rock surface (the top of the
+                           highest material that isn't air): its highest,
+                           lowest and mean.
+    Moho depth             The base of the crust: its shallowest and mean
+                           depth, and the thinnest crust.
+    LAB depth              The depth of the --lab_temperature isotherm
+                           (1300 C by default): its shallowest and mean.
+    rift width             The width of the crust thinned by more than
+                           --thinning (10%) relative to the thickest 10% of
+                           the crust (averaged along strike in 3D).
+    strain localisation    The fraction of the rock that accommodates 90% of
+                           the deformation (the integral of the second
+                           invariant of the strain rate), the largest strain
+                           rate, and the largest accumulated brittle strain.
+    melt volume            The melt fraction (MeltFractionProperty, evaluated
+                           as in lmrGeotherm.py) integrated over the model,
+                           and its largest value. In 2D it's an area, per
+                           metre along strike.
+Elevations and depths are in metres relative to y = 0 (the top of the crust
+in the default lmrMaterials.xml); depths are positive downwards.
+
+Which material is air, crust or mantle is found from the material names in
+the run's copy of the XMLs (xmls/ in the result folder): names containing
+"air" are air, names containing "mantle" are mantle, and everything else is
+crust. Use --air, --crust and --mantle if your names are different.
+
+Each checkpoint is a line of diagnostics.jsonl in the result folder, with
+the timestep and model time. A diagnostic that can't be measured (e.g. the
+field isn't checkpointed) is null, and why is in the line's "errors".
+Checkpoints already in the file are skipped, so it can be re-run as a model
+carries on; use --overwrite after changing any of the options. The
+checkpoints are measured in parallel. lmrRunModel.py can also measure them
+while the model runs (the diagnostics hook of <checkpoint_hooks>), and
+sweep_table.py collects them for a whole sweep.
+
+Run by:
+    python diagnostics.py <result folder> [...] [--lab_temperature 1573.15] [--thinning 0.1]
+           [--air air] [--crust sediment uppercrust ...] [--mantle mantle ...] [--processes 8]
+"""
+
+from __future__ import division
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+import checkpoint_io
+from frequent_output import FrequentOutput
+
+np = checkpoint_io.np
+
+LMR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LMR_DIR)
+
+from lmrGeotherm import Column, ModelError, load_stgermain  # noqa: E402
+
+FILENAME = "diagnostics.jsonl"
+DEFAULTS = {"lab_temperature": 1573.15, "thinning": 0.1, "deformation_fraction": 0.9,
+            "air": None, "crust": None, "mantle": None}
+DIAGNOSTICS = ["topography_max", "topography_min", "topography_mean", "moho_depth_min", "moho_depth_mean",
+               "crustal_thickness_min", "lab_depth_min", "lab_depth_mean", "rift_width", "deforming_fraction",
+               "strain_rate_max", "brittle_strain_max", "melt_volume", "melt_fraction_max"]
+
+# The model's materials, by result folder, so the XMLs are only read once per worker.
+_columns = {}
+
+
+def model_column(output_path):
+    """
+    The Column (see lmrGeotherm.py) of the XMLs the run used: the last
+    restart's, if it has been restarted.
+    """
+    if output_path not in _columns:
+        xml_folders = [path for path in glob.glob(os.path.join(output_path, "xmls*")) if os.path.isdir(path)]
+        if not xml_folders:
+            raise ModelError("There is no copy of the XMLs (xmls/) in {0}".format(output_path))
+        xmls_dir = max(xml_folders, key=lambda path: int(path.split("_")[-1])
+                       if "_restart_" in os.path.basename(path) else 0)
+        _columns[output_path] = Column(load_stgermain([os.path.join(xmls_dir, "lmrMain.xml")]))
+    return _columns[output_path]
+
+
+def material_groups(names, settings):
+    """
+    The material numbers of the air, crust and mantle.
+    """
+    groups = {}
+    for group in ("air", "mantle"):
+        chosen = settings.get(group)
+        groups[group] = [number for number, name in enumerate(names)
+                         if (name in chosen if chosen else group in name.lower())]
+    chosen = settings.get("crust")
+    groups["crust"] = [number for number, name in enumerate(names) if (name in chosen if chosen else
+                       number not in groups["air"] and number not in groups["mantle"])]
+    return groups
+
+
+def control_widths(coordinates, axis):
+    """
+    The width of the part of the model closest to each node along an axis
+    (half way to the nodes either side).
+    """
+    spacing = np.diff(coordinates, axis=axis)
+    zeros = np.zeros_like(np.take(spacing, [0], axis=axis))
+    return (np.concatenate([zeros, spacing], axis=axis) + np.concatenate([spacing, zeros], axis=axis)) / 2
+
+
+def to_nodes(values, shape):
+    """
+    Element values averaged onto the nodes around them.
+    """
+    values = values.reshape(tuple(count - 1 for count in shape))
+    for axis in range(values.ndim):
+        padding = [(0, 0)] * values.ndim
+        padding[axis] = (1, 1)
+        values = np.pad(values, padding, "edge")
+        values = (np.take(values, range(values.shape[axis] - 1), axis=axis) +
+                  np.take(values, range(1, values.shape[axis]), axis=axis)) / 2
+    return values
+
+
+def at_nodes(values, node):
+    """
+    values at one node of each column (the last axis).
+    """
+    return np.take_along_axis(values, node[..., None], -1)[..., 0]
+
+
+def interface(y, inside, below):
+    """
+    The height of the top (or, with below, the bottom) of the nodes inside
+    each column, half way to the next node; NaN where a column has none.
+    Columns are the last axis, bottom first.
+    """
+    count = inside.shape[-1]
+    if below:
+        node = np.argmax(inside, axis=-1)
+        other = np.maximum(node - 1, 0)
+    else:
+        node = count - 1 - np.argmax(inside[..., ::-1], axis=-1)
+        other = np.minimum(node + 1, count - 1)
+    height = (at_nodes(y, node) + at_nodes(y, other)) / 2
+    return np.where(np.any(inside, axis=-1), height, np.nan)
+
+
+def isotherm(y, temperature, level):
+    """
+    The height of the highest point in each column at level, NaN where it's
+    colder everywhere.
+    """
+    count = temperature.shape[-1]
+    hot = temperature >= level
+    node = count - 1 - np.argmax(hot[..., ::-1], axis=-1)
+    above = np.minimum(node + 1, count - 1)
+    low_t, high_t = at_nodes(temperature, node), at_nodes(temperature, above)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(above > node, (level - low_t) / (high_t - low_t), 0.0)
+    height = at_nodes(y, node) + np.clip(fraction, 0, 1) * (at_nodes(y, above) - at_nodes(y, node))
+    return np.where(np.any(hot, axis=-1), height, np.nan)
+
+
+def statistic(function, values):
+    values = values[np.isfinite(values)]
+    return float(function(values)) if len(values) else None
+
+
+def diagnose(output_path, timestep, settings=None):
+    """
+    The diagnostics of one checkpoint, as a record for diagnostics.jsonl.
+    """
+    settings = dict(DEFAULTS, **(settings or {}))
+    record = dict((name, None) for name in DIAGNOSTICS)
+    record.update({"timestep": timestep, "time_in_years": None, "errors": []})
+    try:
+        record["time_in_years"] = FrequentOutput(output_path).time_of(timestep) / checkpoint_io.SECONDS_PER_YEAR
+    except (IOError, KeyError):
+        pass
+
+    vertices, node_shape = checkpoint_io.read_mesh(output_path, timestep)
+    shape = tuple(reversed(node_shape))  # (nz,) ny, nx
+
+    def field(name, optional=False):
+        filename = os.path.join(output_path, "{0}.{1:05d}.h5".format(name, timestep))
+        if not os.path.exists(filename):
+            if not optional:
+                record["errors"].append("{0} isn't checkpointed".format(name))
+            return None
+        data = checkpoint_io.read_field(filename)
+        return data.reshape(data.shape[0], -1)
+
+    def columns(values):
+        # The nodes in columns, bottom first: (nz,) nx, ny.
+        return np.moveaxis(values.reshape(shape), -2, -1)
+
+    y = columns(vertices[:, 1])
+    volume = np.ones(shape)
+    for axis in range(len(shape)):
+        volume = volume * control_widths(vertices[:, len(shape) - 1 - axis].reshape(shape), axis)
+    volume = columns(volume)
+
+    material, rock, groups, names = None, np.ones(y.shape, dtype=bool), None, None
+    material_index = field("MaterialIndexField")
+    try:
+        names = [name for name, _ in model_column(output_path).materials]
+    except ModelError as err:
+        record["errors"].append(str(err))
+    if material_index is not None and names:
+        material = columns(np.clip(np.round(material_index[:, 0]), 0, len(names) - 1).astype(int))
+        groups = material_groups(names, settings)
+        rock = ~np.in1d(material, groups["air"]).reshape(material.shape)
+
+    if groups is not None:
+        surface = interface(y, rock, below=False)
+        crust = np.in1d(material, groups["crust"]).reshape(material.shape)
+        moho = interface(y, crust, below=True)
+        thickness = np.where(np.isnan(moho), 0.0, surface - moho)
+        record.update({"topography_max": statistic(np.max, surface), "topography_min": statistic(np.min, surface),
+                       "topography_mean": statistic(np.mean, surface),
+                       "moho_depth_min": statistic(np.min, -moho), "moho_depth_mean": statistic(np.mean, -moho),
+                       "crustal_thickness_min": statistic(np.min, thickness)})
+        # The thinned crust, across the model at each z (or the one row of columns in 2D).
+        reference = np.nanpercentile(thickness, 90)
+        thinned = thickness < (1 - settings["thinning"]) * reference
+        widths = control_widths(columns(vertices[:, 0])[..., 0], -1)
+        record["rift_width"] = float(np.mean(np.sum(np.where(thinned, widths, 0.0), axis=-1)))
+
+    temperature = field("TemperatureField")
+    if temperature is not None:
+        temperature = columns(temperature[:, 0])
+        lab = isotherm(y, temperature, settings["lab_temperature"])
+        record.update({"lab_depth_min": statistic(np.min, -lab), "lab_depth_mean": statistic(np.mean, -lab)})
+
+    strain_rate = field("StrainRateField")
+    if strain_rate is not None:
+        # The second invariant: xx yy xy in 2D, xx yy zz xy xz yz in 3D.
+        normal = len(shape)
+        invariant = columns(np.sqrt(0.5 * np.sum(strain_rate[:, :normal] ** 2, axis=1) +
+                                    np.sum(strain_rate[:, normal:] ** 2, axis=1)))[rock]
+        record["strain_rate_max"] = statistic(np.max, invariant)
+        deformation = invariant * volume[rock]
+        if np.sum(deformation) > 0:
+            order = np.argsort(deformation)[::-1]
+            needed = np.searchsorted(np.cumsum(deformation[order]),
+                                     settings["deformation_fraction"] * deformation.sum())
+            record["deforming_fraction"] = float(np.sum(volume[rock][order[:needed + 1]]) / np.sum(volume[rock]))
+
+    brittle_strain = field("BrittleTotalStrainField", optional=True)
+    if brittle_strain is not None:
+        record["brittle_strain_max"] = statistic(np.max, columns(brittle_strain[:, 0])[rock])
+
+    pressure = field("PressureField")
+    if temperature is not None and pressure is not None and groups is not None:
+        pressure = columns(to_nodes(pressure[:, 0], shape))
+        try:
+            melt = model_column(output_path).evaluate("MeltFractionProperty", temperature[rock], material[rock],
+                                                      pressure=pressure[rock])
+            record["melt_volume"] = float(np.sum(melt * volume[rock]))
+            record["melt_fraction_max"] = statistic(np.max, melt)
+        except ModelError as err:
+            record["errors"].append("Unable to evaluate the melt fraction: {0}".format(err))
+    return record
+
+
+def measure(args):
+    """
+    diagnose, for the pool.
+    """
+    output_path, timestep, settings = args
+    try:
+        return output_path, diagnose(output_path, timestep, settings)
+    except Exception as err:
+        return output_path, {"timestep": timestep, "errors": ["{0}: {1}".format(type(err).__name__, err)]}
+
+
+def load_diagnostics(output_path):
+    """
+    The records of diagnostics.jsonl, in timestep order (the last, if a
+    checkpoint was measured more than once).
+    """
+    records = {}
+    try:
+        with open(os.path.join(output_path, FILENAME)) as diagnostics:
+            for line in diagnostics:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Cut off part way through writing it.
+                records[record["timestep"]] = record
+    except IOError:
+        pass
+    return [records[step] for step in sorted(records)]
+
+
+def append(output_path, record):
+    # A single write of one line, so lines written at the same time (by the checkpoint hooks) don't get mixed up.
+    with open(os.path.join(output_path, FILENAME), "a") as diagnostics:
+        diagnostics.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the topography, Moho and LAB depth, rift width, strain "
+                                                 "localisation and melt volume of every checkpoint.")
+    parser.add_argument("data_paths", nargs="+",
+                        help="The result folders.")
+    parser.add_argument("--lab_temperature", type=float, default=DEFAULTS["lab_temperature"],
+                        help="The temperature (in K) of the base of the lithosphere. Default 1573.15 (1300 C).")
+    parser.add_argument("--thinning", type=float, default=DEFAULTS["thinning"],
+                        help="How thinned the crust must be to count as part of the rift. Default 0.1 (10%%).")
+    parser.add_argument("--air", nargs="+",
+                        help="The names of the air materials. Default those with air in their name.")
+    parser.add_argument("--crust", nargs="+",
+                        help="The names of the crustal materials. Default all but the air and mantle.")
+    parser.add_argument("--mantle", nargs="+",
+                        help="The names of the mantle materials. Default those with mantle in their name.")
+    parser.add_argument("--timesteps", type=int, nargs="+",
+                        help="Only these timesteps. Default all checkpointed ones.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Measure every checkpoint again, rather than only the new ones.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="How many checkpoints to measure at once. Default: one per CPU.")
+    args = parser.parse_args()
+
+    settings = {"lab_temperature": args.lab_temperature, "thinning": args.thinning,
+                "air": args.air, "crust": args.crust, "mantle": args.mantle}
+    work = []
+    for output_path in args.data_paths:
+        steps = args.timesteps or checkpoint_io.checkpoint_steps(output_path)
+        if not steps:
+            sys.exit("ERROR - No checkpoints found in {0}".format(output_path))
+        if args.overwrite:
+            if os.path.exists(os.path.join(output_path, FILENAME)):
+                os.remove(os.path.join(output_path, FILENAME))
+            done = set()
+        else:
+            done = set(record["timestep"] for record in load_diagnostics(output_path))
+        work.extend((output_path, step, settings) for step in steps if step not in done)
+
+    pool = multiprocessing.Pool(max(1, args.processes))
+    try:
+        for output_path, record in pool.imap_unordered(measure, work):
+            append(output_path, record)
+    finally:
+        pool.close()
+        pool.join()
+
+    for output_path in args.data_paths:
+        records = load_diagnostics(output_path)
+        print("{0} ({1} checkpoints, {2} new):".format(output_path, len(records),
+                                                       sum(1 for work_path, _, _ in work if work_path == output_path)))
+        print("  {0:>9} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>12}".format(
+            "timestep", "Myr", "topo km", "Moho km", "LAB km", "rift km", "deforming", "melt m^n"))
+        for record in records:
+            values = [record.get("time_in_years")] + [record.get(name) for name in (
+                "topography_max", "moho_depth_min", "lab_depth_min", "rift_width")]
+            scales = [1e6, 1e3, 1e3, 1e3, 1e3]
+            print("  {0:>9d} ".format(record["timestep"]) + " ".join(
+                "{0:>10}".format("-" if value is None else "{0:.3f}".format(value / scale))
+                for value, scale in zip(values, scales)) + " {0:>10} {1:>12}".format(
+                *["-" if record.get(name) is None else "{0:.4g}".format(record[name])
+                  for name in ("deforming_fraction", "melt_volume")]))
+        errors = sorted(set(error for record in records for error in record.get("errors", [])))
+        for error in errors:
+            print("  WARNING - {0}".format(error))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
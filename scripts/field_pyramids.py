@@ -0,0 +1,276 @@
+"""
+================
+ Field pyramids
+================
+
+Builds coarsened copies of the mesh fields in a result folder, so large
+(especially 3D) models can be browsed remotely in ParaView without moving
+gigabytes per timestep. Only load full resolution once you know which
+timestep and region you want.
+
+For every checkpointed timestep, and every level (by default 2x, 4x and 8x
+coarser), this writes:
+    pyramid/Pyramid.NNNNN.h5
+        One group per level (level_2x, level_4x, ...) holding the coarse
+        mesh ("vertices") and one dataset per field.
+    pyramid/XDMF.Pyramid_2x.NNNNN.xmf, ...
+        The XDMF for each level, and XDMF.Pyramid_2x.xdmf, ... which tie
+        the timesteps together. Open these in ParaView.
+
+Fields on elements (e.g. PressureField) are averaged over blocks of 2x2(x2),
+4x4(x4), ... elements. Fields on nodes are averaged over the fine nodes
+around each coarse node, and the coarse mesh keeps every 2nd, 4th, ... node
+of the fine mesh (plus the last one, so the edges of the model don't move).
+MaterialIndexField isn't averaged, but takes the value at the kept node (or
+the middle element of the block), so it only holds real materials.
+Particle swarms aren't included.
+
+Timesteps are processed in parallel, and ones that already have pyramids
+are skipped, so it can be re-run while a model is still going.
+
+Run by:
+    python field_pyramids.py <result folder> [--levels 2 4 8] [--processes 4]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+import checkpoint_io
+
+if checkpoint_io.h5py is None:
+    sys.exit("This script requires numpy and h5py\n")
+
+np = checkpoint_io.np
+h5py = checkpoint_io.h5py
+
+
+def coarse_node_indices(count, factor):
+    """
+    Every factor-th node, always including the last one.
+    """
+    indices = list(range(0, count, factor))
+    if indices[-1] != count - 1:
+        indices.append(count - 1)
+    return np.array(indices)
+
+
+def average_nodes(data, axis, factor):
+    """
+    Average the nodes within factor // 2 of each coarse node, along one axis.
+    """
+    count = data.shape[axis]
+    centres = coarse_node_indices(count, factor)
+    low = np.maximum(centres - factor // 2, 0)
+    high = np.minimum(centres + factor // 2, count - 1)
+    summed = np.cumsum(data, axis=axis)
+    zero = np.zeros_like(np.take(summed, [0], axis=axis))
+    summed = np.concatenate([zero, summed], axis=axis)
+    shape = [1] * data.ndim
+    shape[axis] = len(centres)
+    widths = (high + 1 - low).reshape(shape)
+    return (np.take(summed, high + 1, axis=axis) - np.take(summed, low, axis=axis)) / widths
+
+
+def average_elements(data, axis, factor):
+    """
+    Average blocks of factor elements along one axis. A partial block at the
+    end is averaged over what there is.
+    """
+    count = data.shape[axis]
+    starts = np.arange(0, count, factor)
+    shape = [1] * data.ndim
+    shape[axis] = len(starts)
+    widths = (np.minimum(starts + factor, count) - starts).reshape(shape)
+    return np.add.reduceat(data, starts, axis=axis) / widths
+
+
+def sample_nodes(data, axis, factor):
+    """
+    The values at the coarse nodes, along one axis.
+    """
+    return np.take(data, coarse_node_indices(data.shape[axis], factor), axis=axis)
+
+
+def sample_elements(data, axis, factor):
+    """
+    The value of the middle element of each block of factor elements, along
+    one axis.
+    """
+    count = data.shape[axis]
+    starts = np.arange(0, count, factor)
+    return np.take(data, (starts + np.minimum(starts + factor, count) - 1) // 2, axis=axis)
+
+
+def coarsen(data, shape, factor, on_nodes, index=False):
+    """
+    Coarsen a field of (rows, components), where rows are in x fastest order
+    on a grid of the given shape, (nx, ny) or (nx, ny, nz). An index field
+    (e.g. MaterialIndexField) is sampled rather than averaged, as the mean of
+    two materials isn't a material.
+    """
+    grid = data.reshape(tuple(reversed(shape)) + (data.shape[1],)).astype(np.float64)
+    if index:
+        reduce_axis = sample_nodes if on_nodes else sample_elements
+    else:
+        reduce_axis = average_nodes if on_nodes else average_elements
+    for axis in range(len(shape)):
+        grid = reduce_axis(grid, axis, factor)
+    return grid.reshape(-1, data.shape[1])
+
+
+def attribute_type(components, dims):
+    if components == 1:
+        return "Scalar"
+    if components == dims:
+        return "Vector"
+    if components == 6 and dims == 3:
+        return "Tensor6"
+    return "Matrix"
+
+
+def write_level_xmf(filename, h5name, level, step, node_shape, fields):
+    dims = len(node_shape)
+    node_count = int(np.prod(node_shape))
+    grid_dims = " ".join(str(n) for n in reversed(node_shape))
+    lines = ['<?xml version="1.0" ?>',
+             '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">',
+             '<Domain>',
+             '<Grid Name="Pyramid_{0}" GridType="Uniform">'.format(level.split("_")[-1]),
+             '\t<Time Value="{0}" />'.format(step),
+             '\t<Topology Type="{0}DSMesh" NumberOfElements="{1}"/>'.format(dims, grid_dims),
+             '\t<Geometry Type="{0}">'.format("XYZ" if dims == 3 else "XY"),
+             '\t\t<DataItem Format="HDF" NumberType="Float" Precision="8" Dimensions="{0} {1}">{2}:/{3}/vertices</DataItem>'.format(
+                 node_count, dims, h5name, level),
+             '\t</Geometry>']
+    for name, rows, components, attribute, on_nodes in fields:
+        lines += ['\t<Attribute Type="{0}" Center="{1}" Name="{2}">'.format(
+                      attribute, "Node" if on_nodes else "Cell", name),
+                  '\t\t<DataItem Format="HDF" NumberType="Float" Precision="8" Dimensions="{0} {1}">{2}:/{3}/{4}</DataItem>'.format(
+                      rows, components, h5name, level, name),
+                  '\t</Attribute>']
+    lines += ['</Grid>', '</Domain>', '</Xdmf>', '']
+    with open(filename, "w") as xmf:
+        xmf.write("\n".join(lines))
+
+
+def build_pyramid(args):
+    """
+    Build every level for one timestep. Returns the timestep, or None if it
+    was already done.
+    """
+    path, step, factors = args
+    pyramid_dir = os.path.join(path, "pyramid")
+    h5name = "Pyramid.{0:05d}.h5".format(step)
+    h5path = os.path.join(pyramid_dir, h5name)
+    if os.path.exists(h5path):
+        return None
+
+    vertices, node_shape = checkpoint_io.read_mesh(path, step)
+    node_count = vertices.shape[0]
+    element_shape = tuple(n - 1 for n in node_shape)
+    element_count = int(np.prod(element_shape))
+
+    fields = []
+    for filename in checkpoint_io.checkpoint_files(path, step):
+        name = checkpoint_io.field_of(filename)
+        if name == "materialSwarm":
+            continue
+        try:
+            data = checkpoint_io.read_field(filename)
+        except KeyError:
+            continue  # Not a mesh field.
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        if data.shape[0] == node_count:
+            fields.append((name, data, True))
+        elif data.shape[0] == element_count:
+            fields.append((name, data, False))
+
+    # Written under a temporary name, so a half written pyramid is never mistaken for a finished one.
+    with h5py.File(h5path + ".partial", "w") as h5file:
+        for factor in factors:
+            level = "level_{0}x".format(factor)
+            group = h5file.create_group(level)
+            indices = [coarse_node_indices(n, factor) for n in node_shape]
+            grid = vertices.reshape(tuple(reversed(node_shape)) + (vertices.shape[1],))
+            for axis, axis_indices in enumerate(indices):
+                grid = np.take(grid, axis_indices, axis=len(node_shape) - 1 - axis)
+            group.create_dataset("vertices", data=grid.reshape(-1, vertices.shape[1]))
+            coarse_node_shape = tuple(len(axis_indices) for axis_indices in indices)
+
+            level_fields = []
+            for name, data, on_nodes in fields:
+                coarse = coarsen(data, node_shape if on_nodes else element_shape, factor, on_nodes,
+                                 index=name.startswith("MaterialIndex"))
+                attribute = attribute_type(coarse.shape[1], len(node_shape))
+                if attribute == "Vector" and coarse.shape[1] == 2:
+                    coarse = np.column_stack([coarse, np.zeros(coarse.shape[0])])  # ParaView wants 3 component vectors.
+                group.create_dataset(name, data=coarse)
+                level_fields.append((name, coarse.shape[0], coarse.shape[1], attribute, on_nodes))
+
+            write_level_xmf(os.path.join(pyramid_dir, "XDMF.Pyramid_{0}x.{1:05d}.xmf".format(factor, step)),
+                            h5name, level, step, coarse_node_shape, level_fields)
+    os.rename(h5path + ".partial", h5path)
+    return step
+
+
+def write_temporal_xdmf(path, factor):
+    pyramid_dir = os.path.join(path, "pyramid")
+    steps = sorted(checkpoint_io.step_of(filename) for filename in os.listdir(pyramid_dir)
+                   if filename.startswith("Pyramid.") and filename.endswith(".h5"))
+    filename = os.path.join(pyramid_dir, "XDMF.Pyramid_{0}x.xdmf".format(factor))
+    # Renamed into place, as lmrHooks.py may be writing it for several timesteps at once.
+    partial = "{0}.{1}.partial".format(filename, os.getpid())
+    with open(partial, "w") as xdmf:
+        xdmf.write('<?xml version="1.0" ?>\n'
+                   '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">\n'
+                   '<Domain>\n'
+                   '<Grid GridType="Collection" CollectionType="Temporal" Name="Pyramid_{0}x">\n'.format(factor))
+        for step in steps:
+            xdmf.write('\t<xi:include href="XDMF.Pyramid_{0}x.{1:05d}.xmf" '
+                       'xpointer="xpointer(//Xdmf/Domain/Grid[1])"/>\n'.format(factor, step))
+        xdmf.write("</Grid>\n</Domain>\n</Xdmf>\n")
+    os.rename(partial, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build coarsened copies of the mesh fields, for quick visualisation.")
+    parser.add_argument("data_path",
+                        help="The path to your results folder.")
+    parser.add_argument("--levels", type=int, nargs="+", default=[2, 4, 8],
+                        help="How many times coarser each level is. Default 2 4 8.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="How many timesteps to work on at once. Default: one per CPU.")
+    parser.add_argument("--timesteps", type=int, nargs="+",
+                        help="Only these timesteps. Default all checkpointed ones.")
+    args = parser.parse_args()
+
+    steps = args.timesteps or checkpoint_io.checkpoint_steps(args.data_path)
+    if not steps:
+        sys.exit("ERROR - No checkpoints (VelocityField.*.h5) found in {0}".format(args.data_path))
+    if any(factor < 2 for factor in args.levels):
+        sys.exit("ERROR - Levels must be 2 or more")
+
+    pyramid_dir = os.path.join(args.data_path, "pyramid")
+    if not os.path.isdir(pyramid_dir):
+        os.mkdir(pyramid_dir)
+
+    jobs = [(args.data_path, step, sorted(args.levels)) for step in steps]
+    pool = multiprocessing.Pool(max(1, args.processes))
+    try:
+        built = [step for step in pool.imap_unordered(build_pyramid, jobs) if step is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+    for factor in args.levels:
+        write_temporal_xdmf(args.data_path, factor)
+    print("Built pyramids for {0} timestep(s) ({1} already done) in {2}".format(
+        len(built), len(steps) - len(built), pyramid_dir))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
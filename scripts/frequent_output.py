@@ -0,0 +1,292 @@
+"""
+=================
+ Frequent output
+=================
+
+A fast reader for the FrequentOutput.dat file Underworld writes a line to
+every timestep (timestep, time in seconds, CPU time, Vrms, ...). For long
+runs it has millions of lines, and parsing it all with np.loadtxt every time
+is slow.
+
+The parsed columns are kept in a binary sidecar file next to it,
+FrequentOutput.cache (rows of float64, memory-mapped when read), with
+FrequentOutput.cache.json recording how far through FrequentOutput.dat has
+been parsed. Each time it is read, only the lines added since are parsed.
+If the result folder can't be written to (e.g. a read-only copy), it is
+parsed in memory instead.
+
+If a model is restarted from an earlier checkpoint, Underworld writes the
+timesteps after it again. The rows they replace are dropped from the cache,
+so timesteps are always in order and can be looked up by binary search.
+
+Used by the other scripts, e.g.:
+    from frequent_output import FrequentOutput
+    freq = FrequentOutput("result_208x96x0_reference_model")
+    freq.time_of(1200)                # Model time (s) of timestep 1200
+    freq.nearest_checkpoint(3.15e13)  # The checkpointed timestep closest to 1 Myr
+
+Or run by itself, to print a summary, or follow a live run:
+    python frequent_output.py <result folder> [--follow]
+"""
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import sys
+import time
+
+import checkpoint_io
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("This script requires numpy\n")
+
+
+class FrequentOutput(object):
+    """
+    The columns of a result folder's FrequentOutput.dat, kept up to date
+    from the cache. data is a (rows, columns) array (memory-mapped, unless
+    the cache can't be written), and columns are the names from the header
+    line.
+    """
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.source = os.path.join(data_path, "FrequentOutput.dat")
+        self.cache = os.path.join(data_path, "FrequentOutput.cache")
+        self.meta_file = self.cache + ".json"
+        self.in_memory = False
+        if not os.path.isfile(self.source):
+            raise IOError("Unable to find {0}".format(self.source))
+        self.update()
+
+    def load_meta(self):
+        try:
+            with open(self.meta_file) as meta_file:
+                meta = json.load(meta_file)
+            stat = os.stat(self.source)
+            cache_size = os.path.getsize(self.cache)
+        except (IOError, OSError, ValueError):
+            return None
+        # A FrequentOutput.dat that has shrunk or been replaced has to be parsed again from the start.
+        if meta.get("inode") != stat.st_ino or meta["offset"] > stat.st_size \
+                or cache_size != meta["rows"] * len(meta["columns"]) * 8:
+            return None
+        return meta
+
+    def new_meta(self):
+        return {"offset": 0, "rows": 0, "columns": None, "inode": os.stat(self.source).st_ino}
+
+    def save_meta(self, meta):
+        with open(self.meta_file + ".partial", "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.rename(self.meta_file + ".partial", self.meta_file)
+
+    def replace_cache(self, rows):
+        # Other processes may have the cache memory-mapped, and truncating it under them would crash them
+        # (SIGBUS), so a new one is written and renamed into place.
+        with open(self.cache + ".partial", "wb") as cache:
+            cache.write(np.ascontiguousarray(rows, dtype=np.float64).tobytes())
+        os.rename(self.cache + ".partial", self.cache)
+
+    def update(self):
+        """
+        Parse anything added to FrequentOutput.dat since last time. Returns
+        the number of rows added to the end of data.
+        """
+        if not self.in_memory:
+            try:
+                return self.update_cache()
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                    raise
+                # E.g. a read-only copy of the results, so the cache can't be kept next to it.
+                self.in_memory = True
+                self.meta = None
+        return self.update_in_memory()
+
+    def update_cache(self):
+        with open(self.cache + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            meta = self.load_meta()
+            if meta is None:
+                meta = self.new_meta()
+                self.replace_cache(np.zeros((0, 0)))
+
+            new, end = self.parse(meta)
+            existing = self.read_cache(meta)
+            keep = self.rows_kept(existing, new)
+            if keep < meta["rows"]:
+                self.replace_cache(existing[:keep])
+                meta["rows"] = keep
+            del existing
+            if new is not None:
+                with open(self.cache, "ab") as cache:
+                    cache.write(new.tobytes())
+                meta["rows"] += len(new)
+
+            meta["offset"] += end
+            self.save_meta(meta)
+            self.meta = meta
+        self.data = self.read_cache(meta)
+        return 0 if new is None else len(new)
+
+    def update_in_memory(self):
+        if self.meta is None:
+            # A cache that someone else keeps up to date is still a good start.
+            self.meta = self.load_meta() or self.new_meta()
+            self.data = self.read_cache(self.meta)
+        new, end = self.parse(self.meta)
+        self.meta["offset"] += end
+        if new is None:
+            return 0
+        keep = self.rows_kept(self.data, new)
+        self.data = np.concatenate([self.data[:keep], new]) if keep else new
+        self.meta["rows"] = len(self.data)
+        return len(new)
+
+    def parse(self, meta):
+        """
+        The rows added to FrequentOutput.dat after meta's offset (or None),
+        and how far through the file they go.
+        """
+        with open(self.source, "rb") as source:
+            source.seek(meta["offset"])
+            text = source.read()
+        # Only whole lines; the last one may still be being written.
+        end = text.rfind(b"\n") + 1
+        lines = text[:end].decode("ascii", "replace").splitlines()
+
+        rows = []
+        for line in lines:
+            if line.lstrip().startswith("#"):
+                if meta["columns"] is None:
+                    meta["columns"] = line.lstrip("#").split()
+                continue
+            try:
+                rows.append([float(value) for value in line.split()])
+            except ValueError:
+                continue
+        if meta["columns"] is None and rows:
+            meta["columns"] = ["column_{0}".format(number) for number in range(len(rows[0]))]
+        width = len(meta["columns"]) if meta["columns"] else 0
+        rows = [row for row in rows if len(row) == width]
+        if not rows:
+            return None, end
+
+        new = np.array(rows, dtype=np.float64)
+        # Restarted from an earlier checkpoint within the new lines, so keep the last of any repeats.
+        if np.any(np.diff(new[:, 0]) <= 0):
+            keep_rows = []
+            for row in new:
+                while keep_rows and keep_rows[-1][0] >= row[0]:
+                    keep_rows.pop()
+                keep_rows.append(row)
+            new = np.array(keep_rows)
+        return new, end
+
+    def rows_kept(self, existing, new):
+        """
+        How many of the existing rows to keep: after a restart from an
+        earlier checkpoint, the timesteps being written again are dropped.
+        """
+        if new is None or not len(existing):
+            return len(existing)
+        return int(np.searchsorted(existing[:, 0], new[0, 0]))
+
+    def read_cache(self, meta):
+        if not meta["rows"]:
+            return np.zeros((0, len(meta["columns"] or [])))
+        return np.memmap(self.cache, dtype=np.float64, mode="r", shape=(meta["rows"], len(meta["columns"])))
+
+    @property
+    def columns(self):
+        return self.meta["columns"]
+
+    @property
+    def timesteps(self):
+        return self.data[:, 0]
+
+    @property
+    def times(self):
+        return self.data[:, 1]
+
+    def time_of(self, timestep):
+        """
+        The model time (in seconds) at the end of a timestep.
+        """
+        index = int(np.searchsorted(self.timesteps, timestep))
+        if index >= len(self.timesteps) or self.timesteps[index] != timestep:
+            raise KeyError("Timestep {0} is not in {1}".format(timestep, self.source))
+        return float(self.times[index])
+
+    def timestep_at(self, model_time):
+        """
+        The first timestep that ends at or after model_time (in seconds).
+        """
+        index = min(int(np.searchsorted(self.times, model_time)), len(self.times) - 1)
+        return int(self.timesteps[index])
+
+    def nearest_checkpoint(self, model_time, checkpoint_steps=None):
+        """
+        The checkpointed timestep whose time is closest to model_time (in
+        seconds). The checkpoints are found from the VelocityField files if
+        not given.
+        """
+        if checkpoint_steps is None:
+            checkpoint_steps = checkpoint_io.checkpoint_steps(self.data_path)
+        steps = np.array(sorted(checkpoint_steps), dtype=np.float64)
+        indices = np.searchsorted(self.timesteps, steps)
+        found = indices < len(self.timesteps)
+        found[found] = self.timesteps[indices[found]] == steps[found]
+        steps, times = steps[found], self.times[indices[found]]
+        if not len(steps):
+            raise KeyError("None of the checkpoints are in {0}".format(self.source))
+        index = int(np.searchsorted(times, model_time))
+        candidates = [i for i in (index - 1, index) if 0 <= i < len(steps)]
+        return int(steps[min(candidates, key=lambda i: abs(times[i] - model_time))])
+
+    def follow(self, interval=5.0):
+        """
+        Yield new rows as Underworld adds them, forever.
+        """
+        while True:
+            added = self.update()
+            if added:
+                for row in self.data[-added:]:
+                    yield row
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read (and cache) a FrequentOutput.dat file quickly.")
+    parser.add_argument("data_path",
+                        help="The path to your results folder. Must contain the FrequentOutput.dat file.")
+    parser.add_argument("--follow", action="store_true",
+                        help="Keep printing new lines as the model runs.")
+    args = parser.parse_args()
+
+    try:
+        freq = FrequentOutput(args.data_path)
+    except IOError as err:
+        sys.exit(err)
+
+    print("{0} timesteps, columns: {1}".format(len(freq.data), " ".join(freq.columns or [])))
+    if len(freq.data):
+        print("Timesteps {0:.0f} to {1:.0f}, model time {2:.6g} to {3:.6g} years".format(
+            freq.timesteps[0], freq.timesteps[-1], freq.times[0] / checkpoint_io.SECONDS_PER_YEAR,
+            freq.times[-1] / checkpoint_io.SECONDS_PER_YEAR))
+    if args.follow:
+        try:
+            for row in freq.follow():
+                print(" ".join("{0:.6g}".format(value) for value in row))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,476 @@
+"""
+============
+ Job daemon
+============
+
+A small job queue for workstations, so a list of LMR models can be handed
+over in one go and run one after another (or side by side) overnight,
+without a cluster scheduler.
+
+The daemon listens on a Unix socket, and keeps its queue in a state folder
+(~/.lmr_daemon by default), so submissions survive the daemon being
+restarted. Each job is a start XML (e.g. lmrStart.xml) plus optional
+overrides, and is run with lmrRunModel.py from the folder the start XML is
+in, just as if you'd typed "python lmrRunModel.py lmrStart.xml" there.
+A job is started as soon as there are enough free cores for its <CPUs>.
+
+Start the daemon (leave it running, e.g. in screen or tmux):
+    python job_daemon.py serve --cores 16
+
+Submit jobs:
+    python job_daemon.py submit ~/models/rift_fast/lmrStart.xml
+    python job_daemon.py submit ~/models/rift_slow/lmrStart.xml \
+        -o Output_Controls/description=slow_cpus8 -o Underworld_Execution/CPUs=8
+
+Overrides are <path>=<value>, where path is the XML path from the root of
+the start XML, as in the examples above.
+
+See what's going on, or cancel a job:
+    python job_daemon.py status
+    python job_daemon.py status 3
+    python job_daemon.py cancel 3
+    python job_daemon.py stop           # Running jobs carry on
+"""
+
+import argparse
+import datetime
+import errno
+import json
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+
+from xml.etree import ElementTree
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+LMR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LMR_DIR)
+
+import lmrRunModel  # noqa: E402
+
+LMR_NAMESPACE = "https://bitbucket.org/lmondy/lithosphericmodellingrecipe"
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".lmr_daemon")
+
+
+def new_session():
+    """
+    Run jobs in their own session, so they carry on if the daemon is
+    stopped, and make sure Ctrl-C (i.e. cancel) works in them even if the
+    daemon was started in the background.
+    """
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class JobDaemon(object):
+    """
+    Keeps the queue, starts jobs when cores are free, and answers requests.
+    The queue is written to state.json every time it changes.
+    """
+    def __init__(self, state_dir, cores):
+        self.state_dir = state_dir
+        self.cores = cores
+        self.state_file = os.path.join(state_dir, "state.json")
+        self.processes = {}
+        self.running = True
+        self.jobs = []
+        self.next_id = 1
+        self.load_state()
+
+    # === Persistence ===================================================
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return
+        with open(self.state_file) as state:
+            saved = json.load(state)
+        self.jobs = saved["jobs"]
+        self.next_id = saved["next_id"]
+
+        if not all(isinstance(job, dict) for job in self.jobs):
+            print("ERROR - Dropped the entries in {0} that aren't jobs".format(self.state_file))
+            self.jobs = [job for job in self.jobs if isinstance(job, dict)]
+        for job in self.jobs:
+            try:
+                self.restore_job(job)
+            except Exception as err:
+                # An entry edited by hand, or whose start XML has since changed or gone, mustn't stop the
+                # daemon from running the rest of the queue.
+                print("ERROR - Job {0} can't be run, so is marked as failed ({1}: {2})".format(
+                    job.get("id", "?"), type(err).__name__, err))
+                if "id" not in job:
+                    job["id"] = self.next_id
+                    self.next_id += 1
+                job.setdefault("cpus", 0)
+                job.setdefault("start_xml", "?")
+                job.update({"status": "failed", "stopping": False, "error": "{0}: {1}".format(type(err).__name__, err),
+                            "finished": datetime.datetime.now().isoformat()})
+        self.save_state()
+
+    def restore_job(self, job):
+        # Jobs that were running when the daemon stopped either still are
+        # (they run in their own session), or died with the machine.
+        if job["status"] == "running":
+            if pid_alive(job["pid"]):
+                job["detached"] = True
+            elif self.exit_code(job) is not None:
+                self.job_done(job, self.exit_code(job))
+            else:
+                job["status"] = "queued"
+                job["requeued"] = job.get("requeued", 0) + 1
+                self.prepare_restart(job)
+        elif job["status"] == "queued":
+            job["cpus"] = int(job["cpus"])
+            if not os.path.isfile(job["xml"]):
+                self.write_job_xml(job)
+        elif job.get("stopping") and not pid_alive(job["pid"]):
+            job["stopping"] = False
+
+    def save_state(self):
+        temporary = self.state_file + ".tmp"
+        with open(temporary, "w") as state:
+            json.dump({"jobs": self.jobs, "next_id": self.next_id}, state, indent=1, sort_keys=True)
+        os.rename(temporary, self.state_file)  # Atomic, so a crash never leaves half a queue.
+
+    # === Jobs ==========================================================
+    def job(self, job_id):
+        for job in self.jobs:
+            if job["id"] == job_id:
+                return job
+        raise KeyError("There is no job {0}".format(job_id))
+
+    def write_job_xml(self, job):
+        """
+        Write the start XML with the overrides applied, and work out what
+        the job needs and where it will put its results.
+        """
+        ElementTree.register_namespace("lmr", LMR_NAMESPACE)
+        ElementTree.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+        tree = ElementTree.parse(job["start_xml"])
+        root = tree.getroot()
+        for path, value in sorted(job["overrides"].items()):
+            element = root.find(path)
+            if element is None:
+                raise ValueError("The override {0} doesn't match anything in {1}".format(path, job["start_xml"]))
+            element.text = " {0} ".format(value)
+
+        job_dir = os.path.join(self.state_dir, "jobs", str(job["id"]))
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        job["xml"] = os.path.join(job_dir, "lmrStart.xml")
+        job["output"] = os.path.join(job_dir, "output.txt")
+        job["exit_file"] = os.path.join(job_dir, "exit_code")
+        tree.write(job["xml"], encoding="UTF-8", xml_declaration=True)
+
+        model_dict, _ = lmrRunModel.process_xml(lmrRunModel.load_xml(job["xml"], os.path.join(job["cwd"], "LMR.xsd")))
+        job["cpus"] = int(model_dict.get("cpus", 1))
+        job["max_time"] = model_dict["thermal_max_time"] if model_dict["run_thermal_equilibration_phase"] else model_dict["max_time"]
+        if model_dict["run_thermal_equilibration_phase"]:
+            description = "initial-condition_{0}_{1}".format(
+                lmrRunModel.get_textual_resolution(model_dict["thermal_model_resolution"]), model_dict["thermal_description"])
+        else:
+            description = "result_{0}_{1}".format(
+                lmrRunModel.get_textual_resolution(model_dict["model_resolution"]), model_dict["description"])
+        job["output_path"] = os.path.join(job["cwd"], description)
+        job["scratch_path"] = os.path.join(model_dict["scratch_directory"], description) if model_dict["scratch_directory"] else None
+        job["resource_file"] = os.path.join(job["cwd"], "resources_{0}.txt".format(description))
+
+    def prepare_restart(self, job):
+        """
+        A job that was interrupted is restarted from its last checkpoint, if it got that far.
+        """
+        try:
+            lmrRunModel.find_last_timestep(job["output_path"], job.get("scratch_path"))
+        except ValueError:
+            return
+        job["overrides"]["Restarting_Controls/restart"] = "true"
+        self.write_job_xml(job)
+
+    def submit(self, start_xml, overrides):
+        start_xml = os.path.abspath(start_xml)
+        if not os.path.isfile(start_xml):
+            raise ValueError("Can't find {0}".format(start_xml))
+        job = {"id": self.next_id,
+               "start_xml": start_xml,
+               "cwd": os.path.dirname(start_xml),
+               "overrides": overrides,
+               "status": "queued",
+               "submitted": datetime.datetime.now().isoformat()}
+        self.write_job_xml(job)
+        if job["cpus"] > self.cores:
+            raise ValueError("The job needs {0} CPUs, but the daemon only has {1} cores.".format(job["cpus"], self.cores))
+        self.next_id += 1
+        self.jobs.append(job)
+        self.save_state()
+        return job
+
+    def free_cores(self):
+        # A cancelled job keeps its cores until it has actually stopped.
+        return self.cores - sum(job["cpus"] for job in self.jobs if job["status"] == "running" or job.get("stopping"))
+
+    def start_job(self, job):
+        lmr_script = os.path.join(job["cwd"], "lmrRunModel.py")
+        if not os.path.isfile(lmr_script):
+            lmr_script = os.path.join(LMR_DIR, "lmrRunModel.py")
+        if os.path.exists(job["exit_file"]):
+            os.remove(job["exit_file"])
+        # The exit code is written to a file, so it isn't lost if the daemon
+        # is restarted while the job is running.
+        command = "{0} {1} {2}; echo $? > {3}".format(quote(sys.executable), quote(lmr_script),
+                                                      quote(job["xml"]), quote(job["exit_file"]))
+        with open(job["output"], "a") as output:
+            process = subprocess.Popen(["/bin/sh", "-c", command], cwd=job["cwd"],
+                                       stdout=output, stderr=subprocess.STDOUT, preexec_fn=new_session)
+        self.processes[job["id"]] = process
+        job.update({"status": "running", "pid": process.pid, "detached": False,
+                    "started": datetime.datetime.now().isoformat()})
+
+    def exit_code(self, job):
+        try:
+            with open(job["exit_file"]) as exit_file:
+                return int(exit_file.read())
+        except (IOError, ValueError):
+            return None
+
+    def job_done(self, job, returncode):
+        job["returncode"] = returncode
+        job["status"] = "failed" if returncode else "finished"
+        job["finished"] = datetime.datetime.now().isoformat()
+
+    def check_jobs(self):
+        changed = False
+        for job in self.jobs:
+            if job["status"] == "running" or not (job.get("stopping") or job["id"] in self.processes):
+                continue
+            process = self.processes.get(job["id"])
+            if process is not None:
+                stopped = process.poll() is not None
+            else:
+                stopped = not pid_alive(job["pid"])
+            if stopped:  # A cancelled job that has now stopped, so its cores are free.
+                self.processes.pop(job["id"], None)
+                job["stopping"] = False
+                changed = True
+
+        for job in self.jobs:
+            if job["status"] != "running":
+                continue
+            process = self.processes.get(job["id"])
+            if process is not None:
+                if process.poll() is None:
+                    continue
+                del self.processes[job["id"]]
+            elif pid_alive(job["pid"]):
+                continue
+            self.job_done(job, self.exit_code(job))
+            changed = True
+
+        # Start queued jobs, oldest first, as long as they fit.
+        for job in self.jobs:
+            if job["status"] == "queued" and job["cpus"] <= self.free_cores():
+                self.start_job(job)
+                changed = True
+        if changed:
+            self.save_state()
+
+    def cancel(self, job_id):
+        job = self.job(job_id)
+        if job["status"] == "running":
+            job["stopping"] = True  # Until check_jobs() sees it has stopped.
+            try:
+                os.killpg(job["pid"], signal.SIGINT)  # As if Ctrl-C was pressed: the LMR kills Underworld.
+            except OSError:
+                pass
+        if job["status"] in ("queued", "running"):
+            job["status"] = "cancelled"
+            job["finished"] = datetime.datetime.now().isoformat()
+            self.save_state()
+        return job
+
+    def progress(self, job):
+        """
+        How far the job has got, from FrequentOutput.dat, and its latest
+        resource sample and summary (see <resource_sample_interval>).
+        """
+        report = dict(job)
+        timestep, model_time = lmrRunModel.read_last_frequent_output(job["output_path"])
+        report["timestep"] = timestep
+        report["model_time_in_years"] = model_time / lmrRunModel.SECONDS_PER_YEAR
+        if job["max_time"] > 0:
+            report["progress"] = min(1.0, report["model_time_in_years"] / job["max_time"])
+        try:
+            with open(job["resource_file"]) as resources:
+                for line in resources:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    report["metrics" if "summary" in entry else "latest_sample"] = entry.get("summary", entry)
+        except IOError:
+            pass
+        return report
+
+    # === Requests ======================================================
+    def handle(self, request):
+        command = request.get("command")
+        if command == "submit":
+            return {"job": self.submit(request["start_xml"], request.get("overrides", {}))}
+        elif command == "status":
+            if request.get("id") is not None:
+                return {"job": self.progress(self.job(request["id"]))}
+            return {"jobs": [self.progress(job) if job["status"] == "running" else job for job in self.jobs],
+                    "cores": self.cores, "free_cores": self.free_cores()}
+        elif command == "cancel":
+            return {"job": self.cancel(request["id"])}
+        elif command == "stop":
+            self.running = False
+            return {"stopped": True}
+        raise ValueError("Unknown command {0}".format(command))
+
+    def serve(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(5)
+        print("LMR job daemon listening on {0} with {1} cores".format(socket_path, self.cores))
+        sys.stdout.flush()
+        try:
+            while self.running:
+                self.check_jobs()
+                readable, _, _ = select.select([server], [], [], 1.0)
+                if not readable:
+                    continue
+                connection, _ = server.accept()
+                try:
+                    request = json.loads(receive_line(connection))
+                    try:
+                        reply = self.handle(request)
+                    except Exception as err:
+                        # E.g. a start XML that isn't valid XML. A bad request mustn't stop the daemon, as
+                        # then nothing keeps track of the running jobs.
+                        reply = {"error": str(err) or type(err).__name__}
+                    connection.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+                except (ValueError, socket.error):
+                    pass
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(socket_path)
+
+
+def receive_line(connection):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode("utf-8")
+
+
+def send_request(socket_path, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error as err:
+        sys.exit("ERROR - Can't talk to the job daemon on {0} ({1}). Is it running?\n"
+                 "Start it with: python job_daemon.py serve".format(socket_path, err))
+    client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+    line = receive_line(client)
+    client.close()
+    try:
+        reply = json.loads(line)
+    except ValueError:
+        sys.exit("ERROR - The job daemon on {0} didn't reply{1}. Has it stopped? See its output.".format(
+            socket_path, ", or its reply was garbled" if line.strip() else ""))
+    if "error" in reply:
+        sys.exit("ERROR - {0}".format(reply["error"]))
+    return reply
+
+
+def print_job(job):
+    line = "{id:>4}  {status:<10} {cpus:>4} CPUs  {start_xml}".format(**job)
+    if job.get("overrides"):
+        line += " " + " ".join("{0}={1}".format(k, v) for k, v in sorted(job["overrides"].items()))
+    if "progress" in job:
+        line += "\n      timestep {0}, {1:.4g} years ({2:.1%})".format(job["timestep"], job["model_time_in_years"], job["progress"])
+    if "latest_sample" in job:
+        line += ", {0:.2f} GB in use".format(job["latest_sample"]["total_rss"] / 1024 ** 3)
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A job queue for running LMR models on a workstation.")
+    parser.add_argument("--state_dir", default=DEFAULT_STATE_DIR,
+                        help="Where the queue and job files are kept. Default: {0}".format(DEFAULT_STATE_DIR))
+    commands = parser.add_subparsers(dest="command")
+
+    serve = commands.add_parser("serve", help="Run the daemon.")
+    serve.add_argument("--cores", type=int, default=multiprocessing.cpu_count(),
+                       help="How many cores the jobs may use between them. Default: all of them.")
+
+    submit = commands.add_parser("submit", help="Add a model to the queue.")
+    submit.add_argument("start_xml", help="The start XML, e.g. lmrStart.xml")
+    submit.add_argument("-o", "--override", action="append", default=[], metavar="PATH=VALUE",
+                        help="Change a value in the start XML for this job, e.g. Underworld_Execution/CPUs=8")
+
+    status = commands.add_parser("status", help="Show the queue, or one job in detail.")
+    status.add_argument("id", type=int, nargs="?")
+
+    cancel = commands.add_parser("cancel", help="Take a job off the queue, or stop it if it's running.")
+    cancel.add_argument("id", type=int)
+
+    commands.add_parser("stop", help="Stop the daemon. Running jobs carry on.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.state_dir):
+        os.makedirs(args.state_dir)
+    socket_path = os.path.join(args.state_dir, "daemon.sock")
+
+    if args.command == "serve":
+        JobDaemon(args.state_dir, args.cores).serve(socket_path)
+    elif args.command == "submit":
+        overrides = {}
+        for override in args.override:
+            if "=" not in override:
+                sys.exit("ERROR - Overrides look like PATH=VALUE, not {0}".format(override))
+            path, value = override.split("=", 1)
+            overrides[path.strip("/")] = value
+        job = send_request(socket_path, {"command": "submit", "start_xml": os.path.abspath(args.start_xml),
+                                         "overrides": overrides})["job"]
+        print("Submitted job {0}".format(job["id"]))
+    elif args.command == "status":
+        reply = send_request(socket_path, {"command": "status", "id": args.id})
+        if args.id is not None:
+            print(json.dumps(reply["job"], indent=1, sort_keys=True))
+        else:
+            print("{0} of {1} cores free".format(reply["free_cores"], reply["cores"]))
+            for job in reply["jobs"]:
+                print_job(job)
+    elif args.command == "cancel":
+        print("Job {id} is {status}".format(**send_request(socket_path, {"command": "cancel", "id": args.id})["job"]))
+    elif args.command == "stop":
+        send_request(socket_path, {"command": "stop"})
+        print("Stopped the job daemon")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
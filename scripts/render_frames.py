@@ -0,0 +1,370 @@
+"""
+===============
+ Render frames
+===============
+
+Renders a frame of a field (or the material particles) for every checkpoint
+in a result folder, straight from the HDF5 files, with no ParaView and no
+display, and makes them into a movie. The timesteps are rendered in
+parallel, so a long run takes minutes on all the cores of a node.
+
+The colour scale is the same in every frame: --range, or the range of the
+field over the whole run (ignoring the most extreme 1%). A strip at the
+bottom of each frame shows the colour map, and <field>.json (next to the
+frames) records the range and the model time of each frame. MaterialIndexField is coloured by material.
+
+In 3D, a vertical section is rendered: --slice z 0.5 is the x-y plane half
+way along z (or x 0.25, for the z-y plane a quarter of the way along x).
+The mesh may be deformed vertically (e.g. by the isostasy plugin); anything
+above the surface is left white.
+
+--swarm renders the material particles instead (every --decimate'th one,
+and in 3D only those within an element of the slice), coloured by material
+if the swarm file has a MaterialIndex dataset.
+
+Frames are written as <output_path>/<field>.NNNNN.png (NNNNN is the
+timestep). Ones that are already there (with the same settings and colour
+range) are skipped, so it can be re-run as a model carries on. If ffmpeg is
+installed, the frames are made into <output_path>/<field>.mp4 as well.
+
+Run by:
+    python render_frames.py <result folder> [--field TemperatureField] [--range 273 1600]
+           [--colour_map coolwarm] [--log] [--component 0] [--slice z 0.5] [--swarm]
+           [--width 1600] [--fps 20] [--processes 8] [--output_path frames]
+
+For example, the strain rate of a 3D rift, on a log scale:
+    python render_frames.py result_128x64x64_rift --field StrainRateField --log --slice z 0.5
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import checkpoint_io
+from frequent_output import FrequentOutput
+
+if checkpoint_io.h5py is None:
+    sys.exit("This script requires numpy and h5py\n")
+
+np = checkpoint_io.np
+h5py = checkpoint_io.h5py
+
+LMR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LMR_DIR)
+
+from lmrLayout import PALETTE, write_png  # noqa: E402
+
+# Colour maps, as evenly spaced colours to interpolate between.
+COLOUR_MAPS = {
+    "viridis": [(68, 1, 84), (72, 40, 120), (62, 74, 137), (49, 104, 142), (38, 130, 142),
+                (31, 158, 137), (53, 183, 121), (109, 205, 89), (180, 222, 44), (253, 231, 37)],
+    "inferno": [(0, 0, 4), (31, 12, 72), (85, 15, 109), (136, 34, 106), (186, 54, 85),
+                (227, 89, 51), (249, 140, 10), (249, 201, 50), (252, 255, 164)],
+    "coolwarm": [(59, 76, 192), (98, 130, 234), (141, 176, 254), (184, 208, 249), (221, 221, 221),
+                 (245, 196, 173), (244, 154, 123), (222, 96, 77), (180, 4, 38)],
+    "greys": [(0, 0, 0), (255, 255, 255)],
+}
+BACKGROUND = (255, 255, 255)
+COLOUR_BAR_HEIGHT = 12
+
+
+def apply_colour_map(values, low, high, name):
+    """
+    RGB for an array of values, scaled from low to high. NaN is the
+    background.
+    """
+    colours = np.array(COLOUR_MAPS[name], dtype=np.float64)
+    scaled = np.clip((values - low) / ((high - low) or 1.0), 0, 1) * (len(colours) - 1)
+    scaled = np.where(np.isnan(scaled), 0, scaled)
+    lower = np.minimum(scaled.astype(int), len(colours) - 2)
+    fraction = (scaled - lower)[..., None]
+    rgb = (colours[lower] * (1 - fraction) + colours[lower + 1] * fraction).astype(np.uint8)
+    rgb[np.isnan(values)] = BACKGROUND
+    return rgb
+
+
+def categorical_colours(values):
+    palette = np.array(PALETTE + [BACKGROUND], dtype=np.uint8)
+    index = np.where(np.isnan(values), len(PALETTE), np.nan_to_num(values).astype(int) % len(PALETTE))
+    return palette[index.astype(int)]
+
+
+def section(vertices, node_shape, data, on_nodes, cut):
+    """
+    The 2D structured grid to render: (horizontal coordinates, vertical
+    coordinates, values), each shaped (rows, columns) bottom row first. In 3D
+    it is the slice cut = (axis, fraction) through the nodes.
+    """
+    shape = tuple(reversed(node_shape))  # (nz,) ny, nx
+    values_shape = shape if on_nodes else tuple(count - 1 for count in shape)
+    coords = vertices.reshape(shape + (vertices.shape[1],))
+    values = data.reshape(values_shape)
+    if len(node_shape) == 2:
+        return coords[..., 0], coords[..., 1], values
+    axis, fraction = cut
+    if axis == "z":
+        layer = int(round(fraction * (shape[0] - 1)))
+        return (coords[layer, :, :, 0], coords[layer, :, :, 1],
+                values[min(layer, values.shape[0] - 1)])
+    layer = int(round(fraction * (shape[2] - 1)))
+    return (coords[:, :, layer, 2].T, coords[:, :, layer, 1].T,
+            values[:, :, min(layer, values.shape[2] - 1)].T)
+
+
+def frame_size(horizontal, vertical, width):
+    left, right = float(horizontal.min()), float(horizontal.max())
+    bottom, top = float(vertical.min()), float(vertical.max())
+    height = int(round(width * (top - bottom) / ((right - left) or 1.0)))
+    # Even sizes, which most video codecs need.
+    return (left, right, bottom, top), width + width % 2, max(2, height + height % 2)
+
+
+def sample(horizontal, vertical, values, on_nodes, bounds, width, height):
+    """
+    The value of the field at each pixel, NaN outside the mesh. The columns
+    of nodes are assumed to be vertical (the mesh only deforms vertically).
+    """
+    left, right, bottom, top = bounds
+    pixel_x = left + (np.arange(width) + 0.5) * (right - left) / width
+    pixel_y = top - (np.arange(height) + 0.5) * (top - bottom) / height
+    columns = horizontal.shape[1]
+    column = np.interp(pixel_x, horizontal[0], np.arange(columns))
+    first = np.minimum(column.astype(int), columns - 2)
+    t = column - first
+    # The heights of the nodes up each column of pixels, and so which row of the mesh each pixel is in.
+    heights = vertical[:, first] * (1 - t) + vertical[:, first + 1] * t
+    rows = np.empty((height, width))
+    for number in range(width):
+        rows[:, number] = np.interp(pixel_y, heights[:, number], np.arange(heights.shape[0]),
+                                    left=np.nan, right=np.nan)
+    outside = np.isnan(rows)
+    rows = np.nan_to_num(rows)
+
+    if on_nodes:
+        row = np.minimum(rows.astype(int), values.shape[0] - 2)
+        s = rows - row
+        col = np.broadcast_to(first, rows.shape)
+        image = (values[row, col] * (1 - s) * (1 - t) + values[row, col + 1] * (1 - s) * t +
+                 values[row + 1, col] * s * (1 - t) + values[row + 1, col + 1] * s * t)
+    else:
+        image = values[np.minimum(rows.astype(int), values.shape[0] - 1),
+                       np.minimum(np.broadcast_to(column.astype(int), rows.shape), values.shape[1] - 1)]
+    image = image.astype(np.float64)
+    image[outside] = np.nan
+    return image
+
+
+def field_values(settings, step):
+    """
+    The field's values at a timestep as (vertices, node shape, values, on
+    nodes), a single component (or the magnitude), log10 with --log.
+    """
+    path = settings["data_path"]
+    vertices, node_shape = checkpoint_io.read_mesh(path, step)
+    data = checkpoint_io.read_field(os.path.join(path, "{0}.{1:05d}.h5".format(settings["field"], step)))
+    data = data.reshape(data.shape[0], -1)
+    if settings["component"] is not None:
+        data = data[:, settings["component"]]
+    elif data.shape[1] == 1:
+        data = data[:, 0]
+    else:
+        data = np.sqrt(np.sum(data ** 2, axis=1))
+    if settings["log"]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data = np.where(data > 0, np.log10(np.abs(data)), np.nan)
+    return vertices, node_shape, data, data.shape[0] == vertices.shape[0]
+
+
+def value_range(args):
+    """
+    The 1st and 99th percentile of the field at one timestep.
+    """
+    settings, step = args
+    data = field_values(settings, step)[2]
+    data = data[np.isfinite(data)]
+    if not len(data):
+        return None
+    return float(np.percentile(data, 1)), float(np.percentile(data, 99))
+
+
+def render_field(settings, step):
+    vertices, node_shape, data, on_nodes = field_values(settings, step)
+    horizontal, vertical, values = section(vertices, node_shape, data, on_nodes, settings["slice"])
+    bounds, width, height = frame_size(horizontal, vertical, settings["width"])
+    image = sample(horizontal, vertical, values, on_nodes, bounds, width, height)
+    if settings["categorical"]:
+        return categorical_colours(np.round(image)), None
+    low, high = settings["range"]
+    bar = apply_colour_map(np.tile(np.linspace(low, high, width), (COLOUR_BAR_HEIGHT, 1)), low, high,
+                           settings["colour_map"])
+    return apply_colour_map(image, low, high, settings["colour_map"]), bar
+
+
+def render_swarm(settings, step):
+    path = settings["data_path"]
+    vertices, node_shape = checkpoint_io.read_mesh(path, step)
+    with h5py.File(os.path.join(path, "materialSwarm.{0:05d}.h5".format(step)), "r") as h5file:
+        positions = h5file["Position"][::settings["decimate"]]
+        materials = h5file["MaterialIndex"][::settings["decimate"]].ravel() if "MaterialIndex" in h5file else None
+    if len(node_shape) == 3:
+        axis, fraction = settings["slice"]
+        column = {"x": 0, "z": 2}[axis]
+        low, high = vertices[:, column].min(), vertices[:, column].max()
+        thickness = (high - low) / (node_shape[column] - 1)
+        keep = np.abs(positions[:, column] - (low + fraction * (high - low))) <= thickness / 2
+        positions = positions[keep][:, [2 if axis == "x" else 0, 1]]
+        materials = materials[keep] if materials is not None else None
+        vertices = vertices[:, [2 if axis == "x" else 0, 1]]
+    bounds, width, height = frame_size(vertices[:, 0], vertices[:, 1], settings["width"])
+    left, right, bottom, top = bounds
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[...] = BACKGROUND
+    x = np.clip(((positions[:, 0] - left) / (right - left) * width).astype(int), 0, width - 1)
+    y = np.clip(((top - positions[:, 1]) / (top - bottom) * height).astype(int), 0, height - 1)
+    if materials is None:
+        image[y, x] = (80, 80, 80)
+    else:
+        image[y, x] = categorical_colours(materials.astype(np.float64))
+    return image, None
+
+
+def render_frame(args):
+    """
+    Render and write one frame. Returns the timestep, or None if it was
+    already done.
+    """
+    settings, step = args
+    filename = os.path.join(settings["output_path"], "{0}.{1:05d}.png".format(settings["name"], step))
+    if os.path.exists(filename) and not settings["overwrite"]:
+        return None
+    image, bar = render_swarm(settings, step) if settings["swarm"] else render_field(settings, step)
+    if bar is not None:
+        image = np.concatenate([image, np.full((2, image.shape[1], 3), 255, dtype=np.uint8), bar])
+        image = image[:image.shape[0] - image.shape[0] % 2]
+    write_png(filename + ".partial", image)
+    os.rename(filename + ".partial", filename)
+    return step
+
+
+def make_movie(output_path, name, steps, fps):
+    """
+    Join the frames into an mp4 with ffmpeg. Returns its name, or None if
+    ffmpeg isn't there.
+    """
+    frame_list = os.path.join(output_path, "{0}.frames.txt".format(name))
+    with open(frame_list, "w") as frames:
+        for step in steps + steps[-1:]:  # ffmpeg's concat ignores the duration of the last one.
+            frames.write("file '{0}.{1:05d}.png'\nduration {2}\n".format(name, step, 1.0 / fps))
+    movie = os.path.join(output_path, name + ".mp4")
+    try:
+        with open(os.devnull, "w") as devnull:
+            returncode = subprocess.call(["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", frame_list,
+                                          "-pix_fmt", "yuv420p", "-r", str(fps), movie], stdout=devnull, stderr=devnull)
+    except OSError:
+        return None
+    return movie if returncode == 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a frame of a field for every checkpoint, and make a movie.")
+    parser.add_argument("data_path",
+                        help="The path to your results folder.")
+    parser.add_argument("--field", default="TemperatureField",
+                        help="The field to render. Default TemperatureField.")
+    parser.add_argument("--component", type=int,
+                        help="Which component of a vector or tensor field. Default the magnitude.")
+    parser.add_argument("--log", action="store_true",
+                        help="Colour by log10 of the value (e.g. for strain rates).")
+    parser.add_argument("--range", type=float, nargs=2, metavar=("LOW", "HIGH"),
+                        help="The values at the ends of the colour map. Default the range over the whole run.")
+    parser.add_argument("--colour_map", choices=sorted(COLOUR_MAPS), default="viridis",
+                        help="Default viridis.")
+    parser.add_argument("--slice", nargs=2, metavar=("AXIS", "FRACTION"), default=["z", "0.5"],
+                        help="In 3D, the section to render: z (an x-y plane) or x (a z-y plane), and how far "
+                             "along that axis, from 0 to 1. Default z 0.5.")
+    parser.add_argument("--swarm", action="store_true",
+                        help="Render the material particles rather than a field.")
+    parser.add_argument("--decimate", type=int, default=1,
+                        help="With --swarm, only render every n'th particle. Default all of them.")
+    parser.add_argument("--width", type=int, default=1600,
+                        help="Width of the frames in pixels. Default 1600.")
+    parser.add_argument("--fps", type=float, default=20,
+                        help="Frames per second of the movie. Default 20.")
+    parser.add_argument("--timesteps", type=int, nargs="+",
+                        help="Only these timesteps. Default all checkpointed ones.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="How many frames to render at once. Default: one per CPU.")
+    parser.add_argument("--output_path",
+                        help="Where to write the frames. Default <result folder>/frames.")
+    args = parser.parse_args()
+
+    if args.slice[0] not in ("x", "z"):
+        sys.exit("ERROR - The slice axis must be x or z")
+    name = "materialSwarm" if args.swarm else args.field + ("_log" if args.log else "") + (
+        "_{0}".format(args.component) if args.component is not None else "")
+    settings = {"data_path": args.data_path, "field": args.field, "component": args.component, "log": args.log,
+                "colour_map": args.colour_map, "slice": (args.slice[0], float(args.slice[1])), "swarm": args.swarm,
+                "decimate": max(1, args.decimate), "width": args.width, "name": name,
+                "categorical": args.field.startswith("MaterialIndex") and not args.log,
+                "output_path": args.output_path or os.path.join(args.data_path, "frames")}
+
+    reference = "materialSwarm" if args.swarm else args.field
+    steps = args.timesteps or checkpoint_io.checkpoint_steps(args.data_path, reference)
+    if not steps:
+        sys.exit("ERROR - No checkpoints ({0}.*.h5) found in {1}".format(reference, args.data_path))
+    if not os.path.isdir(settings["output_path"]):
+        os.makedirs(settings["output_path"])
+
+    pool = multiprocessing.Pool(max(1, args.processes))
+    try:
+        settings["range"] = args.range
+        if not args.swarm and not settings["categorical"] and settings["range"] is None:
+            ranges = [found for found in pool.map(value_range, [(settings, step) for step in steps]) if found]
+            if not ranges:
+                sys.exit("ERROR - {0} has no values to colour".format(args.field))
+            settings["range"] = [min(low for low, _ in ranges), max(high for _, high in ranges)]
+
+        # Frames rendered before with other settings (or a different range) have to be done again.
+        index_file = os.path.join(settings["output_path"], name + ".json")
+        try:
+            with open(index_file) as index:
+                previous = json.load(index)["settings"]
+        except (IOError, ValueError, KeyError):
+            previous = None
+        recorded = dict((key, value) for key, value in settings.items() if key not in ("output_path",))
+        recorded["slice"] = list(recorded["slice"])
+        settings["overwrite"] = previous != recorded
+
+        rendered = [step for step in pool.imap_unordered(render_frame, [(settings, step) for step in steps])
+                    if step is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+    try:
+        freq = FrequentOutput(args.data_path)
+        times = dict((step, freq.time_of(step) / checkpoint_io.SECONDS_PER_YEAR) for step in steps if step in freq.timesteps)
+    except IOError:
+        times = {}
+    with open(index_file, "w") as index:
+        json.dump({"settings": recorded, "frames": [{"timestep": step, "time_in_years": times.get(step)}
+                                                    for step in steps]}, index, indent=1, sort_keys=True)
+
+    print("Rendered {0} frame(s) ({1} already done) in {2}".format(
+        len(rendered), len(steps) - len(rendered), settings["output_path"]))
+    if settings["range"] is not None:
+        print("Colour range {0:.6g} to {1:.6g}{2}".format(settings["range"][0], settings["range"][1],
+                                                          " (log10)" if args.log else ""))
+    movie = make_movie(settings["output_path"], name, sorted(steps), args.fps)
+    if movie:
+        print("Movie: {0}".format(movie))
+    else:
+        print("ffmpeg isn't installed (or failed), so there's no movie, just the frames.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
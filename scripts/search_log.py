@@ -0,0 +1,139 @@
+"""
+============
+ Search log
+============
+
+Searches the compressed logs the LMR writes when <write_log_file> and
+<compress_log_file> are true. These are folders (e.g.
+log_result_208x96x0_reference_model/) of gzip compressed segments,
+log.00000.txt.gz, log.00001.txt.gz, ..., plus an index.txt saying which
+timesteps each segment covers.
+
+Segments are searched newest first, and only as many as are needed, so
+looking at recent output is fast no matter how long the run has been going.
+
+Run by:
+    python search_log.py <log folder> <regular expression>
+
+For example, the last 20 non-linear solver results:
+    python search_log.py log_result_208x96x0_reference_model "Non linear solver - Residual" -n 20
+
+Everything printed between timesteps 1200 and 1250:
+    python search_log.py log_result_208x96x0_reference_model . --timesteps 1200 1250
+
+The whole log, uncompressed, in order:
+    python search_log.py log_result_208x96x0_reference_model . --all
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import sys
+import zlib
+
+
+def read_index(log_dir):
+    index = {}
+    try:
+        with open(os.path.join(log_dir, "index.txt")) as index_file:
+            for line in index_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                index[entry["segment"]] = entry
+    except IOError:
+        pass
+    return index
+
+
+def read_segment(filename):
+    """
+    Return the lines of a segment. The segment currently being written has
+    no gzip footer yet, so read as much of it as has been flushed.
+    """
+    with open(filename, "rb") as segment:
+        data = segment.read()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        text = decompressor.decompress(data)
+    except zlib.error:
+        with gzip.open(filename, "rb") as segment:
+            text = segment.read()
+    if not isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return text.splitlines()
+
+
+def segment_overlaps(entry, first, last):
+    if entry is None or entry.get("first_timestep") is None:
+        return True  # Not indexed yet (still being written), or no timesteps in it.
+    return entry["last_timestep"] >= first and entry["first_timestep"] <= last
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the compressed logs written by the LMR.")
+    parser.add_argument("log_dir",
+                        help="The log folder, e.g. log_result_208x96x0_reference_model")
+    parser.add_argument("pattern",
+                        help="A (Python) regular expression to look for. Use . to match everything.")
+    parser.add_argument("-n", "--max_matches", type=int, default=50,
+                        help="Stop after this many matches, counting back from the end. Default 50.")
+    parser.add_argument("--timesteps", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Only search output from these timesteps.")
+    parser.add_argument("--all", action="store_true",
+                        help="Print every match in the whole log, oldest first.")
+    args = parser.parse_args()
+
+    segments = sorted(glob.glob(os.path.join(args.log_dir, "log.*.txt.gz")))
+    if not segments:
+        sys.exit("ERROR - No log segments (log.*.txt.gz) found in {0}".format(args.log_dir))
+
+    pattern = re.compile(args.pattern)
+    timestep_re = re.compile(r"^TimeStep = (\d+)")
+    index = read_index(args.log_dir)
+
+    if args.all:
+        for filename in segments:
+            for line in read_segment(filename):
+                if pattern.search(line):
+                    print(line)
+        return 0
+
+    matches = []
+    for number in reversed(range(len(segments))):
+        filename = segments[number]
+        entry = index.get(os.path.basename(filename))
+        if args.timesteps and entry is not None and entry.get("last_timestep") is not None \
+                and entry["last_timestep"] < args.timesteps[0]:
+            break  # Everything from here back is too early.
+        if args.timesteps and not segment_overlaps(entry, *args.timesteps):
+            continue
+
+        segment_matches = []
+        # Output before the first TimeStep line belongs to the previous segment's last timestep.
+        previous = index.get(os.path.basename(segments[number - 1])) if number > 0 else None
+        timestep = previous.get("last_timestep") if previous else None
+        for line in read_segment(filename):
+            match = timestep_re.match(line)
+            if match:
+                timestep = int(match.group(1))
+            if args.timesteps and (timestep is None or not args.timesteps[0] <= timestep <= args.timesteps[1]):
+                continue
+            if pattern.search(line):
+                segment_matches.append(line)
+
+        matches = segment_matches + matches
+        if len(matches) >= args.max_matches:
+            break
+
+    for line in matches[-args.max_matches:]:
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,10 +4,8 @@ import os
 import argparse
 
 
-try:
-    import numpy as np
-except ImportError as e:
-    sys.exit("This script requires numpy\n")
+# Needs numpy, and says so if it isn't there.
+from frequent_output import FrequentOutput
 
 
 def main():
@@ -56,7 +54,7 @@ def main():
         reference_files_pattern += "*"
 
     try:
-        timing_data = np.loadtxt("{folder}/FrequentOutput.dat".format(folder=folder))
+        timing_data = FrequentOutput(folder).data
     except IOError as ioe:
         sys.exit("Unable to find the FrequentOutput.dat file. Here is what the computer says:\n{0}".format(ioe))
 
@@ -0,0 +1,384 @@
+"""
+=============
+ Sweep table
+=============
+
+Collects the results of many runs (e.g. a parameter sweep) into one table, so
+comparing hundreds of runs is a single load rather than a crawl through every
+result folder.
+
+For each result folder it records:
+    - the settings that differ between the runs: from lmrStart.xml (as
+      lmrRunModel.py resolved them, in xmls/lmr_model.json) and every value
+      in the Underworld XMLs in xmls/,
+    - the timesteps, model time, checkpoints and the last (and largest) value
+      of each column of FrequentOutput.dat (e.g. Vrms),
+    - the wall time, CPUs, memory, solver and exit code of the run, from the
+      lmr_run_history.jsonl in the model folder,
+    - the last diagnostics of the run (see diagnostics.py), if it has been
+      measured,
+    - every column of FrequentOutput.dat, and every diagnostic (named
+      diagnostics:<name>, with its own diagnostics:timestep), as time series.
+
+The table is an HDF5 file, one dataset per column under /runs (numbers are
+float64, with NaN where a run doesn't have the value, text is fixed length
+strings), keyed by the run's fingerprint (see <memoize_runs>, or a hash of
+its settings if it has none). The time series are under
+/timeseries/<fingerprint>/<column>.
+
+Running it again only reads the folders that have changed since (e.g. runs
+that have carried on, or finished), so it can be kept up to date while a
+sweep runs with --follow. The folders are read in parallel.
+
+Run by:
+    python sweep_table.py <result folder or model folder> [...] --output sweep.h5 [--follow 300]
+
+A model folder stands for all the result_* and initial-condition_* folders in
+it. To load the table, e.g. into pandas:
+    import pandas, sweep_table
+    runs = pandas.DataFrame(sweep_table.load_table("sweep.h5"))
+    vrms = sweep_table.load_timeseries("sweep.h5", runs.fingerprint[0])["Vrms"]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from xml.etree import ElementTree
+
+import checkpoint_io
+import diagnostics
+from frequent_output import FrequentOutput
+
+try:
+    import numpy as np
+    import h5py
+except ImportError:
+    sys.exit("This script requires numpy and h5py\n")
+
+# Settings that are different for every run, but only because its description is.
+BOOKKEEPING = ("nice_description", "nice_thermal_description", "logfile", "resource_file", "fingerprint",
+               "input_xmls", "restarting", "restart_timestep", "memoized")
+
+# What the run history records about each run.
+HISTORY_VALUES = ("wall_time", "cpu_time", "cpu_efficiency", "ranks", "peak_rank_rss", "peak_total_rss",
+                  "solver_type", "returncode", "health_abort", "date")
+
+
+def run_folders(paths):
+    """
+    The result folders in paths, with model folders replaced by the result
+    folders in them. Links to a folder already included (e.g. memoized runs)
+    are left out.
+    """
+    folders = []
+    seen = set()
+    for path in paths:
+        if os.path.isfile(os.path.join(path, "FrequentOutput.dat")):
+            candidates = [path]
+        else:
+            candidates = sorted(glob.glob(os.path.join(path, "result_*")) +
+                                glob.glob(os.path.join(path, "initial-condition_*")))
+        for candidate in candidates:
+            real = os.path.realpath(candidate)
+            if os.path.isfile(os.path.join(candidate, "FrequentOutput.dat")) and real not in seen:
+                seen.add(real)
+                folders.append(candidate)
+    return folders
+
+
+def signature(folder):
+    """
+    Changes whenever anything the table records about the folder does.
+    """
+    parts = []
+    for filename in (os.path.join(folder, "FrequentOutput.dat"), os.path.join(folder, "lmr_fingerprint.txt"),
+                     os.path.join(folder, diagnostics.FILENAME),
+                     os.path.join(os.path.dirname(os.path.abspath(folder)), "lmr_run_history.jsonl")):
+        try:
+            stat = os.stat(filename)
+            parts.append("{0}:{1}".format(stat.st_mtime, stat.st_size))
+        except OSError:
+            parts.append("-")
+    parts.append(str(len(checkpoint_io.checkpoint_steps(folder))))
+    return " ".join(parts)
+
+
+def flatten_xml(filename, settings):
+    """
+    Add every value in an XML to settings, named by the file, and the names
+    (or tags) of the elements it is in.
+    """
+    def local(tag):
+        return tag.split("}")[-1]
+
+    def walk(element, path):
+        for number, child in enumerate(element):
+            if not isinstance(child.tag, str):
+                continue  # A comment.
+            tag = local(child.tag)
+            name = child.get("name") or (str(number) if tag in ("struct", "list", "param", "element") else tag)
+            if len(child):
+                walk(child, path + name + ".")
+            elif child.text and child.text.strip():
+                settings[path + name] = " ".join(child.text.split())
+
+    try:
+        walk(ElementTree.parse(filename).getroot(), os.path.basename(filename) + ":")
+    except ElementTree.ParseError:
+        pass
+
+
+def flatten_dict(values, path, settings):
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flatten_dict(value, path + key + ".", settings)
+        elif key not in BOOKKEEPING and not (isinstance(value, basestring) and os.sep in value):
+            settings[path + key] = value
+
+
+def run_settings(folder):
+    """
+    The settings of a run, from the XMLs it was run with (the last restart's,
+    if it has been restarted).
+    """
+    xml_folders = [path for path in glob.glob(os.path.join(folder, "xmls*")) if os.path.isdir(path)]
+    if not xml_folders:
+        return {}
+    # xmls, xmls_restart_1, xmls_restart_2, ...
+    xmls_dir = max(xml_folders, key=lambda path: int(path.split("_")[-1]) if "_restart_" in os.path.basename(path) else 0)
+    settings = {}
+    try:
+        with open(os.path.join(xmls_dir, "lmr_model.json")) as model:
+            flatten_dict(json.load(model), "", settings)
+        start_xml = False
+    except (IOError, ValueError):
+        start_xml = True  # Run before lmr_model.json was written, so lmrStart.xml is the best there is.
+    for filename in sorted(glob.glob(os.path.join(xmls_dir, "*.xml"))):
+        name = os.path.basename(filename)
+        # Any other start XMLs in the model folder were copied too, but weren't used.
+        if not name.startswith("lmrStart") or (start_xml and name == "lmrStart.xml"):
+            flatten_xml(filename, settings)
+    return settings
+
+
+def history_record(folder):
+    """
+    The run history's last record of the run in folder, or {}.
+    """
+    name = os.path.basename(os.path.abspath(folder))
+    thermal = name.startswith("initial-condition_")
+    description = name.split("_", 1)[-1]
+    record = {}
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(folder)), "lmr_run_history.jsonl")) as history:
+            for line in history:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("description") == description and entry.get("thermal") == thermal:
+                    record = entry
+    except IOError:
+        pass
+    return record
+
+
+def read_run(args):
+    """
+    Everything the table records about one result folder. Run in the pool.
+    """
+    folder, folder_signature = args
+    try:
+        freq = FrequentOutput(folder)
+    except IOError as err:
+        return folder, None, str(err)
+
+    settings = run_settings(folder)
+    try:
+        with open(os.path.join(folder, "lmr_fingerprint.txt")) as stamp:
+            fingerprint = stamp.read().strip()
+    except IOError:
+        # Not memoized, so the settings (which include the description) stand in for it.
+        fingerprint = hashlib.sha256(json.dumps([os.path.basename(os.path.abspath(folder)), settings],
+                                                sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    steps = checkpoint_io.checkpoint_steps(folder)
+    results = {"fingerprint": fingerprint, "path": os.path.abspath(folder),
+               "phase": "thermal" if os.path.basename(os.path.abspath(folder)).startswith("initial") else "mechanical",
+               "timesteps": len(freq.data), "checkpoints": len(steps), "last_checkpoint": steps[-1] if steps else None}
+    if len(freq.data):
+        results["final_timestep"] = int(freq.timesteps[-1])
+        results["final_time_years"] = float(freq.times[-1]) / checkpoint_io.SECONDS_PER_YEAR
+        for number, column in enumerate(freq.columns[2:], 2):
+            results["final_" + column] = float(freq.data[-1, number])
+            results["max_" + column] = float(np.max(freq.data[:, number]))
+
+    history = history_record(folder)
+    for key in HISTORY_VALUES:
+        if history.get(key) is not None:
+            results[key] = history[key]
+    if history.get("wall_time") and history.get("timesteps", 0) > history.get("first_timestep", 0):
+        results["time_per_step"] = history["wall_time"] / (history["timesteps"] - history.get("first_timestep", 0))
+
+    timeseries = dict((column, np.array(freq.data[:, number])) for number, column in enumerate(freq.columns or []))
+    measured = diagnostics.load_diagnostics(folder)
+    if measured:
+        for name in diagnostics.DIAGNOSTICS:
+            results["final_" + name] = measured[-1].get(name)
+        for name in ["timestep"] + diagnostics.DIAGNOSTICS:
+            timeseries["diagnostics:" + name] = column_array([record.get(name) for record in measured])
+    return folder, {"signature": folder_signature, "settings": settings, "results": results}, timeseries
+
+
+def column_array(values):
+    """
+    A column of the table: float64 (NaN if missing) if every value is a
+    number, otherwise fixed length strings.
+    """
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, (bool, int, long, float)) for value in present):
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    text = ["" if value is None else (value if isinstance(value, basestring) else json.dumps(value)) for value in values]
+    return np.array([value.encode("utf-8") for value in text], dtype="S{0}".format(max([1] + [len(value) for value in text])))
+
+
+def write_runs(h5file, records):
+    """
+    (Re)write /runs from the records of every run: the results, and the
+    settings that aren't the same in every run.
+    """
+    records = sorted(records, key=lambda record: record["results"]["path"])
+    settings = set()
+    for record in records:
+        settings.update(record["settings"])
+    # Ones only some runs have (e.g. from before lmr_model.json was written) count if they differ between those.
+    varying = sorted(name for name in settings
+                     if len(set(json.dumps(record["settings"][name], sort_keys=True)
+                                for record in records if name in record["settings"])) > 1)
+    results = sorted(set(name for record in records for name in record["results"]))
+
+    if "runs" in h5file:
+        del h5file["runs"]
+    runs = h5file.create_group("runs")
+    for name in results:
+        runs.create_dataset(name, data=column_array([record["results"].get(name) for record in records]))
+    for name in varying:
+        runs.create_dataset("setting:" + name.replace("/", "|"),
+                            data=column_array([record["settings"].get(name) for record in records]))
+    runs.attrs["runs"] = len(records)
+    return varying
+
+
+def update_table(output, folders, processes):
+    """
+    Read the folders that have changed since the table was last written, and
+    rewrite the table. Returns (read, problems).
+    """
+    problems = []
+    with h5py.File(output, "a") as h5file:
+        series = h5file.require_group("timeseries")
+        # The fingerprint (and so the group) of each folder already in the table.
+        known = dict((group.attrs["path"], name) for name, group in series.items())
+        signatures = dict((folder, signature(folder)) for folder in folders)
+        changed = [(folder, signatures[folder]) for folder in folders
+                   if os.path.abspath(folder) not in known
+                   or series[known[os.path.abspath(folder)]].attrs["signature"] != signatures[folder]]
+
+        pool = multiprocessing.Pool(max(1, processes))
+        try:
+            for folder, record, timeseries in pool.imap_unordered(read_run, changed):
+                if record is None:
+                    problems.append("{0}: {1}".format(folder, timeseries))
+                    continue
+                path = record["results"]["path"]
+                fingerprint = record["results"]["fingerprint"]
+                if path in known:
+                    del series[known[path]]
+                if fingerprint in series:
+                    # An identical run in another folder; keep the one that got further.
+                    other = json.loads(series[fingerprint].attrs["record"])
+                    if other["results"]["timesteps"] >= record["results"]["timesteps"]:
+                        problems.append("{0}: the same run as {1}, so it's left out".format(folder, other["results"]["path"]))
+                        continue
+                    del series[fingerprint]
+                group = series.create_group(fingerprint)
+                for column, values in timeseries.items():
+                    group.create_dataset(column.replace("/", "|"), data=values, compression="gzip", compression_opts=1)
+                group.attrs["path"] = path
+                group.attrs["signature"] = record["signature"]
+                group.attrs["record"] = json.dumps(record, sort_keys=True, default=str)
+                known[path] = fingerprint
+        finally:
+            pool.close()
+            pool.join()
+
+        # Folders that have gone since last time drop out of the table.
+        wanted = set(os.path.abspath(folder) for folder in folders)
+        for path, name in list(known.items()):
+            if path not in wanted and name in series:
+                del series[name]
+        write_runs(h5file, [json.loads(run.attrs["record"]) for run in series.values()])
+    return len(changed), problems
+
+
+def load_table(filename):
+    """
+    The table of runs, as a dict of column name -> numpy array (text columns
+    decoded), ready for pandas.DataFrame.
+    """
+    with h5py.File(filename, "r") as h5file:
+        columns = {}
+        for name, data in h5file["runs"].items():
+            values = data[()]
+            if values.dtype.kind == "S":
+                values = np.array([value.decode("utf-8") for value in values], dtype=object)
+            columns[name.replace("|", "/")] = values
+    return columns
+
+
+def load_timeseries(filename, fingerprint):
+    """
+    The FrequentOutput.dat columns of one run, as a dict of column -> array.
+    """
+    with h5py.File(filename, "r") as h5file:
+        return dict((name.replace("|", "/"), data[()]) for name, data in h5file["timeseries"][fingerprint].items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect the results of many runs into one HDF5 table.")
+    parser.add_argument("paths", nargs="+",
+                        help="Result folders, or model folders (for all the result folders in them).")
+    parser.add_argument("--output", default="sweep_table.h5",
+                        help="The table to write (or update). Default sweep_table.h5.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="How many folders to read at once. Default: the number of cores.")
+    parser.add_argument("--follow", type=float, default=0, metavar="SECONDS",
+                        help="Keep updating the table this often, until stopped with Ctrl-C.")
+    args = parser.parse_args()
+
+    try:
+        while True:
+            started = time.time()
+            folders = run_folders(args.paths)
+            read, problems = update_table(args.output, folders, args.processes)
+            for problem in problems:
+                print("WARNING - {0}".format(problem))
+            print("{0} runs in {1} ({2} read in {3:.1f} seconds)".format(
+                len(folders), args.output, read, time.time() - started))
+            sys.stdout.flush()
+            if args.follow <= 0:
+                break
+            time.sleep(args.follow)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+====================
+ Verify checkpoints
+====================
+
+Checks which checkpoints in a result folder can be restarted from: every
+file Underworld needs must be there, open cleanly (if h5py is installed),
+have the same mesh field shapes as the first checkpoint, and match the
+checksum recorded when it was moved out of <scratch_directory> (if it was).
+The files of each checkpoint are checked in parallel.
+
+lmrRunModel.py does the same checks when restarting, and picks the newest
+checkpoint that passes, but it's worth checking before waiting in a queue.
+
+Run by:
+    python verify_checkpoints.py <result folder> [--timesteps 100 200] [--all]
+
+By default only the newest checkpoints are checked, until one passes.
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+LMR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LMR_DIR)
+import lmrRunModel  # noqa: E402
+import checkpoint_io  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check which LMR checkpoints can be restarted from.")
+    parser.add_argument("data_path",
+                        help="The path to your results folder.")
+    parser.add_argument("--scratch_path",
+                        help="Where <scratch_directory> put this run, if checkpoints may still be there.")
+    parser.add_argument("--timesteps", type=int, nargs="+",
+                        help="Only check these timesteps.")
+    parser.add_argument("--all", action="store_true",
+                        help="Check every checkpoint, not just the newest until one passes.")
+    parser.add_argument("--processes", type=int,
+                        help="How many files to check at once. Default: one per CPU.")
+    args = parser.parse_args()
+
+    if not lmrRunModel.have_h5py:
+        print("h5py isn't installed, so only file sizes and recorded checksums can be checked.")
+
+    search_paths = [path for path in (args.data_path, args.scratch_path) if path]
+    steps = args.timesteps or sorted(set(checkpoint_io.step_of(filename) for path in search_paths
+                                         for filename in glob.glob(os.path.join(path, "VelocityField.*.h5"))),
+                                     reverse=True)
+    if not steps:
+        sys.exit("ERROR - No checkpoints (VelocityField.*.h5) found in {0}".format(args.data_path))
+
+    damaged = 0
+    for step in steps:
+        problems = lmrRunModel.checkpoint_problems(args.data_path, args.scratch_path, step, args.processes)
+        if problems:
+            damaged += 1
+            print("Timestep {0:>6d}: DAMAGED\n    {1}".format(step, "\n    ".join(problems)))
+        else:
+            print("Timestep {0:>6d}: ok".format(step))
+            if not (args.all or args.timesteps):
+                break
+    return 1 if damaged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,42 +9,35 @@
 
 A surprisingly difficult tool to find (in open-source anyway)!
 
-Prints out the diffs between two Underworld flattened XMLs.
+Prints out the differences between Underworld flattened XMLs, as the path
+of each struct/list/param that differs, and its values.
 
 Run by:
 python xml_diff.py <xml_file_1> <xml_file_2>
 
-When you do this, it will print out a list of differences, generally with
-some context.
-
 For example:
 ::
-    ['*** ',
-     '--- ',
-     '***************',
-     '*** 21,28 ****',
-     "   OrderedDict([('Type', 'StgFEM_PeakMemory'",
-     "   ('Context', 'context')]",
-     "   OrderedDict([('Type', 'Underworld_HDF5ConditionFunction'",
-     "!  ('FeVariableHDF5Filename', '/mnt/landscapes/UWtests/lmrMeshAdapter/initial-condition_4x52x0_laterally_homog/TemperatureField.04505.h5'",
-     "!  ('MeshHDF5Filename', '/mnt/landscapes/UWtests/lmrMeshAdapter/initial-condition_4x52x0_laterally_homog/Mesh.linearMesh.00000.h5'",
-     "   ('TargetFeVariable', 'TemperatureField'",
-     "   ('Partitioned', False)]",
-     "   OrderedDict([('rhoZeroMaterial', 'mantle'",
-     '--- 21,28 ----',
-     "   OrderedDict([('Type', 'StgFEM_PeakMemory'",
-     "   ('Context', 'context')]",
-     "   OrderedDict([('Type', 'Underworld_HDF5ConditionFunction'",
-     "!  ('FeVariableHDF5Filename', '/mnt/landscapes/UWtests/lmrMeshAdapter_v2/initial-condition_4x48x0_laterally_homog/TemperatureField.00152.h5'",
-     "!  ('MeshHDF5Filename', '/mnt/landscapes/UWtests/lmrMeshAdapter_v2/initial-condition_4x48x0_laterally_homog/Mesh.linearMesh.00000.h5'",
-     "   ('TargetFeVariable', 'TemperatureField'",
-     "   ('Partitioned', False)]",
-     "   OrderedDict([('rhoZeroMaterial', 'mantle'"]
-
-
-The two lines with differences are highlighted with '!', and the surrounding
-stuff is just to give some context about where in the file these changes are.
-It is far from perfect, but works well enough.
+    components/temperatureICs/FeVariableHDF5Filename
+        /mnt/landscapes/UWtests/lmrMeshAdapter/initial-condition_4x52x0_laterally_homog/TemperatureField.04505.h5
+        /mnt/landscapes/UWtests/lmrMeshAdapter_v2/initial-condition_4x48x0_laterally_homog/TemperatureField.00152.h5
+
+Lists are compared item by item, shown as e.g. plugins[3]/Type.
+
+Any number of files can be compared against the first one (the baseline),
+which is how to see what varies across a parameter sweep:
+python xml_diff.py <baseline.xml> <xml_file> [<xml_file> ...]
+
+This prints each path that differs in any of the files, with the baseline
+value and the value in each file that differs. Instead of a file, a result
+folder can be given, and the input.xml Underworld flattens into it is used.
+Add --json for output other programs can read:
+    {"baseline": ..., "files": [...], "differences": {path: {file: value, ...}}}
+where each path's entry has the baseline value under the baseline's name,
+and the value in every file that differs from it ("<missing>" if the path
+isn't there at all).
+
+Every struct and list is hashed once, so branches that are identical to
+the baseline are skipped without looking inside them.
 
 Relies on numerous code snippets from the web. Unfortunately, the sources to
 these have been lost. If you recognise the source of these code snippets,
@@ -52,43 +45,136 @@ please let us know, and we will reference accordingly.
 """
 
 from xml.etree import ElementTree
-from pprint import pprint
 from collections import OrderedDict
-import difflib
+import hashlib
+import json
 import sys
 import argparse
 import os
 
+MISSING = "<missing>"
+
 
 def main():
-    parser = argparse.ArgumentParser(description="Compare two flattened UW XML files.")
-    parser.add_argument("xml_file_1",
-                        help="The first XML file.")
-    parser.add_argument("xml_file_2",
-                        help="The second XML file.")
+    parser = argparse.ArgumentParser(description="Compare flattened UW XML files against the first one.")
+    parser.add_argument("baseline",
+                        help="The XML file (or result folder) to compare against.")
+    parser.add_argument("others", nargs="+",
+                        help="The XML files (or result folders) to compare with it.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the differences as JSON.")
     args = parser.parse_args()
 
-    if not os.path.isfile(args.xml_file_1):
-        sys.exit("ERROR - Can't find first XML file: {0}".format(args.xml_file_1))
-    if not os.path.isfile(args.xml_file_2):
-        sys.exit("ERROR - Can't find second XML file: {0}".format(args.xml_file_2))
-
-    tree1 = ElementTree.parse(args.xml_file_1)
-    tree2 = ElementTree.parse(args.xml_file_2)
-    dict1 = _elementToDict(tree1.getroot())
-    dict2 = _elementToDict(tree2.getroot())
-    diff = dict_diff(dict1, dict2)
-    if(len(diff)):
-        print "Differences:"
-        for key, value in diff.items():
-            first = str(value[0]).split('),')
-            second = str(value[1]).split('),')
-            result = list(difflib.context_diff(first, second, lineterm=""))
-            pprint(result)
+    baseline_file = find_xml(args.baseline)
+    baseline = hash_tree(load_flattened(baseline_file))
+
+    differences = OrderedDict()
+    files = []
+    for other in args.others:
+        other_file = find_xml(other)
+        files.append(other_file)
+        for path, base_value, value in diff_trees(baseline, hash_tree(load_flattened(other_file))):
+            differences.setdefault(path, OrderedDict([(baseline_file, base_value)]))[other_file] = value
+
+    if args.json:
+        print json.dumps({"baseline": baseline_file, "files": files, "differences": differences},
+                         indent=1, default=str)
+    elif len(differences):
+        print "Differences from {0}:".format(baseline_file)
+        for path, values in differences.items():
+            print path
+            for filename, value in values.items():
+                print "    {0}".format(value) if len(files) == 1 else "    {0}: {1}".format(filename, value)
+        if len(files) > 1:
+            print "\n{0} paths differ across {1} files".format(len(differences), len(files))
     else:
         print "No Differences"
 
 
+def find_xml(path):
+    """
+    Use the input.xml Underworld writes into a result folder, if given a folder.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "input.xml")
+    if not os.path.isfile(path):
+        sys.exit("ERROR - Can't find XML file: {0}".format(path))
+    return path
+
+
+def load_flattened(xml_file):
+    return _elementToDict(ElementTree.parse(xml_file).getroot())
+
+
+class HashedNode(object):
+    """
+    A value from the XML dict, with a hash of everything under it. For a
+    struct, children is an OrderedDict of HashedNodes; for a list, a list
+    of them; for a param, None.
+    """
+    __slots__ = ("digest", "value", "children")
+
+    def __init__(self, digest, value, children):
+        self.digest = digest
+        self.value = value
+        self.children = children
+
+
+def hash_tree(value):
+    digest = hashlib.md5()
+    if isinstance(value, dict):
+        children = OrderedDict((key, hash_tree(child)) for key, child in value.items())
+        digest.update(b"struct")
+        for key, child in children.items():
+            digest.update(repr(key).encode("utf-8") + b"=" + child.digest)
+    elif isinstance(value, list):
+        children = [hash_tree(child) for child in value]
+        digest.update(b"list")
+        for child in children:
+            digest.update(child.digest)
+    else:
+        children = None
+        digest.update(repr(value).encode("utf-8"))
+    return HashedNode(digest.digest(), value, children)
+
+
+def describe(node):
+    if node is None:
+        return MISSING
+    if node.children is None:
+        return node.value
+    return "<struct>" if isinstance(node.children, dict) else "<list of {0}>".format(len(node.children))
+
+
+def diff_trees(first, second, path=""):
+    """
+    Yield (path, first value, second value) for everything that differs
+    between two HashedNode trees. Subtrees with the same hash are skipped.
+    """
+    if first is not None and second is not None and first.digest == second.digest:
+        return
+    if first is not None and second is not None and isinstance(first.children, dict) \
+            and isinstance(second.children, dict):
+        for key in first.children:
+            for difference in diff_trees(first.children[key], second.children.get(key),
+                                         "{0}/{1}".format(path, key) if path else key):
+                yield difference
+        for key in second.children:
+            if key not in first.children:
+                for difference in diff_trees(None, second.children[key],
+                                             "{0}/{1}".format(path, key) if path else key):
+                    yield difference
+    elif first is not None and second is not None and isinstance(first.children, list) \
+            and isinstance(second.children, list):
+        for index in range(max(len(first.children), len(second.children))):
+            first_item = first.children[index] if index < len(first.children) else None
+            second_item = second.children[index] if index < len(second.children) else None
+            for difference in diff_trees(first_item, second_item, "{0}[{1}]".format(path, index)):
+                yield difference
+    else:
+        yield path, describe(first), describe(second)
+
+
 def _elemGetKey(elem):
     elemtagsplit = elem.tag
     if 'name' in elem.attrib:
@@ -240,26 +326,5 @@ class XmlDictConfig(dict):
                 self.update({element.tag: element.text})
 
 
-def dict_diff(first, second):
-    """ Return a dict of keys that differ with another config object.  If a
-        value is not found in one of the configs, it will be represented by
-        KEYNOTFOUND.
-        @param first:   Fist dictionary to diff.
-        @param second:  Second dicationary to diff.
-        @return diff:   Dict of Key => (first.val, second.val)
-    """
-    diff = {}
-    # Check all keys in first dict
-    for key in first.keys():
-        if key not in second:
-            diff[key] = (first[key], KEYNOTFOUND)
-        elif first[key] != second[key]:
-            diff[key] = (first[key], second[key])
-    # Check all keys in second dict to find missing
-    for key in second.keys():
-        if key not in first:
-            diff[key] = (KEYNOTFOUND, second[key])
-    return diff
-
 if __name__ == '__main__':
     main()